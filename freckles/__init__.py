@@ -4,4 +4,4 @@ __author__ = """Markus Binsteiner"""
 __email__ = 'makkus@posteo.de'
 __version__ = '0.1.70'
 
-from freckles import Freck, Freckles, FrecklesRunCallback
+from freckles import BatchableFreck, Freck, Freckles, FrecklesRunCallback
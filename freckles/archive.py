@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import tarfile
+import time
+from datetime import datetime
+
+from constants import *
+
+log = logging.getLogger("freckles")
+
+ARCHIVE_COMPRESSED_EXTENSION = ".tar.gz"
+
+
+def get_disk_usage(*paths):
+    """Returns the number of bytes of disk space used by the files and directories in the provided paths, counting files that are hard-linked multiple times only once."""
+
+    seen = set()
+    total = 0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                file_stat = os.lstat(os.path.join(root, name))
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                if inode in seen:
+                    continue
+                seen.add(inode)
+                # the space that is actually allocated, if the platform reports it
+                blocks = getattr(file_stat, "st_blocks", None)
+                total = total + (blocks * 512 if blocks is not None else file_stat.st_size)
+
+    return total
+
+
+def get_blob_key(path, file_stat):
+    """Returns the key of a file in the blob store, which changes if its content or permissions change."""
+
+    content_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            content_hash.update(chunk)
+
+    return "{}_{:o}".format(content_hash.hexdigest(), stat.S_IMODE(file_stat.st_mode))
+
+
+class RunArchive(object):
+    """Manages the archive of the directories of finished runs.
+
+    Every invocation of 'freckles apply' creates one archive entry, a directory named after its start date (see FRECKLES_ARCHIVE_DATE_FORMAT) that contains the directories of all its runs. Entries are never changed after they are created, so identical files in different entries (mostly roles and playbooks) can be replaced by hard links to a single copy in a content-addressed blob store. Old entries can be compressed into a '.tar.gz' file, or removed. The entry the 'last' link points to is never compressed or removed.
+
+    Args:
+        archive_dir (str): the directory containing the archive entries
+        blob_dir (str): the directory of the blob store (has to be on the same filesystem as 'archive_dir')
+        last_link (str): the link to the directory of the last run
+    """
+
+    def __init__(self, archive_dir=FRECKLES_DEFAULT_EXECUTION_ARCHIVE_DIR, blob_dir=FRECKLES_DEFAULT_ARCHIVE_BLOB_DIR, last_link=FRECKLES_DEFAULT_LAST_EXECUTION_DIR):
+
+        self.archive_dir = archive_dir
+        self.blob_dir = blob_dir
+        self.last_link = last_link
+
+    def get_entries(self):
+        """Returns the names of all archive entries (compressed ones including their extension), oldest first."""
+
+        if not os.path.isdir(self.archive_dir):
+            return []
+
+        return sorted(os.listdir(self.archive_dir), key=lambda name: (self.get_entry_date(name), name))
+
+    def get_entry_date(self, name):
+        """Returns the time (in seconds since the epoch) an archive entry was created."""
+
+        if name.endswith(ARCHIVE_COMPRESSED_EXTENSION):
+            name = name[:-len(ARCHIVE_COMPRESSED_EXTENSION)]
+        try:
+            return time.mktime(datetime.strptime(name, FRECKLES_ARCHIVE_DATE_FORMAT).timetuple())
+        except ValueError:
+            return os.path.getmtime(os.path.join(self.archive_dir, name))
+
+    def get_last_entry(self):
+        """Returns the name of the archive entry the 'last' link points to, or None."""
+
+        if not os.path.islink(self.last_link):
+            return None
+
+        target = os.path.realpath(self.last_link)
+        archive_dir = os.path.realpath(self.archive_dir)
+        if not target.startswith(archive_dir + os.sep):
+            return None
+
+        return os.path.relpath(target, archive_dir).split(os.sep)[0]
+
+    def dedup(self, path):
+        """Replaces the files in a directory (recursively) with hard links to identical files in the blob store, adding the ones that aren't in there yet.
+
+        Returns:
+            int: the number of files that were replaced
+        """
+
+        replaced = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(root, name)
+                file_stat = os.lstat(file_path)
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+
+                try:
+                    blob_key = get_blob_key(file_path, file_stat)
+                    blob_path = os.path.join(self.blob_dir, blob_key[:2], blob_key)
+                    if not os.path.exists(blob_path):
+                        if not os.path.isdir(os.path.dirname(blob_path)):
+                            os.makedirs(os.path.dirname(blob_path))
+                        os.link(file_path, blob_path)
+                        continue
+
+                    blob_stat = os.stat(blob_path)
+                    if (blob_stat.st_dev, blob_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino):
+                        continue
+                    temp_path = "{}.{}".format(file_path, os.getpid())
+                    os.link(blob_path, temp_path)
+                    os.rename(temp_path, file_path)
+                    replaced = replaced + 1
+                except (IOError, OSError) as e:
+                    log.debug("Could not deduplicate '{}': {}".format(file_path, e))
+
+        return replaced
+
+    def compress(self, name):
+        """Replaces an archive entry with a '.tar.gz' file."""
+
+        entry_path = os.path.join(self.archive_dir, name)
+        archive_file = "{}{}".format(entry_path, ARCHIVE_COMPRESSED_EXTENSION)
+        temp_file = "{}.{}".format(archive_file, os.getpid())
+
+        with tarfile.open(temp_file, "w:gz") as archive:
+            archive.add(entry_path, arcname=name)
+        os.rename(temp_file, archive_file)
+        shutil.rmtree(entry_path)
+
+    def remove(self, name):
+
+        entry_path = os.path.join(self.archive_dir, name)
+        if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+            shutil.rmtree(entry_path)
+        else:
+            os.remove(entry_path)
+
+    def remove_unused_blobs(self):
+        """Removes the files from the blob store that are not linked to from any archive entry anymore.
+
+        Returns:
+            int: the number of removed files
+        """
+
+        removed = 0
+        for root, dirs, files in os.walk(self.blob_dir):
+            for name in files:
+                blob_path = os.path.join(root, name)
+                if os.lstat(blob_path).st_nlink <= 1:
+                    os.remove(blob_path)
+                    removed = removed + 1
+
+        return removed
+
+    def gc(self, keep=FRECKLES_DEFAULT_ARCHIVE_KEEP, max_age=FRECKLES_DEFAULT_ARCHIVE_MAX_AGE, compress_after=FRECKLES_DEFAULT_ARCHIVE_COMPRESS_AFTER, dedup=True):
+        """Applies the retention policy to the archive.
+
+        Entries are removed if they are not among the newest 'keep' ones, or older than 'max_age' seconds. Of the remaining ones, the ones older than 'compress_after' seconds are compressed, and the others are deduplicated (if 'dedup' is True). Finally, files in the blob store that aren't used anymore are removed.
+
+        Args:
+            keep (int): the number of entries to keep (None for no limit)
+            max_age (int): the number of seconds to keep entries (None for no limit)
+            compress_after (int): the number of seconds after which entries are compressed (None to never compress them)
+            dedup (bool): whether to deduplicate the uncompressed entries
+
+        Returns:
+            dict: the names of the removed ('removed') and compressed ('compressed') entries, the number of deduplicated files ('deduplicated') and the number of bytes that were reclaimed ('reclaimed')
+        """
+
+        usage_before = get_disk_usage(self.archive_dir, self.blob_dir)
+        result = {"removed": [], "compressed": [], "deduplicated": 0}
+
+        now = time.time()
+        last_entry = self.get_last_entry()
+        entries = self.get_entries()
+        for i, name in enumerate(entries):
+
+            if name == last_entry:
+                continue
+
+            age = now - self.get_entry_date(name)
+            if (keep is not None and i < len(entries) - keep) or (max_age is not None and age > max_age):
+                log.debug("Removing archive entry: {}".format(name))
+                self.remove(name)
+                result["removed"].append(name)
+            elif compress_after is not None and age > compress_after and not name.endswith(ARCHIVE_COMPRESSED_EXTENSION):
+                log.debug("Compressing archive entry: {}".format(name))
+                self.compress(name)
+                result["compressed"].append(name)
+
+        if dedup:
+            for name in self.get_entries():
+                entry_path = os.path.join(self.archive_dir, name)
+                if os.path.isdir(entry_path):
+                    result["deduplicated"] = result["deduplicated"] + self.dedup(entry_path)
+
+        self.remove_unused_blobs()
+        result["reclaimed"] = usage_before - get_disk_usage(self.archive_dir, self.blob_dir)
+
+        return result
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import copy
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime
+from exceptions import FrecklesConfigError
+
+import yaml
+
+from constants import *
+from role_cache import RoleCache
+from runners.ansible_runner import (FRECKLES_INTERNAL_ROLES_PATH,
+                                    extract_ansible_roles, report_role_status)
+
+from . import __version__ as VERSION
+
+log = logging.getLogger("freckles")
+
+BUNDLE_METADATA_FILE = "freckles_bundle.yml"
+BUNDLE_ROLES_DIR = "roles"
+
+BUNDLE_VERSION_KEY = "version"
+BUNDLE_CREATED_KEY = "created"
+BUNDLE_CONFIGS_KEY = "configs"
+BUNDLE_LEAFS_KEY = "leafs"
+BUNDLE_EXTERNAL_ROLES_KEY = "external_roles"
+
+
+def is_bundle(path):
+    """Returns whether the provided path is a bundle archive."""
+
+    if not isinstance(path, basestring) or not os.path.isfile(path) or not tarfile.is_tarfile(path):
+        return False
+
+    with tarfile.open(path) as archive:
+        try:
+            archive.getmember(BUNDLE_METADATA_FILE)
+        except KeyError:
+            return False
+
+    return True
+
+
+def is_inside(path, directory):
+    """Returns whether a path (after resolving all symlinks) is the provided directory, or inside of it."""
+
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def check_bundle_member(member, target_dir):
+    """Checks whether extracting a member of a bundle archive would write, or link, outside of the target directory.
+
+    Returns:
+        str: the reason the member is invalid, or None if it is valid
+    """
+
+    dest = os.path.join(target_dir, member.name)
+    if not is_inside(dest, target_dir):
+        return "path outside of the bundle"
+    # extracting a file through an existing symlink
+    if not is_inside(os.path.dirname(dest), target_dir):
+        return "parent directory outside of the bundle"
+    if member.issym() and not is_inside(os.path.join(os.path.dirname(dest), member.linkname), target_dir):
+        return "symlink to '{}' outside of the bundle".format(member.linkname)
+    if member.islnk() and not is_inside(os.path.join(target_dir, member.linkname), target_dir):
+        return "hard link to '{}' outside of the bundle".format(member.linkname)
+    if member.isdev():
+        return "device file"
+
+    return None
+
+
+def create_bundle(freckles, bundle_file):
+    """Creates a bundle archive out of the configs of a :class:`~freckles.freckles.Freckles` object.
+
+    The bundle contains the calculated (already rendered) leafs, all internal roles and all external roles the runs use, so it can be applied without network access. External roles are determined from the run items that are created on this machine, so the bundle should be created on the same kind of system it is applied on. They are copied from the role cache of the object (see :class:`~freckles.role_cache.RoleCache`), which downloads the ones that are missing.
+
+    Args:
+        freckles (Freckles): the object containing the leafs to bundle (the leafs need to be a list, not a stream)
+        bundle_file (str): the path of the archive to create
+
+    Returns:
+        dict: the external roles that were bundled
+    """
+
+    leafs = copy.deepcopy(freckles.leafs)
+
+    freckles.preprocess_configs()
+    external_roles = {}
+    for frecks in freckles.process_leafs():
+        external_roles.update(extract_ansible_roles(freckles.create_run_items(frecks)))
+
+    metadata = {
+        BUNDLE_VERSION_KEY: VERSION,
+        BUNDLE_CREATED_KEY: datetime.now().isoformat(),
+        BUNDLE_CONFIGS_KEY: list(freckles.configs),
+        BUNDLE_EXTERNAL_ROLES_KEY: external_roles,
+        BUNDLE_LEAFS_KEY: leafs
+    }
+
+    build_dir = tempfile.mkdtemp(prefix="freckles_bundle_")
+    try:
+        roles_dir = os.path.join(build_dir, BUNDLE_ROLES_DIR)
+        if external_roles:
+            role_cache = freckles.role_cache if freckles.role_cache is not None else RoleCache()
+            for role_name, role_path in role_cache.get_roles(external_roles, report=report_role_status).iteritems():
+                log.debug("Copying external role: {} -> {}".format(role_path, role_name))
+                shutil.copytree(role_path, os.path.join(roles_dir, "external", role_name), symlinks=True)
+            role_cache.log_stats()
+        shutil.copytree(FRECKLES_INTERNAL_ROLES_PATH, os.path.join(roles_dir, "internal"), symlinks=True)
+
+        with open(os.path.join(build_dir, BUNDLE_METADATA_FILE), 'w') as f:
+            f.write(yaml.safe_dump(metadata, default_flow_style=False))
+
+        with tarfile.open(bundle_file, "w:gz") as archive:
+            archive.add(os.path.join(build_dir, BUNDLE_METADATA_FILE), arcname=BUNDLE_METADATA_FILE)
+            archive.add(roles_dir, arcname=BUNDLE_ROLES_DIR)
+    finally:
+        shutil.rmtree(build_dir)
+
+    return external_roles
+
+
+class Bundle(object):
+    """An extracted bundle archive.
+
+    Use :meth:`extract` to create one, and :meth:`cleanup` to delete the extracted files once they are not needed anymore.
+
+    Args:
+        bundle_dir (str): the directory the bundle was extracted to
+
+    Attributes:
+        configs (list): the configs the bundle was created from
+        leafs (list): the pre-calculated leafs
+        roles_dir (str): the directory that contains the 'internal' and 'external' roles
+    """
+
+    def __init__(self, bundle_dir):
+
+        self.bundle_dir = bundle_dir
+        with open(os.path.join(bundle_dir, BUNDLE_METADATA_FILE)) as f:
+            metadata = yaml.safe_load(f)
+
+        if metadata.get(BUNDLE_VERSION_KEY, None) != VERSION:
+            log.warning("Bundle was created with a different version of freckles ({}), this might not work.".format(metadata.get(BUNDLE_VERSION_KEY, None)))
+
+        self.configs = metadata.get(BUNDLE_CONFIGS_KEY, [])
+        self.leafs = metadata[BUNDLE_LEAFS_KEY]
+        self.external_roles = metadata.get(BUNDLE_EXTERNAL_ROLES_KEY, {})
+        self.roles_dir = os.path.join(bundle_dir, BUNDLE_ROLES_DIR)
+
+    @staticmethod
+    def extract(bundle_file, target_dir=None):
+        """Extracts a bundle archive.
+
+        Args:
+            bundle_file (str): the path to the archive
+            target_dir (str): the directory to extract to (a temporary directory if not specified)
+
+        Returns:
+            Bundle: the extracted bundle
+        """
+
+        if target_dir is None:
+            target_dir = tempfile.mkdtemp(prefix="freckles_bundle_")
+
+        with tarfile.open(bundle_file) as archive:
+            members = archive.getmembers()
+            for member in members:
+                error = check_bundle_member(member, target_dir)
+                if error is not None:
+                    raise FrecklesConfigError("Invalid member '{}' in bundle '{}': {}".format(member.name, bundle_file, error), "bundle", bundle_file)
+            # checked again right before every member is extracted, since the links that were extracted before change where paths point to
+            for member in members:
+                error = check_bundle_member(member, target_dir)
+                if error is not None:
+                    raise FrecklesConfigError("Invalid member '{}' in bundle '{}': {}".format(member.name, bundle_file, error), "bundle", bundle_file)
+                archive.extract(member, target_dir)
+
+        return Bundle(target_dir)
+
+    def cleanup(self):
+
+        shutil.rmtree(self.bundle_dir, ignore_errors=True)
@@ -15,10 +15,16 @@ import yaml
 
 import click_log
 import py
+from archive import RunArchive
+from bundle import Bundle, create_bundle, is_bundle
+from config_cache import ConfigCache
 from constants import *
 from freckles import Freckles
-from frkl import Frkl
-from utils import CursorOff
+from frkl import ConfigRenderer, Frkl, set_renderer
+from leaf_cache import LeafCache
+from role_cache import RoleCache
+from state_db import StateDB
+from utils import CursorOff, UnaliasedDumper
 
 from . import __version__ as VERSION
 
@@ -37,6 +43,9 @@ class Config(object):
         config_dir (str): the directory containing freckles configuration
         config_file (str): the path to the config file
         config (dict): other config values
+        config_cache (ConfigCache): the cache for remote config files
+        leaf_cache (LeafCache): the cache for leafs calculated from configs (None if disabled)
+        role_cache (RoleCache): the cache for external roles
     """
 
     def __init__(self, *args, **kwargs):
@@ -48,6 +57,9 @@ class Config(object):
 
         self.config_file = py.path.local(self.config_dir).join(FRECKLES_DEFAULT_CONFIG_FILE_NAME)
         self.config = dict(*args, **kwargs)
+        self.config_cache = ConfigCache()
+        self.leaf_cache = None
+        self.role_cache = RoleCache()
 
     def load(self):
         """load yaml config from disk"""
@@ -84,8 +96,12 @@ pass_freckles_config = click.make_pass_decorator(Config, ensure=True)
 @click.pass_context
 @click_log.simple_verbosity_option()
 @click.option('--version', help='the version of freckles you are running', is_flag=True)
+@click.option('--offline', help='only use cached remote configs and external roles, never access the network to retrieve them', is_flag=True, default=False)
+@click.option('--cache-max-age', help='number of seconds a cached remote config or external role is used without checking whether it changed (default: 0, always check)', type=int, default=0)
+@click.option('--cache-templates', help='store compiled config templates on disk, and re-use them in later invocations', is_flag=True, default=False)
+@click.option('--no-leaf-cache', help='always re-calculate the configuration, even if none of the inputs changed since the last invocation', is_flag=True, default=False)
 @click_log.init("freckles")
-def cli(ctx, freckles_config, version):
+def cli(ctx, freckles_config, version, offline, cache_max_age, cache_templates, no_leaf_cache):
     """Freckles manages your dotfiles (and other aspects of your local machine).
 
     The base options here are forwarded to all the sub-commands listed below. Not all of the sub-commands will use all of the options you can specify though.
@@ -98,6 +114,12 @@ def cli(ctx, freckles_config, version):
         sys.exit(0)
 
     freckles_config.load()
+    freckles_config.config_cache = ConfigCache(max_age=cache_max_age, offline=offline)
+    freckles_config.role_cache = RoleCache(max_age=cache_max_age, offline=offline)
+    if cache_templates:
+        set_renderer(ConfigRenderer(bytecode_cache_dir=FRECKLES_DEFAULT_TEMPLATE_CACHE_DIR))
+    if not no_leaf_cache:
+        freckles_config.leaf_cache = LeafCache(config_cache=freckles_config.config_cache)
     augment_config(freckles_config)
 
     # if ctx.invoked_subcommand is None:
@@ -112,22 +134,91 @@ def augment_config(freckles_config):
 @cli.command("apply")
 @click.option('--details', help='whether to print details of the results of the  operations that are executed, or not', default=False, is_flag=True)
 @click.option('--debug', help='print debug information for each freck', default=False, is_flag=True)
+@click.option('--stream', help='process configs while the runs are prepared, instead of all of them up front (errors in later configs are only found once they are reached)', default=False, is_flag=True)
+@click.option('--jobs', '-j', help='the number of worker processes to prepare the runs with (default: 1)', default=1, type=click.IntRange(min=1))
+@click.option('--run-jobs', help='the number of independent branches of a run to execute at the same time (default: 1, runs are executed as a whole)', default=1, type=click.IntRange(min=1))
+@click.option('--incremental', '-i', help='skip items that were applied successfully before and did not change since (without this option, all items are applied)', default=False, is_flag=True)
+@click.option('--incremental-max-age', help='number of seconds after which unchanged items are applied again anyway, in incremental mode (default: 1 day)', default=FRECKLES_DEFAULT_STATE_DB_MAX_AGE, type=click.IntRange(min=0))
+@click.option('--workdir', help='the directory to prepare and execute runs in, for example on a tmpfs like /dev/shm (default: ~/.freckles/runs), finished runs are moved to the archive', default=None, type=click.Path(file_okay=False))
+@click.option('--compress-logs', help='compress the logs of runs (with gzip) once they are finished', default=False, is_flag=True)
+@click.option('--role-jobs', help='the number of external roles to download at the same time (default: {})'.format(FRECKLES_DEFAULT_ROLE_DOWNLOAD_JOBS), default=FRECKLES_DEFAULT_ROLE_DOWNLOAD_JOBS, type=click.IntRange(min=1))
 # @click.option('--only-prepare', '-p', required=False, default=False, help='Only prepare the run(s), don\'t kick them off', is_flag=True)
 @click.argument('config', required=False, nargs=-1)
 @pass_freckles_config
-def run(freckles_config, details, config, debug):
+def run(freckles_config, details, config, debug, stream, jobs, run_jobs, incremental, incremental_max_age, workdir, compress_logs, role_jobs):
     """Executes one or multiple runs.
 
     A config can either be a local yaml file, a url to a remote yaml file, or a json string.
 
     Configurations are overlayed in the order they are provided. Read more about configuration files and format by visiting XXX``).
+
+    Instead of configs, a single bundle (created with the ``bundle`` command) can be provided, which doesn't need network access.
+    """
+
+    bundle = None
+    if len(config) == 1 and is_bundle(config[0]):
+        bundle = Bundle.extract(config[0])
+
+    # outcomes are always recorded, so a full run makes the next incremental one skip everything it applied
+    state_db = StateDB(max_age=incremental_max_age)
+    freckles_config.role_cache.jobs = role_jobs
+
+    try:
+        if bundle is not None:
+            freckles = Freckles(bundle=bundle, jobs=jobs, run_jobs=run_jobs, state_db=state_db, incremental=incremental, compress_logs=compress_logs, workdir=workdir)
+        else:
+            freckles = Freckles(*config, config_cache=freckles_config.config_cache, leaf_cache=freckles_config.leaf_cache, stream=stream, jobs=jobs, run_jobs=run_jobs, state_db=state_db, incremental=incremental, compress_logs=compress_logs, workdir=workdir, role_cache=freckles_config.role_cache)
+        freckles.set_debug(debug)
+        freckles.preprocess_configs()
+        with CursorOff():
+            freckles.run(details)
+    finally:
+        if bundle is not None:
+            bundle.cleanup()
+
+
+@cli.command("bundle")
+@click.option('--output', '-o', help='the file to write the bundle to', default="freckles_bundle.tar.gz", type=click.Path(dir_okay=False, writable=True))
+@click.option('--jobs', '-j', help='the number of worker processes to prepare the runs with (default: 1)', default=1, type=click.IntRange(min=1))
+@click.argument('config', required=False, nargs=-1)
+@pass_freckles_config
+def bundle(freckles_config, output, config, jobs):
+    """Creates a bundle that can be applied without network access.
+
+    All configs are downloaded and rendered, and the resulting list of tasks is written into an archive, together with all the roles that are needed to execute them. Apply the bundle with ``freckles apply <bundle_file>``.
+
+    Roles are selected for the system this command runs on, so the bundle should be created on the same kind of system it will be applied on.
+    """
+
+    freckles = Freckles(*config, config_cache=freckles_config.config_cache, leaf_cache=freckles_config.leaf_cache, jobs=jobs, role_cache=freckles_config.role_cache)
+    external_roles = create_bundle(freckles, output)
+
+    click.echo("Bundle created (including {} external role(s)): {}".format(len(external_roles), output))
+
+
+@cli.group("archive")
+def archive():
+    """Manages the archive of finished runs (in ~/.freckles/runs/archive)."""
+
+    pass
+
+
+@archive.command("gc")
+@click.option('--keep', help='the number of invocations of \'apply\' to keep the runs of (default: {})'.format(FRECKLES_DEFAULT_ARCHIVE_KEEP), default=FRECKLES_DEFAULT_ARCHIVE_KEEP, type=click.IntRange(min=0))
+@click.option('--max-age', help='number of days to keep runs (default: {})'.format(FRECKLES_DEFAULT_ARCHIVE_MAX_AGE // (24 * 60 * 60)), default=FRECKLES_DEFAULT_ARCHIVE_MAX_AGE // (24 * 60 * 60), type=click.IntRange(min=0))
+@click.option('--compress-after', help='number of days after which runs are compressed (default: {})'.format(FRECKLES_DEFAULT_ARCHIVE_COMPRESS_AFTER // (24 * 60 * 60)), default=FRECKLES_DEFAULT_ARCHIVE_COMPRESS_AFTER // (24 * 60 * 60), type=click.IntRange(min=0))
+@click.option('--no-dedup', help='don\'t replace identical files of different runs with hard links to a single copy', default=False, is_flag=True)
+def archive_gc(keep, max_age, compress_after, no_dedup):
+    """Removes, compresses and deduplicates archived runs.
+
+    Runs are removed if they are older than the configured maximum age, or not among the ones of the last invocations of ``apply`` that are kept. Of the remaining ones, the older ones are compressed. The last run is always kept uncompressed.
     """
 
-    freckles = Freckles(*config)
-    freckles.set_debug(debug)
-    freckles.preprocess_configs()
-    with CursorOff():
-        freckles.run(details)
+    day = 24 * 60 * 60
+    result = RunArchive().gc(keep=keep, max_age=max_age * day, compress_after=compress_after * day, dedup=not no_dedup)
+
+    click.echo("Removed {} archived invocation(s), compressed {}, deduplicated {} file(s)".format(len(result["removed"]), len(result["compressed"]), result["deduplicated"]))
+    click.echo("Reclaimed: {:.1f} MB".format(result["reclaimed"] / (1024.0 * 1024.0)))
 
 
 @cli.command("print-config")
@@ -139,10 +230,10 @@ def print_config(freckles_config, config):
 
        The output to this command could be piped into a yaml file, and then used with the ``run`` command. Although, in practice that doesn't make much sense of course. """
 
-    freckles = Freckles(*config)
+    freckles = Freckles(*config, config_cache=freckles_config.config_cache, leaf_cache=freckles_config.leaf_cache)
     leafs = freckles.leafs
 
-    print(yaml.dump(leafs, default_flow_style=False))
+    print(yaml.dump(leafs, Dumper=UnaliasedDumper, default_flow_style=False))
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from exceptions import FrecklesConfigError
+
+import requests
+
+from constants import *
+
+log = logging.getLogger("freckles")
+
+CACHE_URL_KEY = "url"
+CACHE_ETAG_KEY = "etag"
+CACHE_LAST_MODIFIED_KEY = "last_modified"
+CACHE_FETCHED_KEY = "fetched"
+CACHE_CONTENT_KEY = "content"
+
+
+class ConfigCache(object):
+    """On-disk cache for remote config files.
+
+    Every downloaded config is stored (together with its ``ETag`` and ``Last-Modified`` headers) in a json file in the cache directory, keyed by the expanded url. Subsequent requests for the same url are conditional GETs, so unchanged configs are not transferred again.
+
+    Args:
+        cache_dir (str): the directory to store cached configs in
+        max_age (int): number of seconds a cached config is used without revalidating it (0 means always revalidate)
+        offline (bool): never access the network, only use cached configs
+
+    Attributes:
+        hits (int): number of configs that were served from the cache (including successful revalidations)
+        misses (int): number of configs that had to be downloaded
+    """
+
+    def __init__(self, cache_dir=FRECKLES_DEFAULT_CONFIG_CACHE_DIR, max_age=0, offline=False):
+
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.offline = offline
+
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_cache_file(self, url):
+
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.cache_dir, "{}.json".format(hashlib.sha1(url).hexdigest()))
+
+    def load(self, url):
+        """Returns the cache entry for the provided url, or None if there is none."""
+
+        cache_file = self.get_cache_file(url)
+        if not os.path.exists(cache_file):
+            return None
+
+        try:
+            with open(cache_file) as f:
+                entry = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Ignoring invalid config cache entry '{}': {}".format(cache_file, e))
+            return None
+
+        if entry.get(CACHE_URL_KEY, None) != url:
+            return None
+
+        return entry
+
+    def store(self, url, content, etag=None, last_modified=None):
+
+        entry = {
+            CACHE_URL_KEY: url,
+            CACHE_ETAG_KEY: etag,
+            CACHE_LAST_MODIFIED_KEY: last_modified,
+            CACHE_FETCHED_KEY: time.time(),
+            CACHE_CONTENT_KEY: content
+        }
+
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            cache_file = self.get_cache_file(url)
+            temp_file = "{}.{}.{}".format(cache_file, os.getpid(), threading.current_thread().ident)
+            with open(temp_file, 'w') as f:
+                json.dump(entry, f)
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError) as e:
+            log.debug("Could not write config cache entry for '{}': {}".format(url, e))
+
+        return entry
+
+    def count(self, hit):
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, url, session, verify_ssl=True, timeout=None):
+        """Returns the content of a remote config, using the cached version if it is still valid.
+
+        Args:
+            url (str): the (expanded) url of the config
+            session (requests.Session): the session to use for downloading
+            verify_ssl (bool): whether to verify ssl certificates
+            timeout (tuple): (connect, read) timeout
+
+        Returns:
+            str: the content of the config
+        """
+
+        entry = self.load(url)
+
+        if entry is not None:
+            age = time.time() - entry.get(CACHE_FETCHED_KEY, 0)
+            if self.offline or age < self.max_age:
+                log.debug("Using cached config (age: {}s): {}".format(int(age), url))
+                self.count(True)
+                return entry[CACHE_CONTENT_KEY]
+        elif self.offline:
+            raise FrecklesConfigError("Can't load config '{}': not cached, and running in offline mode.".format(url), 'config', url)
+
+        headers = {}
+        if entry is not None:
+            if entry.get(CACHE_ETAG_KEY, None):
+                headers["If-None-Match"] = entry[CACHE_ETAG_KEY]
+            if entry.get(CACHE_LAST_MODIFIED_KEY, None):
+                headers["If-Modified-Since"] = entry[CACHE_LAST_MODIFIED_KEY]
+
+        # the cached version is only used if the server can't be reached, not if it answers with an error (e.g. because the config was removed)
+        try:
+            r = session.get(url, headers=headers, verify=verify_ssl, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if entry is not None:
+                log.warning("Can't revalidate config '{}', using cached version: {}".format(url, e))
+                self.count(True)
+                return entry[CACHE_CONTENT_KEY]
+            raise FrecklesConfigError("Can't download config '{}': {}".format(url, e), 'config', url)
+        except requests.exceptions.RequestException as e:
+            raise FrecklesConfigError("Can't download config '{}': {}".format(url, e), 'config', url)
+
+        if r.status_code == 304 and entry is not None:
+            log.debug("Cached config still valid: {}".format(url))
+            self.store(url, entry[CACHE_CONTENT_KEY], entry.get(CACHE_ETAG_KEY, None), entry.get(CACHE_LAST_MODIFIED_KEY, None))
+            self.count(True)
+            return entry[CACHE_CONTENT_KEY]
+
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            raise FrecklesConfigError("Can't download config '{}': {}".format(url, e), 'config', url)
+
+        self.count(False)
+        content = r.text
+        self.store(url, content, r.headers.get("ETag", None), r.headers.get("Last-Modified", None))
+        return content
+
+    def log_stats(self):
+
+        log.debug("Config cache: {} hit(s), {} miss(es)".format(self.hits, self.misses))
@@ -24,7 +24,31 @@ FRECKLES_DEFAULT_LAST_EXECUTION_DIR_NAME = "last"
 FRECKLES_DEFAULT_LAST_EXECUTION_DIR = os.path.join(FRECKLES_DEFAULT_EXECUTION_BASE_DIR, FRECKLES_DEFAULT_LAST_EXECUTION_DIR_NAME)
 FRECKLES_DEFAULT_EXECUTION_ARCHIVE_DIR_NAME = "archive"
 FRECKLES_DEFAULT_EXECUTION_ARCHIVE_DIR = os.path.join(FRECKLES_DEFAULT_EXECUTION_BASE_DIR, FRECKLES_DEFAULT_EXECUTION_ARCHIVE_DIR_NAME)
+FRECKLES_ARCHIVE_DATE_FORMAT = '%y%m%d_%H_%M_%S'
+FRECKLES_DEFAULT_ARCHIVE_BLOB_DIR = os.path.join(FRECKLES_DEFAULT_EXECUTION_BASE_DIR, "blobs")
+FRECKLES_DEFAULT_ARCHIVE_KEEP = 20
+FRECKLES_DEFAULT_ARCHIVE_MAX_AGE = 30 * 24 * 60 * 60
+FRECKLES_DEFAULT_ARCHIVE_COMPRESS_AFTER = 7 * 24 * 60 * 60
 FRECKLES_DEFAULT_EXECUTION_LOGS_DIR = os.path.join(FRECKLES_DEFAULT_EXECUTION_BASE_DIR, FRECKLES_DEFAULT_EXECUTION_DIR_NAME, "logs")
+FRECKLES_RUN_LOG_FILE_NAME = "run_log.jsonl"
+FRECKLES_DEFAULT_RUN_LOG_BUFFER_SIZE = 64 * 1024
+FRECKLES_DEFAULT_RUN_LOG_FLUSH_INTERVAL = 5
+# the number of characters of stderr and messages kept in memory per task, the rest is only in the run log
+FRECKLES_DEFAULT_TASK_OUTPUT_MAX_SIZE = 16 * 1024
+FRECKLES_DEFAULT_CACHE_DIR = os.path.join(FRECKLES_DEFAULT_DIR, "cache")
+FRECKLES_DEFAULT_CONFIG_CACHE_DIR = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "configs")
+FRECKLES_DEFAULT_TEMPLATE_CACHE_DIR = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "templates")
+FRECKLES_DEFAULT_LEAF_CACHE_DIR = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "leafs")
+FRECKLES_DEFAULT_PLUGIN_INDEX_FILE = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "plugins.json")
+FRECKLES_DEFAULT_HOST_FACTS_FILE = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "host_facts.json")
+FRECKLES_DEFAULT_ENVIRONMENT_CACHE_DIR = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "environments")
+# can be pointed to a directory that is shared between users
+FRECKLES_DEFAULT_ROLE_CACHE_DIR = os.environ.get("FRECKLES_ROLE_CACHE_DIR", os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "roles"))
+FRECKLES_DEFAULT_ROLE_DOWNLOAD_JOBS = 4
+FRECKLES_DEFAULT_INTERNAL_ROLE_CACHE_DIR = os.path.join(FRECKLES_DEFAULT_CACHE_DIR, "internal_roles")
+FRECKLES_DEFAULT_HOST_FACTS_MAX_AGE = 24 * 60 * 60
+FRECKLES_DEFAULT_STATE_DB_FILE = os.path.join(FRECKLES_DEFAULT_DIR, "state.json")
+FRECKLES_DEFAULT_STATE_DB_MAX_AGE = 24 * 60 * 60
 FRECKLES_DEFAULT_ARCHIVE_PLAYS = False
 FRECK_DEFAULT_SUDO = False
 
@@ -64,12 +88,17 @@ FRECK_NAME_KEY = "freck_name"
 FRECK_CONFIGS_KEY = "freck_configs"
 FRECK_ID_KEY = "freck_id"
 FRECK_ITEM_NAME_KEY = "freck_item_name"
+FRECK_BATCH_ITEMS_KEY = "freck_batch_items"
 FRECK_PREPROCESS_KEY = "freck_preprocess"
 FRECK_TASK_DESC = "freck_task_desc"
 FRECK_NEW_RUN_AFTER_THIS_KEY = "new_run_after"
 FRECK_SUDO_KEY = "become"
 FRECK_BECOME_KEY = "freck_become"
 UNIQUE_TASK_ID_KEY = "unique_task_id"
+FRECK_DEPENDS_ON_KEY = "depends_on"
+FRECK_RESOURCES_KEY = "resources"
+FRECK_REMOTE_STATE_KEY = "remote_state"
+FRECK_CHANGES_HOST_FACTS_KEY = "changes_host_facts"
 
 FRECK_PRIORITY_KEY = "priority"
 
@@ -22,6 +22,9 @@ class FrecklesRunError(ClickException):
         ClickException.__init__(self, message)
         self.run = run
 
+    def __reduce__(self):
+        return (FrecklesRunError, (self.message, self.run))
+
 
 class FrecklesConfigError(ClickException):
     """An Error signaling a configuration issue.
@@ -37,3 +40,6 @@ class FrecklesConfigError(ClickException):
         ClickException.__init__(self, message)
         self.config_key = config_key
         self.config_value = config_value
+
+    def __reduce__(self):
+        return (FrecklesConfigError, (self.message, self.config_key, self.config_value))
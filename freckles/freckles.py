@@ -2,32 +2,43 @@
 
 import abc
 import copy
-import errno
 import glob
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import pickle
 import pprint
 import shutil
+import signal
 import sys
+import threading
+import traceback
 import urllib2
 import uuid
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import datetime
 from exceptions import FrecklesConfigError, FrecklesRunError
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 
 import click
 import six
 import yaml
 
+from archive import RunArchive
 from constants import *
 from freckles_runner import FrecklesRunner
 from frkl import FRKL_META_LEVEL_KEY, LEAF_DICT, Frkl, expand_config_url
-from runners.ansible_runner import AnsibleRunner
+from host_facts import get_host_facts
+from planner import create_run_plan, get_item_dependencies, resources_conflict
+from run_log import RunLogWriter
+from runners.ansible_runner import FRECK_META_ROLES_KEY, AnsibleRunner
 from sets import Set
-from utils import (CursorOff, check_schema, dict_merge, get_pkg_mgr_from_path,
-                   load_extensions)
+from utils import (CursorOff, LayeredDict, can_passwordless_sudo, check_schema,
+                   get_pkg_mgr_from_path, load_extensions, merge_dicts,
+                   playbook_needs_sudo)
 from voluptuous import ALLOW_EXTRA, Any, Required, Schema
 
 log = logging.getLogger("freckles")
@@ -68,8 +79,21 @@ class Freck(object):
     """Base class for freckles plugins ("Frecks"). Used to create run items and handle the output in order to display meaningful messages to the user.
 
     The only method that needs to be overwritten is the 'create_run_items' one. It is recommended to overwrite most of the others too.
+
+    Which tasks a freck is used for (if the task name is not the name of the freck itself) should preferrably be declared with the 'DISPATCH_*' attributes, which can be indexed (see :class:`FreckDispatcher`). Only frecks that need to look at more than the task name and the keys of the 'roles' dict should overwrite 'can_be_used_for'.
+
+    Attributes:
+        DISPATCH_TASK_NAMES (frozenset): names of tasks (other than the name of the freck) this freck is used for
+        DISPATCH_ROLES_KEY (bool): whether this freck is used for tasks whose name is a key in the 'roles' dict of the freck meta
+        DISPATCH_FALLBACK (bool): whether this freck is used for all tasks no other freck can be used for
+        DISPATCH_MUTABLE_META (bool): whether an overwritten 'can_be_used_for' method needs a (deep) copy of the freck meta it can change, instead of a read-only view
     """
 
+    DISPATCH_TASK_NAMES = frozenset()
+    DISPATCH_ROLES_KEY = False
+    DISPATCH_FALLBACK = False
+    DISPATCH_MUTABLE_META = False
+
     def __init__(self):
         pass
 
@@ -112,13 +136,7 @@ class Freck(object):
             dict: the merged config vars
         """
 
-        freck_vars = {}
-        for config in freck_configs:
-            dict_merge(freck_vars, config)
-
-        freck_config = copy.deepcopy(FRECK_DEFAULT_CONFIG)
-        dict_merge(freck_config, copy.deepcopy(self.default_freck_config()))
-        dict_merge(freck_config, copy.deepcopy(freck_vars))
+        freck_config = merge_dicts(FRECK_DEFAULT_CONFIG, self.default_freck_config(), *freck_configs)
 
         if develop:
             click.echo("===============================================")
@@ -146,7 +164,13 @@ class Freck(object):
             bool: whether this freck handles this config item or not
         """
 
-        return False
+        task_name = freck_meta.get(TASK_NAME_KEY, None)
+        if task_name in self.DISPATCH_TASK_NAMES:
+            return True
+        if self.DISPATCH_ROLES_KEY and task_name in (freck_meta.get(FRECK_META_ROLES_KEY, None) or {}):
+            return True
+
+        return self.DISPATCH_FALLBACK
 
     @abc.abstractmethod
     def create_run_item(self, freck_meta, develop=False):
@@ -165,23 +189,261 @@ class Freck(object):
         """
         pass
 
+    def get_resources(self, freck_meta):
+        """Returns the resource classes (for example a package manager lock, or a directory) the run item of this freck needs exclusive access to.
+
+        This is used to find the items of a run that can be executed concurrently (see :func:`planner.create_run_plan`). The default uses the 'resources' key of the freck meta, if it exists.
+
+        Args:
+            freck_meta (dict): the meta_information about a freck
+
+        Returns:
+            list: a list of resource class names, or None if the item could use any resource (which means it is never executed concurrently with other items)
+        """
+        return freck_meta.get(FRECK_RESOURCES_KEY, None)
+
+    def get_dependencies(self, freck_meta):
+        """Returns the unique task ids of the items that have to be executed before the run item of this freck, if they are part of the same run.
+
+        The default uses the 'depends_on' key of the freck meta, if it exists.
+
+        Args:
+            freck_meta (dict): the meta_information about a freck
+
+        Returns:
+            list: a list of unique task ids
+        """
+        depends_on = freck_meta.get(FRECK_DEPENDS_ON_KEY, [])
+        if isinstance(depends_on, basestring):
+            depends_on = [depends_on]
+        return depends_on
+
+    def has_remote_state(self, freck_meta):
+        """Returns whether the desired state of the run item of this freck depends on something outside of its configuration (for example the latest commit of a git repository).
+
+        Such items are never skipped in incremental runs (see :meth:`Freckles.filter_unchanged_items`), since their hash doesn't change if the remote state does. The default uses the 'remote_state' key of the freck meta, if it exists.
+
+        Args:
+            freck_meta (dict): the meta_information about a freck
+
+        Returns:
+            bool: whether the item depends on remote state
+        """
+        return freck_meta.get(FRECK_REMOTE_STATE_KEY, False)
+
+    def changes_host_facts(self, freck_meta):
+        """Returns whether the run item of this freck changes the facts about the machine (see :class:`~freckles.host_facts.HostFacts`), for example because it installs a package manager.
+
+        The facts are probed again after a run that contains such an item. The default uses the 'changes_host_facts' key of the freck meta, if it exists.
+
+        Args:
+            freck_meta (dict): the meta_information about a freck
+
+        Returns:
+            bool: whether the item changes the host facts
+        """
+        return freck_meta.get(FRECK_CHANGES_HOST_FACTS_KEY, False)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class BatchableFreck(object):
+    """Mixin for frecks whose run items can be merged with the ones of other frecks of the same type (see :meth:`Freckles.batch_frecks`)."""
+
+    @abc.abstractmethod
+    def get_batch_key(self, freck_meta):
+        """Returns a key that is the same for all frecks of this type that can be executed together, in a single task (for example packages that are installed with the same package manager and options).
+
+        Frecks with the same key are merged with :meth:`merge_batch`, unless they are separated by a freck that conflicts with them (see :meth:`Freckles.batch_frecks`).
+
+        Args:
+            freck_meta (dict): the meta_information about a freck
+
+        Returns:
+            object: a hashable key, or None if this freck can't be batched
+        """
+        pass
+
+    @abc.abstractmethod
+    def merge_batch(self, freck_metas):
+        """Merges the meta information of frecks with the same batch key into the one of a single freck, which the run item is created from.
+
+        The result should contain a list of the item names of all merged frecks under the 'freck_batch_items' key, those are reported separately to the user.
+
+        Args:
+            freck_metas (list): the meta information of all frecks to merge, in the order they would be executed
+
+        Returns:
+            dict: the merged meta information
+        """
+        pass
+
+    def get_batch_item_id(self, freck_meta):
+        """Returns what a batchable freck does within its batch (for example the name of the package it installs).
+
+        Frecks with the same batch key and item id are only executed once per run. The default returns None, which means no frecks are ignored.
+
+        Args:
+            freck_meta (dict): the meta_information about a freck
+
+        Returns:
+            object: a hashable id, or None
+        """
+        return None
+
+
+class FreckDispatcher(object):
+    """Finds the freck to use for a freck meta dict.
+
+    Frecks are tried in this order: the freck with the same name as the task, frecks that declare the task name in 'DISPATCH_TASK_NAMES', frecks with 'DISPATCH_ROLES_KEY' set (if the task name is a key in the 'roles' dict), frecks that overwrite 'can_be_used_for' and, lastly, frecks with 'DISPATCH_FALLBACK' set.
+
+    The index of the declared predicates is only created (which means all frecks are loaded) once a task needs it. Results are cached per task name and set of 'roles' keys, only frecks that overwrite 'can_be_used_for' are asked every time.
+
+    Args:
+        frecks (Mapping): the available frecks, with their names as keys
+    """
+
+    def __init__(self, frecks):
+
+        self.frecks = frecks
+        self.index = None
+        self.cache = {}
+
+    def create_index(self):
+
+        index = {"task_names": {}, "roles_key": [], "dynamic": [], "fallback": []}
+
+        for freck_name, freck in self.frecks.iteritems():
+            for task_name in freck.DISPATCH_TASK_NAMES:
+                index["task_names"].setdefault(task_name, freck_name)
+            if freck.DISPATCH_ROLES_KEY:
+                index["roles_key"].append(freck_name)
+            if type(freck).can_be_used_for.__func__ is not Freck.can_be_used_for.__func__:
+                index["dynamic"].append(freck_name)
+            if freck.DISPATCH_FALLBACK:
+                index["fallback"].append(freck_name)
+
+        return index
+
+    def get_freck_name(self, freck_meta):
+        """Returns the name of the freck to use for the provided freck meta dict, or False if there is none."""
+
+        task_name = freck_meta[TASK_NAME_KEY]
+        if task_name in self.frecks:
+            return task_name
+
+        if self.index is None:
+            self.index = self.create_index()
+
+        roles = freck_meta.get(FRECK_META_ROLES_KEY, None) or {}
+        signature = (task_name, frozenset(roles))
+        if signature not in self.cache:
+            freck_name = self.index["task_names"].get(task_name, None)
+            if freck_name is None and self.index["roles_key"] and task_name in roles:
+                freck_name = self.index["roles_key"][0]
+            self.cache[signature] = freck_name
+
+        freck_name = self.cache[signature]
+        if freck_name is not None:
+            return freck_name
+
+        for freck_name in self.index["dynamic"]:
+            freck = self.frecks[freck_name]
+            meta = copy.deepcopy(freck_meta) if freck.DISPATCH_MUTABLE_META else LayeredDict(freck_meta)
+            if freck.can_be_used_for(meta):
+                return freck_name
+
+        if self.index["fallback"]:
+            return self.index["fallback"][0]
+
+        return False
+
+
+
+class TaskResultSummary(object):
+    """The summary of the results ansible reports for a task, updated with every result so the results themselves don't have to be kept in memory.
+
+    Only the first 'max_output_size' characters of stderr and messages are kept, the full results are in the run log.
+
+    Args:
+        ignored_strings (list): results of ansible tasks whose names contain one of these strings never count as a change
+        max_output_size (int): the number of characters of output to keep
+    """
+
+    def __init__(self, ignored_strings=[TASK_IGNORE_STRING], max_output_size=FRECKLES_DEFAULT_TASK_OUTPUT_MAX_SIZE):
+
+        self.ignored_strings = ignored_strings
+        self.max_output_size = max_output_size
+
+        self.skipped = True
+        self.changed = False
+        self.failed = False
+        self.stderr = []
+        self.msg = []
+        self.output_size = 0
+        self.truncated = False
+
+    def add_output(self, target, output):
+
+        if isinstance(output, basestring):
+            remaining = self.max_output_size - self.output_size
+            if len(output) > remaining:
+                self.truncated = True
+                if remaining <= 0:
+                    return
+                output = output[:remaining]
+            self.output_size = self.output_size + len(output)
+
+        target.append(output)
+
+    def add(self, details):
+        """Adds a result (as reported by the freckles ansible callback plugin) to the summary."""
+
+        task_name = details[TASK_NAME_KEY]
+        ignore_changed = False
+        for ignored_string in self.ignored_strings:
+            if ignored_string in task_name:
+                log.debug("Ignoring detail for task: {}".format(task_name))
+                ignore_changed = True
+                break
+
+        ignore_errors = details["ignore_errors"] is True
+
+        if details[FRECKLES_STATE_KEY] != FRECKLES_STATE_SKIPPED:
+            self.skipped = False
+
+            if not ignore_errors and details[FRECKLES_STATE_KEY] == FRECKLES_STATE_FAILED:
+                self.failed = True
+            if not ignore_changed and details["result"].get(FRECKLES_CHANGED_KEY, False):
+                self.changed = True
+            if details["result"].get("stderr", False):
+                self.add_output(self.stderr, details["result"]["stderr"])
+            if details["result"].get("msg", False):
+                self.add_output(self.msg, details["result"]["msg"])
 
 
 class FrecklesRunCallback(object):
 
-    def __init__(self, run_nr, frecks, items, details=False):
+    def __init__(self, run_nr, frecks, items, details=False, nr_tasks=None, log_dir=FRECKLES_DEFAULT_EXECUTION_LOGS_DIR, task_states=None, compress_log=False, archive_log_dir=None):
         self.frecks = frecks
         self.items = {}
         for item in items:
             self.items[item[FRECK_ID_KEY]] = item
+        # the number of tasks of the whole run, which is more than the number of items if only a branch of it is executed
+        self.nr_tasks = nr_tasks if nr_tasks is not None else len(self.items)
+        # a summary of the results of every task (see TaskResultSummary), by freck id
         self.task_result = {}
         self.total_tasks = -1
         self.current_freck_id = -1
         self.detailed_output = details
         self.success = True
 
-        self.log_file = os.path.join(FRECKLES_DEFAULT_EXECUTION_LOGS_DIR, "run_log")
-
+        self.log_dir = log_dir
+        self.log_file = os.path.join(self.log_dir, FRECKLES_RUN_LOG_FILE_NAME)
+        self.run_log = RunLogWriter(self.log_file, run_nr=run_nr, compress=compress_log)
+        # the directory the logs are moved to once the run is finished
+        self.archive_log_dir = archive_log_dir if archive_log_dir else log_dir
+        # the resulting state of every completed task, by freck id (shared by all branches of a run)
+        self.task_states = task_states
 
     def set_total_tasks(self, total):
         self.total_tasks = total
@@ -190,16 +452,7 @@ class FrecklesRunCallback(object):
 
     def log(self, freck_id, details):
 
-        try:
-            os.makedirs(FRECKLES_DEFAULT_EXECUTION_LOGS_DIR)
-        except OSError as exc:  # Python >2.5
-            if exc.errno == errno.EEXIST and os.path.isdir(FRECKLES_DEFAULT_EXECUTION_LOGS_DIR):
-                pass
-            else:
-                raise
-        with open(self.log_file, "a+") as myfile:
-            myfile.write("{}\n".format(details))
-
+        self.run_log.write(freck_id, details)
 
         #log.debug("Details for freck '{}': {}".format(freck_id, details))
         if details == RUN_STARTED:
@@ -218,7 +471,9 @@ class FrecklesRunCallback(object):
             log.debug("No task associated to reported freck_id '{}': {}".format(freck_id, details))
             return
 
-        self.task_result.setdefault(freck_id, []).append(details)
+        if freck_id not in self.task_result.keys():
+            self.task_result[freck_id] = TaskResultSummary()
+        self.task_result[freck_id].add(details)
 
         if self.current_freck_id != freck_id:
             if self.current_freck_id > 0:
@@ -232,7 +487,16 @@ class FrecklesRunCallback(object):
 
         else:
             if self.detailed_output:
-                click.echo("\n  . {}".format(self.get_summary_string_from_detaila(details)), nl=False)
+                self.echo("\n  . {}".format(self.get_summary_string_from_detaila(details)), nl=False)
+
+    def echo(self, message, nl=True):
+
+        click.echo(message, nl=nl)
+
+    def close(self):
+        """Writes out the rest of the run log, has to be called once the run is finished (also if it failed)."""
+
+        self.run_log.close()
 
 
     def get_summary_string_from_detaila(self, details):
@@ -252,49 +516,24 @@ class FrecklesRunCallback(object):
 
         Args:
             task (dict): the task details
-            output_details (list): all the information that was recorded during the execution of that task (list of dicts)
+            output_details (TaskResultSummary): a summary of all the information that was recorded during the execution of that task
 
         Result:
             dict: information about whether the task succeeded, or not, and also other details
         """
 
-        skipped = True
-        changed = False
-        failed = False
-        stderr = []
+        skipped = output_details.skipped
+        changed = output_details.changed
+        failed = output_details.failed
+        stderr = list(output_details.stderr)
         stdout = []
-        msg = []
+        msg = list(output_details.msg)
+        if output_details.truncated:
+            archived_log_file = os.path.join(self.archive_log_dir, os.path.basename(self.run_log.final_log_file))
+            msg.append("[output truncated, the full results are the events with freck_id {} in the run log: {}]".format(task[FRECK_ID_KEY], archived_log_file))
 
         result = {}
 
-        freck = self.frecks[task[FRECK_NAME_KEY]]
-        ignored_strings = [TASK_IGNORE_STRING]
-
-        for details in output_details:
-
-            task_name = details[TASK_NAME_KEY]
-            ignore_changed = False
-            for ignored_string in ignored_strings:
-                if ignored_string in task_name:
-                    log.debug("Ignoring detail for task: {}".format(task_name))
-                    ignore_changed = True
-                    break
-
-            ignore_errors = details["ignore_errors"] is True
-
-            if details[FRECKLES_STATE_KEY] != FRECKLES_STATE_SKIPPED:
-                skipped = False
-
-                if not ignore_errors and details[FRECKLES_STATE_KEY] == FRECKLES_STATE_FAILED:
-                    failed = True
-                if not ignore_changed and details["result"].get(FRECKLES_CHANGED_KEY, False):
-                    changed = True
-                if details["result"].get("stderr", False):
-                    stderr.append(details["result"]["stderr"])
-                if details["result"].get("msg", False):
-                    msg.append(details["result"]["msg"])
-
-
         if skipped:
             result[FRECKLES_STATE_KEY] = FRECKLES_STATE_SKIPPED
         else:
@@ -321,7 +560,7 @@ class FrecklesRunCallback(object):
 
         Args:
             task_item (dict): details about the task that was executed
-            output_details (dict): output as created by ansible
+            output_details (TaskResultSummary): a summary of the output created by ansible
 
         Returns:
             dict: sanitized dictionary that freckles know how to display
@@ -340,12 +579,15 @@ class FrecklesRunCallback(object):
         item_name = task_item[FRECK_ITEM_NAME_KEY]
         task_desc = task_item[FRECK_DESC_KEY]
 
-        task_title = "- task {:02d}/{:02d}: {}  - '{}'".format(freckles_id, len(self.items), task_desc, item_name)
+        if FRECK_BATCH_ITEMS_KEY in task_item.keys():
+            task_title = "- task {:02d}/{:02d}: {}  - {} items".format(freckles_id, self.nr_tasks, task_desc, len(task_item[FRECK_BATCH_ITEMS_KEY]))
+        else:
+            task_title = "- task {:02d}/{:02d}: {}  - '{}'".format(freckles_id, self.nr_tasks, task_desc, item_name)
         nl = False
         if log.getEffectiveLevel() < 20:
             nl = True
 
-        click.echo(task_title, nl=nl)
+        self.echo(task_title, nl=nl)
 
 
     def log_freck_complete(self, freckles_id):
@@ -356,15 +598,24 @@ class FrecklesRunCallback(object):
         if freckles_id not in self.task_result.keys():
             log.debug("Unreckognized task_id for: {}".format(freckles_id))
             return
-        output_details = self.task_result[freckles_id]
+        # the summary is not needed anymore once the task is complete
+        output_details = self.task_result.pop(freckles_id)
 
         output = self.handle_task_output(task_item, output_details)
 
         log.debug("Result of task: {}".format(output))
 
         state_string = output[FRECKLES_STATE_KEY]
-
-        click.echo("\t=> {}".format(state_string))
+        if self.task_states is not None:
+            self.task_states[freckles_id] = state_string
+
+        # batched items are executed in a single task, there is no separate result for each of them
+        if FRECK_BATCH_ITEMS_KEY in task_item.keys():
+            self.echo("\t=> {} (result of the single task for all items)".format(state_string))
+            for batch_item_name in task_item[FRECK_BATCH_ITEMS_KEY]:
+                self.echo("    - '{}'".format(batch_item_name))
+        else:
+            self.echo("\t=> {}".format(state_string))
 
         if  state_string != FRECKLES_STATE_FAILED:
             return True
@@ -390,19 +641,212 @@ class FrecklesRunCallback(object):
 
         return not failed
 
+
+class BranchRunCallback(FrecklesRunCallback):
+    """Callback for a branch of a run that is executed concurrently with other branches.
+
+    The output of a task is only printed once the task is complete, all at once, so the output of different branches doesn't get mixed up.
+
+    Args:
+        output_lock (threading.Lock): the lock shared by all branches of a run, held while printing
+    """
+
+    def __init__(self, run_nr, frecks, items, output_lock, **kwargs):
+
+        super(BranchRunCallback, self).__init__(run_nr, frecks, items, **kwargs)
+        self.output_lock = output_lock
+        self.output = []
+
+    def echo(self, message, nl=True):
+
+        self.output.append(message)
+        if nl:
+            self.output.append("\n")
+
+    def log_freck_complete(self, freckles_id):
+
+        result = super(BranchRunCallback, self).log_freck_complete(freckles_id)
+
+        with self.output_lock:
+            click.echo("".join(self.output), nl=False)
+        self.output = []
+
+        return result
+
+
+def run_branch(runner_obj):
+    """Executes a branch of a run (in a worker thread).
+
+    Returns:
+        tuple: the exception if the branch couldn't be executed (or None), and whether it succeeded
+    """
+
+    try:
+        return (None, runner_obj.run())
+    except Exception as e:
+        log.debug("Error executing branch: {}".format(e), exc_info=True)
+        return (e, False)
+
+
+LEAF_WORKER_FRECKS = None
+
+
+def init_leaf_worker():
+    """Initializes a worker process of a :class:`LeafProcessor` pool."""
+
+    global LEAF_WORKER_FRECKS
+
+    # interrupts are handled (and the pool is terminated) by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    LEAF_WORKER_FRECKS = load_extensions()
+
+
+def process_leaf_worker(leaf, supported_runners):
+    """Processes a leaf in a worker process.
+
+    Exceptions (and exits) are returned instead of raised, because a worker that exits, or an exception that can't be unpickled, would block the pool. Tracebacks can't be pickled, so the formatted traceback is returned with the exception.
+
+    Returns:
+        tuple: a tuple (exception, traceback, result), either the first two or the last one are None
+    """
+
+    try:
+        freck = LEAF_WORKER_FRECKS[leaf[FRECK_META_KEY][FRECK_NAME_KEY]]
+        return (None, None, freck.process_leaf(leaf, supported_runners, False))
+    except (Exception, SystemExit) as e:
+        worker_traceback = traceback.format_exc()
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            e = Exception("{}: {}".format(type(e).__name__, e))
+        return (e, worker_traceback, None)
+
+
+class LeafProcessor(object):
+    """Processes leafs with the frecks they are assigned to.
+
+    With more than one job, leafs are processed ahead in a pool of worker processes, and the results are returned in the same order as the leafs. Processing a leaf can depend on the runs before it (e.g. a dotfile repository that was checked out), so :meth:`discard_pending` needs to be called after a run was executed, which re-processes all leafs that were processed ahead.
+
+    Args:
+        frecks (Mapping): the available frecks, with their names as keys
+        leafs (iterable): the (preprocessed) leafs
+        supported_runners (list): the runners that are supported on this system
+        jobs (int): the number of worker processes to use, leafs are processed in this process if 1
+        debug (bool): whether to print debug information for each freck (this always processes in this process)
+    """
+
+    def __init__(self, frecks, leafs, supported_runners, jobs=1, debug=False):
+
+        self.frecks = frecks
+        self.leafs = leafs
+        self.supported_runners = supported_runners
+        self.jobs = 1 if debug else max(1, jobs)
+        self.debug = debug
+        self.pending = deque()
+        self.pool = None
+
+    def __iter__(self):
+        """Yields (freck_nr, leaf, runner, processed) tuples, for every leaf that has freck meta."""
+
+        leafs = ((freck_nr, leaf) for freck_nr, leaf in enumerate(self.leafs) if FRECK_META_KEY in leaf.keys())
+
+        if self.jobs == 1:
+            for freck_nr, leaf in leafs:
+                freck = self.frecks[leaf[FRECK_META_KEY][FRECK_NAME_KEY]]
+                runner, processed = freck.process_leaf(copy.deepcopy(leaf), self.supported_runners, self.debug)
+                yield (freck_nr, leaf, runner, processed)
+            return
+
+        self.pool = multiprocessing.Pool(self.jobs, init_leaf_worker)
+        try:
+            while True:
+                while len(self.pending) < self.jobs * 2:
+                    try:
+                        freck_nr, leaf = next(leafs)
+                    except StopIteration:
+                        break
+                    self.pending.append((freck_nr, leaf, self.submit(leaf)))
+
+                if not self.pending:
+                    break
+
+                freck_nr, leaf, result = self.pending.popleft()
+                error, worker_traceback, value = result.get()
+                if error is not None:
+                    log.debug("Error processing leaf in worker process:\n{}".format(worker_traceback))
+                    error.worker_traceback = worker_traceback
+                    raise error
+                runner, processed = value
+                yield (freck_nr, leaf, runner, processed)
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, leaf):
+
+        return self.pool.apply_async(process_leaf_worker, (leaf, self.supported_runners))
+
+    def discard_pending(self):
+        """Discards the results of all leafs that were processed ahead, and processes them again."""
+
+        if self.pool is not None:
+            self.pending = deque((freck_nr, leaf, self.submit(leaf)) for freck_nr, leaf, _ in self.pending)
+
+
 class Freckles(object):
     """The central class in this project. This calculates the items to execute out of the default values and overlayed user provided configuration.
 
     TODO: more doc
+
+    Args:
+        *config_items: the configs to overlay, in order
+        config_cache (ConfigCache): optional keyword argument, the cache to use for remote configs
+        leaf_cache (LeafCache): optional keyword argument, the cache to use for the calculated leafs
+        stream (bool): optional keyword argument, whether to calculate the leafs while they are processed, instead of all up front (cached leafs are still used, but new ones are not stored)
+        bundle (Bundle): optional keyword argument, an (extracted) bundle to use the pre-calculated leafs and roles of, instead of processing configs
+        jobs (int): optional keyword argument, the number of worker processes to process leafs with (default: 1)
+        run_jobs (int): optional keyword argument, the number of independent branches of a run to execute concurrently (default: 1, which executes every run as a whole)
+        state_db (StateDB): optional keyword argument, the database to record the outcome of executed items in
+        incremental (bool): optional keyword argument, whether to skip items that are unchanged since their last successful execution, according to 'state_db'
+        compress_logs (bool): optional keyword argument, whether to compress the log of a run (with gzip) once it's finished
+        archive (RunArchive): optional keyword argument, the archive the directories of finished runs are moved to
+        workdir (str): optional keyword argument, the directory to create and execute runs in, for example on a tmpfs (default: ~/.freckles/runs)
+        role_cache (RoleCache): optional keyword argument, the cache to link external roles from, or copy them into a bundle from (not used when applying bundles, which contain their roles)
     """
 
-    def __init__(self, *config_items):
+    def __init__(self, *config_items, **kwargs):
 
         self.freck_plugins = load_extensions()
+        self.dispatcher = FreckDispatcher(self.freck_plugins)
         self.supported_runners = [FRECKLES_DEFAULT_RUNNER]
         self.configs = config_items
-        frkl = Frkl(self.configs, FRECK_TASKS_KEY, [FRECK_VARS_KEY, FRECK_META_KEY], FRECK_META_KEY, TASK_NAME_KEY, FRECK_VARS_KEY, DEFAULT_DOTFILE_REPO_NAME, FRECKLES_DEFAULT_FRECKLES_BOOTSTRAP_CONFIG_PATH, add_leaf_dicts=True)
-        self.leafs = frkl.leafs
+        self.config_cache = kwargs.get("config_cache", None)
+        self.leaf_cache = kwargs.get("leaf_cache", None)
+        self.stream = kwargs.get("stream", False)
+        self.bundle = kwargs.get("bundle", None)
+        self.jobs = kwargs.get("jobs", 1)
+        self.run_jobs = kwargs.get("run_jobs", 1)
+        self.state_db = kwargs.get("state_db", None)
+        self.incremental = kwargs.get("incremental", False)
+        self.compress_logs = kwargs.get("compress_logs", False)
+        self.archive = kwargs.get("archive", RunArchive())
+        self.role_cache = kwargs.get("role_cache", None)
+        # absolute, since the runner changes the working directory
+        self.execution_base_dir = os.path.abspath(os.path.expanduser(kwargs.get("workdir", None) or FRECKLES_DEFAULT_EXECUTION_BASE_DIR))
+
+        self.leafs = None
+        if self.bundle is not None:
+            self.configs = self.bundle.configs
+            self.leafs = copy.deepcopy(self.bundle.leafs)
+        elif self.leaf_cache is not None:
+            self.leafs = self.leaf_cache.load(self.configs)
+
+        if self.leafs is None:
+            frkl = Frkl(self.configs, FRECK_TASKS_KEY, [FRECK_VARS_KEY, FRECK_META_KEY], FRECK_META_KEY, TASK_NAME_KEY, FRECK_VARS_KEY, DEFAULT_DOTFILE_REPO_NAME, FRECKLES_DEFAULT_FRECKLES_BOOTSTRAP_CONFIG_PATH, add_leaf_dicts=True, cache=self.config_cache, stream=self.stream)
+            self.leafs = frkl.leafs
+            if self.leaf_cache is not None and not self.stream:
+                self.leaf_cache.store(self.configs, frkl.get_dependencies(), self.leafs)
         self.debug_freck = False
 
 
@@ -411,38 +855,38 @@ class Freckles(object):
 
 
     def preprocess_configs(self):
+        """Finds the freck to use for every leaf.
 
-        for leaf in self.leafs:
-            check_schema(leaf, FRECKLES_INPUT_CONFIG_SCHEMA)
-            if FRECK_META_KEY not in leaf.keys():
-                continue
-            if leaf[FRECK_META_KEY][TASK_NAME_KEY] in self.freck_plugins.keys():
-                leaf[FRECK_META_KEY][FRECK_NAME_KEY] = leaf[FRECK_META_KEY][TASK_NAME_KEY]
-                continue
+        If the leafs are streamed, this only wraps them, and every leaf is preprocessed once it is consumed.
+        """
 
-            freck_to_use = False
-            for freck_name, freck in self.freck_plugins.iteritems():
-                if freck.can_be_used_for(copy.deepcopy(leaf[FRECK_META_KEY])):
-                    freck_to_use = freck_name
-                    break
+        if isinstance(self.leafs, list):
+            for leaf in self.leafs:
+                self.preprocess_leaf(leaf)
+        else:
+            self.leafs = itertools.imap(self.preprocess_leaf, self.leafs)
+
+    def preprocess_leaf(self, leaf):
 
-            if not freck_to_use:
-                raise FrecklesConfigError("Can't find freck that can execute task with name '{}' (full config: {})".format(leaf[FRECK_META_KEY][TASK_NAME_KEY], leaf[FRECK_META_KEY]), FRECK_META_KEY, leaf[FRECK_META_KEY])
+        check_schema(leaf, FRECKLES_INPUT_CONFIG_SCHEMA)
+        if FRECK_META_KEY not in leaf.keys():
+            return leaf
 
-            leaf[FRECK_META_KEY][FRECK_NAME_KEY] = freck_to_use
+        freck_to_use = self.dispatcher.get_freck_name(leaf[FRECK_META_KEY])
+        if not freck_to_use:
+            raise FrecklesConfigError("Can't find freck that can execute task with name '{}' (full config: {})".format(leaf[FRECK_META_KEY][TASK_NAME_KEY], leaf[FRECK_META_KEY]), FRECK_META_KEY, leaf[FRECK_META_KEY])
+
+        leaf[FRECK_META_KEY][FRECK_NAME_KEY] = freck_to_use
+        return leaf
 
 
     def process_leafs(self):
 
         frecks = []
-        for freck_nr, leaf in enumerate(self.leafs):
-            if FRECK_META_KEY not in leaf.keys():
-                continue
+        processor = LeafProcessor(self.freck_plugins, self.leafs, self.supported_runners, jobs=self.jobs, debug=self.debug_freck)
+        for freck_nr, leaf, runner, processed in processor:
             freck_name = leaf[FRECK_META_KEY][FRECK_NAME_KEY]
 
-            runner, processed = self.freck_plugins[freck_name].process_leaf(copy.deepcopy(leaf), self.supported_runners, self.debug_freck)
-
-
             if not processed:
                 log.debug("No frecks created for freck_name '{}'.".format(freck_name))
                 continue
@@ -461,13 +905,7 @@ class Freckles(object):
                 processed = [processed]
 
             # apply result on top of original configuration
-            temp = []
-            for p in processed:
-                t = copy.deepcopy(leaf[FRECK_META_KEY])
-                dict_merge(t, p)
-                temp.append(t)
-
-            processed = temp
+            processed = [merge_dicts(leaf[FRECK_META_KEY], p) for p in processed]
 
             new_run = False
             for prep in processed:
@@ -496,6 +934,7 @@ class Freckles(object):
                         run_frecks = []
 
                 frecks = run_frecks
+                processor.discard_pending()
 
         yield self.sort_frecks(frecks)
 
@@ -513,11 +952,110 @@ class Freckles(object):
         return sorted_result
 
 
+    def batch_frecks(self, frecks):
+        """Merges frecks that can be executed together (see :meth:`BatchableFreck.get_batch_key`).
+
+        Frecks are merged at the position of the first of them. A batch is closed (later frecks with the same key start a new one) at a freck that conflicts with it, so it is never moved across such a freck: a freck that doesn't declare its resources, one that uses a resource that conflicts with one of the batch (see :func:`planner.resources_conflict`), or one that provides a task the batch depends on. Frecks with the same batch key and item id (see :meth:`BatchableFreck.get_batch_item_id`) are only kept the first time in a run.
+        """
+
+        result = []
+        batches = {}
+        batch_item_ids = set()
+        unique_ids = set()
+        for freck in frecks:
+            freck_plugin = self.freck_plugins[freck[FRECK_NAME_KEY]]
+            key = freck_plugin.get_batch_key(freck) if isinstance(freck_plugin, BatchableFreck) else None
+            if key is None:
+                unique_id = freck.get(UNIQUE_TASK_ID_KEY, None)
+                # tasks that are already in the run are ignored when the run items are created
+                if unique_id not in unique_ids:
+                    if unique_id is not None:
+                        unique_ids.add(unique_id)
+                    resources = freck_plugin.get_resources(freck)
+                    for batch_key, batch in batches.items():
+                        if resources is None or unique_id in batch["depends_on"] or any(resources_conflict(resource, used) for resource in resources for used in batch["resources"]):
+                            del batches[batch_key]
+                result.append(freck)
+                continue
+
+            key = (freck[FRECK_NAME_KEY], key)
+            item_id = freck_plugin.get_batch_item_id(freck)
+            if item_id is not None:
+                if (key, item_id) in batch_item_ids:
+                    log.debug("Item '{}' is already executed in this run, ignoring it.".format(freck.get(FRECK_ITEM_NAME_KEY, item_id)))
+                    continue
+                batch_item_ids.add((key, item_id))
+
+            if key not in batches:
+                batches[key] = {"frecks": [], "resources": set(), "depends_on": set()}
+                result.append(batches[key]["frecks"])
+            batches[key]["frecks"].append(freck)
+            batches[key]["resources"].update(freck_plugin.get_resources(freck) or [])
+            batches[key]["depends_on"].update(freck_plugin.get_dependencies(freck))
+
+        frecks = []
+        for freck in result:
+            if not isinstance(freck, list):
+                frecks.append(freck)
+            elif len(freck) == 1:
+                frecks.append(freck[0])
+            else:
+                frecks.append(self.freck_plugins[freck[0][FRECK_NAME_KEY]].merge_batch(freck))
+
+        return frecks
+
+    def create_run_items(self, frecks):
+        """Creates the run items for all frecks of a run, and assigns their ids."""
+
+        items = []
+        i = 1
+        unique_ids = []
+        for freck in self.batch_frecks(frecks):
+
+            freck_plugin = self.freck_plugins[freck[FRECK_NAME_KEY]]
+
+            run_item = freck_plugin.create_run_item(copy.deepcopy(freck), self.debug_freck)
+            if not isinstance(run_item, dict):
+                raise Exception("Freck plugin returned non-dict value as run_item")
+
+            if UNIQUE_TASK_ID_KEY in run_item.keys() and run_item[UNIQUE_TASK_ID_KEY] in unique_ids:
+                log.debug("Already got a task with id '{}', ignoring this one.".format(run_item[UNIQUE_TASK_ID_KEY]))
+                continue
+            elif UNIQUE_TASK_ID_KEY in run_item.keys():
+                unique_ids.append(run_item[UNIQUE_TASK_ID_KEY])
+
+
+            if FRECK_BATCH_ITEMS_KEY in freck.keys():
+                run_item[FRECK_BATCH_ITEMS_KEY] = freck[FRECK_BATCH_ITEMS_KEY]
+
+            # used to plan concurrent execution
+            resources = freck_plugin.get_resources(freck)
+            if resources is not None:
+                run_item[FRECK_RESOURCES_KEY] = list(resources)
+            depends_on = freck_plugin.get_dependencies(freck)
+            if depends_on:
+                run_item[FRECK_DEPENDS_ON_KEY] = list(depends_on)
+            if freck_plugin.has_remote_state(freck):
+                run_item[FRECK_REMOTE_STATE_KEY] = True
+            if freck_plugin.changes_host_facts(freck):
+                run_item[FRECK_CHANGES_HOST_FACTS_KEY] = True
+            if freck.get(UNIQUE_TASK_ID_KEY, False):
+                run_item.setdefault(UNIQUE_TASK_ID_KEY, freck[UNIQUE_TASK_ID_KEY])
+
+            # make sure the id didn't change, everything else can be different
+            run_item[FRECK_ID_KEY] = i
+            run_item.setdefault(FRECK_SUDO_KEY, FRECK_DEFAULT_SUDO)
+            run_item.setdefault(FRECK_VARS_KEY, {})
+            items.append(run_item)
+            i = i + 1
+
+        return items
+
     def run(self, details=False):
 
         start_date = datetime.now()
-        date_string = start_date.strftime('%y%m%d_%H_%M_%S')
-        archive_dirname = os.path.join(FRECKLES_DEFAULT_EXECUTION_ARCHIVE_DIR, date_string)
+        date_string = start_date.strftime(FRECKLES_ARCHIVE_DATE_FORMAT)
+        archive_dirname = os.path.join(self.archive.archive_dir, date_string)
         os.makedirs(archive_dirname)
 
         for run_nr, frecks in enumerate(self.process_leafs(), start=1):
@@ -537,46 +1075,146 @@ class Freckles(object):
                 raise FrecklesConfigError("Can't find runner with name: {}".format(runner_name))
 
             log.debug("Using runner: {}".format(runner_name))
-            items = []
-            i = 1
-            unique_ids = []
-            for freck in frecks:
-
-                freck_plugin = self.freck_plugins[freck[FRECK_NAME_KEY]]
-
-                run_item = freck_plugin.create_run_item(copy.deepcopy(freck), self.debug_freck)
-                if not isinstance(run_item, dict):
-                    raise Exception("Freck plugin returned non-dict value as run_item")
+            items = self.create_run_items(frecks)
+            dest_dir = os.path.join(archive_dirname, "run_{}".format(run_nr))
 
-                if UNIQUE_TASK_ID_KEY in run_item.keys() and run_item[UNIQUE_TASK_ID_KEY] in unique_ids:
-                    log.debug("Already got a task with id '{}', ignoring this one.".format(run_item[UNIQUE_TASK_ID_KEY]))
+            # hashes have to be calculated before the items are given to a runner, which changes them
+            item_hashes = None
+            task_states = None
+            if self.state_db is not None:
+                items, item_hashes = self.filter_unchanged_items(run_nr, items)
+                if not items:
+                    click.echo("Nothing to do in run #{}, all items are unchanged".format(run_nr))
                     continue
-                elif UNIQUE_TASK_ID_KEY in run_item.keys():
-                    unique_ids.append(run_item[UNIQUE_TASK_ID_KEY])
-
-
-                # make sure the id didn't change, everything else can be different
-                run_item[FRECK_ID_KEY] = i
-                run_item.setdefault(FRECK_SUDO_KEY, FRECK_DEFAULT_SUDO)
-                run_item.setdefault(FRECK_VARS_KEY, {})
-                items.append(run_item)
-                i = i + 1
-
-            callback = FrecklesRunCallback(run_nr, self.freck_plugins, items, details)
-            runner_obj = runner_class(items, callback)
+                task_states = {}
+
+            stages = self.plan_run(items)
+            if len(stages) == 1 and len(stages[0]) == 1:
+                log_dir = os.path.join(self.execution_base_dir, FRECKLES_DEFAULT_EXECUTION_DIR_NAME, "logs")
+                callback = FrecklesRunCallback(run_nr, self.freck_plugins, items, details, log_dir=log_dir, task_states=task_states, compress_log=self.compress_logs, archive_log_dir=os.path.join(dest_dir, "logs"))
+                roles_dir = self.bundle.roles_dir if self.bundle is not None else None
+                runner_obj = runner_class(items, callback, roles_dir=roles_dir, execution_base_dir=self.execution_base_dir, role_cache=self.role_cache)
+
+                click.echo("Starting run #{}".format(run_nr))
+                try:
+                    success = runner_obj.run()
+                finally:
+                    callback.close()
+                click.echo("Run #{} finished: {}".format(run_nr, ("success" if success else "failed")))
+
+                log.debug("Moving run directory to archive: {}".format(dest_dir))
+                shutil.move(runner_obj.execution_dir, dest_dir)
+            else:
+                click.echo("Starting run #{} ({} stages, {} branches)".format(run_nr, len(stages), sum(len(branches) for branches in stages)))
+                success = self.run_stages(run_nr, runner_class, items, stages, dest_dir, details, task_states)
+                click.echo("Run #{} finished: {}".format(run_nr, ("success" if success else "failed")))
 
-            click.echo("Starting run #{}".format(run_nr))
-            success = runner_obj.run()
-            click.echo("Run #{} finished: {}".format(run_nr, ("success" if success else "failed")))
+            if any(item.get(FRECK_CHANGES_HOST_FACTS_KEY, False) for item in items):
+                log.debug("Run #{} changed the host facts, probing them again when they are needed".format(run_nr))
+                get_host_facts().invalidate()
 
-            dest_dir = os.path.join(archive_dirname, "run_{}".format(run_nr))
-            log.debug("Moving run directory to archive: {}".format(dest_dir))
-            shutil.move(FRECKLES_DEFAULT_EXECUTION_DIR, dest_dir)
+            if self.state_db is not None:
+                for freck_id, state in task_states.iteritems():
+                    self.state_db.record(item_hashes[freck_id], state)
+                self.state_db.store()
 
             if os.path.exists(FRECKLES_DEFAULT_LAST_EXECUTION_DIR):
                 os.unlink(FRECKLES_DEFAULT_LAST_EXECUTION_DIR)
             log.debug("Creating archive directory to last run convenience link")
             os.symlink(dest_dir, FRECKLES_DEFAULT_LAST_EXECUTION_DIR)
+            # most of the files of a run (roles, playbooks) are the same as in earlier runs
+            self.archive.dedup(dest_dir)
             if not success:
                 click.echo("\nRun failed, exiting...")
                 sys.exit(1)
+
+    def filter_unchanged_items(self, run_nr, items):
+        """Calculates the hashes of the desired state of the items of a run, and removes the unchanged ones if this is an incremental run.
+
+        Items are unchanged if they were executed successfully with the same hash less than 'max_age' seconds ago (see :class:`state_db.StateDB`). Items that depend on remote state (like a git checkout) are never unchanged, and neither are items that depend on an item that is executed, either by its unique task id or by a shared resource (see :func:`planner.get_item_dependencies`). The remaining items get new, consecutive ids.
+
+        Returns:
+            tuple: the items to execute, and their hashes by (new) freck id
+        """
+
+        hashed_items = [(item, self.state_db.get_item_hash(item)) for item in items]
+        if self.incremental:
+            dependencies = get_item_dependencies(items)
+            execute = []
+            for i, (item, item_hash) in enumerate(hashed_items):
+                execute.append(item.get(FRECK_REMOTE_STATE_KEY, False) or not self.state_db.is_unchanged(item_hash) or any(execute[j] for j in dependencies[i]))
+            hashed_items = [hashed_item for hashed_item, execute_item in zip(hashed_items, execute) if execute_item]
+            nr_skipped = len(items) - len(hashed_items)
+            if nr_skipped:
+                click.echo("Skipping {} unchanged item(s) of run #{}".format(nr_skipped, run_nr))
+
+        item_hashes = {}
+        for i, (item, item_hash) in enumerate(hashed_items, start=1):
+            item[FRECK_ID_KEY] = i
+            item_hashes[i] = item_hash
+
+        return ([item for item, item_hash in hashed_items], item_hashes)
+
+    def plan_run(self, items):
+        """Splits the items of a run into stages, and those into branches that can be executed concurrently (see :func:`planner.create_run_plan`).
+
+        Unless 'run_jobs' is bigger than 1, this returns a single stage with a single branch that contains all items. The same happens if some of the items need sudo, and sudo needs a password (which can't be asked for by multiple branches at the same time).
+        """
+
+        if self.run_jobs < 2:
+            return [[items]]
+
+        if playbook_needs_sudo(items) and not can_passwordless_sudo():
+            log.info("Run needs a sudo password, not executing branches concurrently.")
+            return [[items]]
+
+        return create_run_plan(items)
+
+    def run_stages(self, run_nr, runner_class, items, stages, dest_dir, details=False, task_states=None):
+        """Executes the stages of a run one after the other, and the branches of each stage concurrently (at most 'run_jobs' at the same time).
+
+        Every branch is executed by its own runner, in its own execution directory, which is moved to 'dest_dir' once the branch is finished. Stages after a failed one are not executed.
+
+        Returns:
+            bool: whether all branches succeeded
+        """
+
+        os.makedirs(dest_dir)
+        roles_dir = self.bundle.roles_dir if self.bundle is not None else None
+        output_lock = threading.Lock()
+
+        branch_nr = 0
+        for stage_nr, branches in enumerate(stages, start=1):
+
+            # runners are created one after the other, since creating the execution environment changes the working directory
+            runners = []
+            for branch in branches:
+                branch_nr = branch_nr + 1
+                execution_dir_name = "{}_{}".format(FRECKLES_DEFAULT_EXECUTION_DIR_NAME, branch_nr)
+                log_dir = os.path.join(self.execution_base_dir, execution_dir_name, "logs")
+                archive_log_dir = os.path.join(dest_dir, "branch_{}".format(branch_nr), "logs")
+                callback = BranchRunCallback(run_nr, self.freck_plugins, branch, output_lock, details=details, nr_tasks=len(items), log_dir=log_dir, task_states=task_states, compress_log=self.compress_logs, archive_log_dir=archive_log_dir)
+                runners.append((branch_nr, runner_class(branch, callback, roles_dir=roles_dir, execution_dir_name=execution_dir_name, execution_base_dir=self.execution_base_dir, role_cache=self.role_cache), callback))
+
+            log.debug("Executing stage {}/{} of run #{}: {} branches".format(stage_nr, len(stages), run_nr, len(runners)))
+            pool = ThreadPool(min(self.run_jobs, len(runners)))
+            try:
+                results = pool.map(run_branch, [runner_obj for nr, runner_obj, callback in runners])
+            finally:
+                pool.close()
+                pool.join()
+                for nr, runner_obj, callback in runners:
+                    callback.close()
+
+            for nr, runner_obj, callback in runners:
+                branch_dest_dir = os.path.join(dest_dir, "branch_{}".format(nr))
+                log.debug("Moving branch directory to archive: {}".format(branch_dest_dir))
+                shutil.move(runner_obj.execution_dir, branch_dest_dir)
+
+            for error, branch_success in results:
+                if error is not None:
+                    raise error
+            if not all(branch_success for error, branch_success in results):
+                return False
+
+        return True
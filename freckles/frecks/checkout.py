@@ -8,6 +8,7 @@ import sys
 from freckles import Freck
 from freckles.constants import *
 from freckles.exceptions import FrecklesConfigError
+from freckles.planner import get_dir_resource
 from freckles.runners.ansible_runner import (FRECK_META_ROLE_KEY,
                                              FRECK_META_ROLES_KEY,
                                              TASK_FREE_FORM_KEY,
@@ -45,6 +46,10 @@ class CheckoutGitRepo(AbstractRole):
 
         return "{}_{}_{}".format(CheckoutGitRepo.UNIQUE_TASK_ID_PREFIX, freck_meta[FRECK_VARS_KEY][REPO_KEY], freck_meta[FRECK_VARS_KEY][TARGET_KEY])
 
+    def get_resources(self, freck_meta):
+
+        return [get_dir_resource(freck_meta[FRECK_VARS_KEY][TARGET_KEY])]
+
     def get_role(self, freck_meta):
         return "git_sync_repo"
 
@@ -57,6 +62,9 @@ class CheckoutGitRepo(AbstractRole):
     def get_sudo(self, freck_meta):
         return False
 
+    def has_remote_state(self, freck_meta):
+        return True
+
     def get_additional_roles(self, freck_meta):
         return {"git_sync_repo": "frkl:ansible-git-sync-repo"}
 
@@ -97,6 +105,8 @@ class CheckoutDotfiles(AbstractTask):
             meta_new[TASK_NAME_KEY] = "git"
             meta_new[TASK_TEMPLATE_KEYS] = GIT_VALID_KEYS
             meta_new[FRECK_NEW_RUN_AFTER_THIS_KEY] = True
+            meta_new[FRECK_RESOURCES_KEY] = [get_dir_resource(base_dir)]
+            meta_new[FRECK_REMOTE_STATE_KEY] = True
             result.append(meta_new)
 
         return (FRECKLES_ANSIBLE_RUNNER, result)
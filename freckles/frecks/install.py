@@ -7,19 +7,22 @@ import platform
 import pprint
 import sys
 
-from ansible.module_utils import basic
-from ansible.module_utils.facts import Distribution
-from freckles import Freck
+from freckles import BatchableFreck, Freck
 from freckles.constants import *
 from freckles.exceptions import FrecklesConfigError
 from freckles.frecks.checkout import GIT_VALID_KEYS
+from freckles.host_facts import (OS_FAMILY_KEY, PKG_MGRS_AVAILABLE_KEY,
+                                 get_host_facts)
+from freckles.planner import (RESOURCE_APT_LOCK, RESOURCE_CONDA,
+                              RESOURCE_HOMEBREW, RESOURCE_NIX_STORE,
+                              RESOURCE_YUM_LOCK, get_home_dir_resource)
 from freckles.runners.ansible_runner import (FRECK_META_ROLE_DICT_KEY,
                                              FRECK_META_ROLE_KEY,
                                              FRECK_META_ROLES_KEY)
-from freckles.utils import (create_apps_dict, create_dotfiles_dict, dict_merge,
-                            get_pkg_mgr_from_marker_file,
+from freckles.utils import (LayeredDict, create_apps_dict, create_dotfiles_dict,
+                            dict_merge, get_pkg_mgr_from_marker_file,
                             get_pkg_mgr_from_path, get_pkg_mgr_sudo,
-                            parse_dotfiles_item)
+                            merge_dicts, parse_dotfiles_item)
 from role import AbstractRole, Role
 from sets import Set
 from task import AbstractTask
@@ -34,6 +37,9 @@ DEFAULT_PKG_MGRS = {
     "Darwin": "homebrew"
 }
 
+# package managers that don't depend on the OS family, in order of preference, used if there is no default one for it
+FALLBACK_PKG_MGRS = ["nix", "conda", "homebrew"]
+
 ENSURE_PACKAGE_MANAGER_KEY = "ensure_pkg_manager"
 
 PKG_MGRS_COMMANDS = {
@@ -77,10 +83,21 @@ ADD_PKG_MGR_PATH_DEFAULT_WHEN_AUTO_INSTALL_PKG_MGR = False
 
 GIT_CONFIG_UPDATE_DEFAULT = True
 
+BATCH_INSTALL_KEY = "batch_install"
+BATCH_INSTALL_DEFAULT = True
+
 INSTALL_BREW_KEY = "install-brew"
 
 class AbstractPackageManager(object):
 
+    # whether packages can be installed with a single task, and if so whether their names are given to the module as a list (no separator) or as a string
+    BATCHABLE = False
+    BATCH_NAMES_SEPARATOR = None
+    # the resources tasks of this package manager need exclusive access to (see 'freckles.planner'), None if they could use any
+    RESOURCES = None
+    # the unique task id of the task that installs this package manager, if there is one
+    INSTALLER_TASK_ID = None
+
     def __init__(self, app_name, config):
         self.app_name = app_name
         self.config = config
@@ -99,12 +116,12 @@ class AbstractPackageManager(object):
 
         result = []
         for desc in self.create_task_descs():
-            meta_copy = copy.deepcopy(meta_base)
-            meta_copy[FRECK_SUDO_KEY] = self.get_task_become()
+            task_meta = LayeredDict(meta_base)
+            task_meta[FRECK_SUDO_KEY] = self.get_task_become()
             if self.get_extra_roles():
-                meta_copy[FRECK_META_ROLES_KEY] = self.get_extra_roles()
+                task_meta[FRECK_META_ROLES_KEY] = self.get_extra_roles()
 
-            dict_merge(meta_copy, desc)
+            meta_copy = merge_dicts(task_meta, desc)
             for key in self.config.keys():
                 if key in self.get_valid_keys():
                     meta_copy[FRECK_VARS_KEY][key] = self.config[key]
@@ -158,6 +175,9 @@ class SimplePackageManager(AbstractPackageManager):
 
 class AptPackageManager(SimplePackageManager):
 
+    BATCHABLE = True
+    RESOURCES = [RESOURCE_APT_LOCK]
+
     @staticmethod
     def get_alias():
         return 'apt'
@@ -191,6 +211,11 @@ class AptPackageManager(SimplePackageManager):
 
 class NixPackageManager(SimplePackageManager):
 
+    BATCHABLE = True
+    BATCH_NAMES_SEPARATOR = ","
+    RESOURCES = [RESOURCE_NIX_STORE]
+    INSTALLER_TASK_ID = "install_nix"
+
     @staticmethod
     def get_alias():
         return 'nix'
@@ -210,6 +235,9 @@ class NixPackageManager(SimplePackageManager):
 
 class YumPackageManager(SimplePackageManager):
 
+    BATCHABLE = True
+    RESOURCES = [RESOURCE_YUM_LOCK]
+
     @staticmethod
     def get_alias():
         return 'yum'
@@ -227,6 +255,11 @@ class YumPackageManager(SimplePackageManager):
 
 class CondaPackageManager(SimplePackageManager):
 
+    BATCHABLE = True
+    BATCH_NAMES_SEPARATOR = ","
+    RESOURCES = [RESOURCE_CONDA]
+    INSTALLER_TASK_ID = "install_conda"
+
     @staticmethod
     def get_alias():
         return 'conda'
@@ -246,6 +279,8 @@ class CondaPackageManager(SimplePackageManager):
 
 class PipPackageManager(SimplePackageManager):
 
+    BATCHABLE = True
+
     @staticmethod
     def get_alias():
         return 'pip'
@@ -274,6 +309,10 @@ class PipPackageManager(SimplePackageManager):
         return descs
 class HomeBrewPackageManager(SimplePackageManager):
 
+    BATCHABLE = True
+    RESOURCES = [RESOURCE_HOMEBREW]
+    INSTALLER_TASK_ID = "install_brew"
+
     @staticmethod
     def get_alias():
         return 'homebrew'
@@ -325,28 +364,55 @@ class GitPackageManager(AbstractPackageManager):
             meta[TASK_NAME_KEY] = 'git'
             meta[FRECK_VARS_KEY] = {'repo': self.repo, 'dest': self.dest}
             meta[FRECK_ITEM_NAME_KEY] = self.repo
+            meta[FRECK_REMOTE_STATE_KEY] = True
             descs.append(meta)
 
         return descs
 
 
 PKG_MGRS = [AptPackageManager, YumPackageManager, GitPackageManager, NixPackageManager, CondaPackageManager, GitPackageManager, PipPackageManager, HomeBrewPackageManager]
+BATCHABLE_PKG_MGRS = dict((mgr.get_alias(), mgr) for mgr in PKG_MGRS if mgr.BATCHABLE)
+PKG_MGR_CLASSES = dict((mgr.get_alias(), mgr) for mgr in PKG_MGRS)
+
+
+def add_pkg_mgr_resources(meta, pkg_mgr, depends_on_update=True):
+    """Adds the resources a task of a package manager uses, and the tasks it depends on, to its meta dict (see 'freckles.planner').
+
+    Tasks of package managers that don't declare their resources are left alone, which means they are never executed concurrently with other tasks.
+    """
+
+    pkg_mgr_cls = PKG_MGR_CLASSES.get(pkg_mgr, None)
+    if pkg_mgr_cls is None or pkg_mgr_cls.RESOURCES is None:
+        return
+
+    meta[FRECK_RESOURCES_KEY] = list(pkg_mgr_cls.RESOURCES)
+    depends_on = []
+    if pkg_mgr_cls.INSTALLER_TASK_ID:
+        depends_on.append(pkg_mgr_cls.INSTALLER_TASK_ID)
+    if depends_on_update:
+        depends_on.append("{}_{}".format(Update.UNIQUE_TASK_ID_PREFIX, pkg_mgr))
+    meta[FRECK_DEPENDS_ON_KEY] = depends_on
 
 
 def get_os_family():
 
-    basic._ANSIBLE_ARGS = '{"ANSIBLE_MODULE_ARGS": {}}'
-    module = basic.AnsibleModule({})
-    d = Distribution(module)
-    d.populate()
-    os_family = d.facts["os_family"]
-    return os_family
+    return get_host_facts().get(OS_FAMILY_KEY)
 
 def get_default_pkg_mgr():
+    """Returns the package manager to use if none is specified: the default one for the OS family, or the first of FALLBACK_PKG_MGRS that is available (or False if none is)."""
 
-    return DEFAULT_PKG_MGRS.get(get_os_family(), False)
+    pkg_mgr = DEFAULT_PKG_MGRS.get(get_os_family(), False)
+    if pkg_mgr:
+        return pkg_mgr
 
-class Install(AbstractTask):
+    available = get_host_facts().get(PKG_MGRS_AVAILABLE_KEY, [])
+    for pkg_mgr in FALLBACK_PKG_MGRS:
+        if pkg_mgr in available:
+            return pkg_mgr
+
+    return False
+
+class Install(AbstractTask, BatchableFreck):
 
     def get_config_schema(self):
 
@@ -430,8 +496,13 @@ class Install(AbstractTask):
             if not pkg_mgr_obj:
                 raise FrecklesConfigError("No handler defined for package manager '{}'".format(meta[PKG_MGR_KEY]), PKG_MGR_KEY, meta[PKG_MGR_KEY])
 
+            if not config.get(BATCH_INSTALL_KEY, BATCH_INSTALL_DEFAULT):
+                meta[BATCH_INSTALL_KEY] = False
+
             pkg_mgr_obj.validate_config()
             descs = pkg_mgr_obj.create_meta_descs(meta)
+            for desc in descs:
+                add_pkg_mgr_resources(desc, meta[PKG_MGR_KEY])
             configs.extend(descs)
 
 
@@ -474,6 +545,36 @@ class Install(AbstractTask):
 
         return (FRECKLES_ANSIBLE_RUNNER,  configs)
 
+    def get_batch_key(self, freck_meta):
+
+        pkg_mgr = BATCHABLE_PKG_MGRS.get(freck_meta.get(TASK_NAME_KEY, None), None)
+        vars = freck_meta.get(FRECK_VARS_KEY, {})
+        if not pkg_mgr or UNIQUE_TASK_ID_KEY in freck_meta.keys() or not freck_meta.get(BATCH_INSTALL_KEY, BATCH_INSTALL_DEFAULT):
+            return None
+        # '.deb' files and requirement files can't be batched
+        if not isinstance(vars.get("name", None), basestring):
+            return None
+
+        options = dict((key, value) for key, value in vars.iteritems() if key != "name")
+        return (freck_meta[TASK_NAME_KEY], freck_meta.get(FRECK_SUDO_KEY, False), freck_meta.get(FRECK_DESC_KEY, None), json.dumps(options, sort_keys=True), json.dumps(freck_meta.get(FRECK_META_ROLES_KEY, {}), sort_keys=True))
+
+    def merge_batch(self, freck_metas):
+
+        names = [freck_meta[FRECK_VARS_KEY]["name"] for freck_meta in freck_metas]
+        item_names = [freck_meta.get(FRECK_ITEM_NAME_KEY, name) for freck_meta, name in zip(freck_metas, names)]
+
+        separator = BATCHABLE_PKG_MGRS[freck_metas[0][TASK_NAME_KEY]].BATCH_NAMES_SEPARATOR
+        result = copy.deepcopy(freck_metas[0])
+        result[FRECK_VARS_KEY]["name"] = separator.join(names) if separator else names
+        result[FRECK_ITEM_NAME_KEY] = ", ".join(item_names)
+        result[FRECK_BATCH_ITEMS_KEY] = item_names
+
+        return result
+
+    def get_batch_item_id(self, freck_meta):
+
+        return freck_meta[FRECK_VARS_KEY]["name"]
+
     # def create_run_items(self, freck_meta, config):
 
     #     if PKG_MGR_KEY in config.keys() and config[PKG_MGR_KEY] == 'git':
@@ -508,6 +609,7 @@ class Update(AbstractTask):
         new_meta[FRECK_SUDO_KEY] = get_pkg_mgr_sudo(pkg_mgr)
         new_meta[FRECK_ITEM_NAME_KEY] = "{} package cache".format(pkg_mgr)
         new_meta[UNIQUE_TASK_ID_KEY] = "{}_{}".format(Update.UNIQUE_TASK_ID_PREFIX, pkg_mgr)
+        add_pkg_mgr_resources(new_meta, pkg_mgr, depends_on_update=False)
         if "roles" in PKG_MGRS_COMMANDS[pkg_mgr].keys():
             new_meta[FRECK_META_ROLES_KEY] = PKG_MGRS_COMMANDS[pkg_mgr]["roles"]
         return new_meta
@@ -563,6 +665,7 @@ class Upgrade(AbstractTask):
         new_meta[FRECK_ITEM_NAME_KEY] = "{} packages".format(pkg_mgr)
 
         new_meta[UNIQUE_TASK_ID_KEY] = "{}_{}".format(Upgrade.UNIQUE_TASK_ID_PREFIX, pkg_mgr)
+        add_pkg_mgr_resources(new_meta, pkg_mgr)
         if "roles" in PKG_MGRS_COMMANDS[pkg_mgr].keys():
             new_meta[FRECK_META_ROLES_KEY] = PKG_MGRS_COMMANDS[pkg_mgr]["roles"]
 
@@ -603,15 +706,23 @@ class Upgrade(AbstractTask):
 
 class InstallNix(AbstractRole):
 
-    UNIQUE_TASK_ID = "install_nix"
+    UNIQUE_TASK_ID = NixPackageManager.INSTALLER_TASK_ID
+    # the installer also adds nix to the shell init files
+    RESOURCES = [RESOURCE_NIX_STORE, get_home_dir_resource()]
 
     @staticmethod
     def get_install_nix_meta():
-        return AbstractRole.create_role_dict("install_nix", item_name="nix", desc="install package manager", sudo=True, additional_roles={"install_nix": "frkl:ansible-nix-pkg-mgr"}, unique_task_id=InstallNix.UNIQUE_TASK_ID)
+        return AbstractRole.create_role_dict("install_nix", item_name="nix", desc="install package manager", sudo=True, additional_roles={"install_nix": "frkl:ansible-nix-pkg-mgr"}, unique_task_id=InstallNix.UNIQUE_TASK_ID, resources=InstallNix.RESOURCES, changes_host_facts=True)
 
     def get_unique_task_id(self, freck_meta):
         return InstallNix.UNIQUE_TASK_ID
 
+    def get_resources(self, freck_meta):
+        return InstallNix.RESOURCES
+
+    def changes_host_facts(self, freck_meta):
+        return True
+
     def get_role(self, freck_meta):
         return "install_nix"
 
@@ -631,15 +742,22 @@ class InstallNix(AbstractRole):
 
 class InstallBrew(AbstractRole):
 
-    UNIQUE_TASK_ID = "install_brew"
+    UNIQUE_TASK_ID = HomeBrewPackageManager.INSTALLER_TASK_ID
+    RESOURCES = [RESOURCE_HOMEBREW, get_home_dir_resource()]
 
     @staticmethod
     def get_install_brew_meta():
-        return AbstractRole.create_role_dict("install_brew", item_name="homebrew", desc="install package manager", sudo=False, additional_roles={"install_brew": "https://github.com/geerlingguy/ansible-role-homebrew.git", "elliotweiser.osx-command-line-tools": "https://github.com/elliotweiser/ansible-osx-command-line-tools.git"}, unique_task_id=InstallBrew.UNIQUE_TASK_ID)
+        return AbstractRole.create_role_dict("install_brew", item_name="homebrew", desc="install package manager", sudo=False, additional_roles={"install_brew": "https://github.com/geerlingguy/ansible-role-homebrew.git", "elliotweiser.osx-command-line-tools": "https://github.com/elliotweiser/ansible-osx-command-line-tools.git"}, unique_task_id=InstallBrew.UNIQUE_TASK_ID, resources=InstallBrew.RESOURCES, changes_host_facts=True)
 
     def get_unique_task_id(self, freck_meta):
         return InstallBrew.UNIQUE_TASK_ID
 
+    def get_resources(self, freck_meta):
+        return InstallBrew.RESOURCES
+
+    def changes_host_facts(self, freck_meta):
+        return True
+
     def get_role(self, freck_meta):
         return "install_brew"
 
@@ -657,16 +775,24 @@ class InstallBrew(AbstractRole):
 
 class InstallConda(AbstractRole):
 
-    UNIQUE_TASK_ID = "install_conda"
+    UNIQUE_TASK_ID = CondaPackageManager.INSTALLER_TASK_ID
+    # the installer also adds conda to the shell init files
+    RESOURCES = [RESOURCE_CONDA, get_home_dir_resource()]
 
     @staticmethod
     def get_install_conda_meta():
 
-        return AbstractRole.create_role_dict("install_conda", item_name="conda", desc="install package manager", sudo=False, additional_roles={"install_conda": "frkl:ansible-conda-pkg-mgr"}, additional_vars={"conda_rel_path": ".freckles/opt"}, unique_task_id=InstallConda.UNIQUE_TASK_ID)
+        return AbstractRole.create_role_dict("install_conda", item_name="conda", desc="install package manager", sudo=False, additional_roles={"install_conda": "frkl:ansible-conda-pkg-mgr"}, additional_vars={"conda_rel_path": ".freckles/opt"}, unique_task_id=InstallConda.UNIQUE_TASK_ID, resources=InstallConda.RESOURCES, changes_host_facts=True)
 
     def get_unique_task_id(self, freck_meta):
         return InstallConda.UNIQUE_TASK_ID
 
+    def get_resources(self, freck_meta):
+        return InstallConda.RESOURCES
+
+    def changes_host_facts(self, freck_meta):
+        return True
+
     def get_role(self, freck_meta):
         return "install_conda"
 
@@ -6,12 +6,11 @@ import platform
 import pprint
 import sys
 
-from ansible.module_utils import basic
-from ansible.module_utils.facts import Distribution
 from freckles import Freck
 from freckles.constants import *
 from freckles.exceptions import FrecklesConfigError
 from freckles.frecks.checkout import GIT_VALID_KEYS
+from freckles.host_facts import OS_FAMILY_KEY, get_host_facts
 from freckles.runners.ansible_runner import (FRECK_META_ROLE_DICT_KEY,
                                              FRECK_META_ROLE_KEY,
                                              FRECK_META_ROLES_KEY)
@@ -89,12 +88,7 @@ def get_os_family():
     # print(osfamily)
     # return osfamily
 
-    basic._ANSIBLE_ARGS = '{"ANSIBLE_MODULE_ARGS": {}}'
-    module = basic.AnsibleModule({})
-    d = Distribution(module)
-    d.populate()
-    os_family = d.facts["os_family"]
-    return os_family
+    return get_host_facts().get(OS_FAMILY_KEY)
 
 
 def get_default_pkg_mgr():
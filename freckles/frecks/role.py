@@ -27,10 +27,6 @@ ROLE_VARS_KEY = "role_vars"
 
 class AbstractRole(Freck):
 
-    def can_be_used_for(self, freck_meta):
-
-        return False
-
     @abc.abstractmethod
     def get_role(self, freck_meta):
         pass
@@ -54,7 +50,7 @@ class AbstractRole(Freck):
         return False
 
     @staticmethod
-    def create_role_dict(role, item_name=None, desc=None, sudo=True, additional_roles={}, additional_vars={}, unique_task_id=False):
+    def create_role_dict(role, item_name=None, desc=None, sudo=True, additional_roles={}, additional_vars={}, unique_task_id=False, resources=None, changes_host_facts=False):
 
         freck_meta = {}
         freck_meta[FRECK_META_ROLE_KEY] = role
@@ -84,6 +80,12 @@ class AbstractRole(Freck):
         if unique_task_id:
             freck_meta[UNIQUE_TASK_ID_KEY] = unique_task_id
 
+        if resources is not None:
+            freck_meta[FRECK_RESOURCES_KEY] = resources
+
+        if changes_host_facts:
+            freck_meta[FRECK_CHANGES_HOST_FACTS_KEY] = True
+
         return freck_meta
 
     def create_run_item(self, freck_meta, develop=False):
@@ -121,9 +123,7 @@ class AbstractRole(Freck):
 
 class Role(AbstractRole):
 
-    def can_be_used_for(self, freck_meta):
-        can = TASK_NAME_KEY in freck_meta.keys() and FRECK_META_ROLES_KEY in freck_meta.keys() and freck_meta[TASK_NAME_KEY] in freck_meta[FRECK_META_ROLES_KEY].keys()
-        return can
+    DISPATCH_ROLES_KEY = True
 
     def get_role(self, freck_meta):
         return freck_meta[TASK_NAME_KEY]
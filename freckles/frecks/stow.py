@@ -4,6 +4,7 @@ import pprint
 
 from freckles import Freck
 from freckles.constants import *
+from freckles.planner import get_dir_resource
 from freckles.runners.ansible_runner import (FRECK_META_ROLE_KEY,
                                              FRECK_META_ROLES_KEY)
 from freckles.utils import create_dotfiles_dict, parse_dotfiles_item
@@ -58,6 +59,7 @@ class Stow(AbstractTask):
             meta[TASK_NAME_KEY] = "stow"
             meta[FRECK_ITEM_NAME_KEY] = app
             meta[FRECK_DESC_KEY] = "stow - {} -> {}".format(base_dir, target_dir)
+            meta[FRECK_RESOURCES_KEY] = [get_dir_resource(base_dir), get_dir_resource(target_dir)]
             meta[FRECK_VARS_KEY] = {
                 "name": details[FRECK_ITEM_NAME_KEY],
                 "source_dir": base_dir,
@@ -76,8 +78,8 @@ class Stow(AbstractTask):
         stderr = []
 
         if output["state"] == FRECKLES_STATE_FAILED:
-            for output in output_details:
-                for line in output["result"]["msg"].split("\n"):
+            for msg in output_details.msg:
+                for line in msg.split("\n"):
                     stderr.append(line)
         else:
             # flatten stderr sublist
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import abc
 import copy
+import json
 import logging
 import pprint
 import sys
@@ -11,7 +12,7 @@ import sets
 from freckles import Freck
 from freckles.constants import *
 from freckles.exceptions import FrecklesConfigError
-from freckles.frkl import LEAF_DICT
+from freckles.frkl import LEAF_DICT, content_hash
 from freckles.runners.ansible_runner import (ANSIBLE_TASK_TYPE,
                                              FRECK_META_ROLE_DICT_KEY,
                                              FRECK_META_ROLE_KEY,
@@ -30,7 +31,6 @@ from voluptuous import ALLOW_EXTRA, Any, Required, Schema
 
 log = logging.getLogger("freckles")
 
-GENERATED_ROLE_ID_COUNTER = 1
 GENERATED_ROLE_NAME_PREFIX = "dyn"
 
 
@@ -62,8 +62,6 @@ class AbstractTask(Freck):
 
     def create_run_item(self, freck_meta, develop=False):
 
-        global GENERATED_ROLE_ID_COUNTER
-
         freck_name = self.get_task_name(freck_meta) or freck_meta[FRECK_NAME_KEY]
         freck_desc = self.get_task_desc(freck_meta) or freck_meta[FRECK_DESC_KEY]
         task_name = self.get_task_name(freck_meta) or freck_meta[TASK_NAME_KEY]
@@ -79,9 +77,11 @@ class AbstractTask(Freck):
         template_keys = self.get_task_template_keys(freck_meta) or freck_meta.get(TASK_TEMPLATE_KEYS, False) or vars.keys()
 
         template_keys.extend(vars.keys())
-        final_keys = set(template_keys)
-        task = {"name": freck_desc, "type": task_name, "task": {"vars": { "role_{0:04d}_task_{1:06d}".format(GENERATED_ROLE_ID_COUNTER, 1): list(final_keys)}, "become": become}}
-        role_name = "{}_{}_{}".format(GENERATED_ROLE_NAME_PREFIX, task_name, GENERATED_ROLE_ID_COUNTER)
+        final_keys = sorted(set(template_keys))
+        # the generated role only depends on the task, the variables used and become (the values of the variables are role parameters), so items that only differ in those values share the role
+        role_hash = content_hash(json.dumps([task_name, final_keys, become]))[:10]
+        role_name = "{}_{}_{}".format(GENERATED_ROLE_NAME_PREFIX, task_name, role_hash)
+        task = {"name": freck_desc, "type": task_name, "task": {"vars": {"{}_task".format(role_name): final_keys}, "become": become}}
         add_roles = self.get_additional_roles(freck_meta)
         if add_roles:
             add_roles.update(freck_meta.get(FRECK_META_ROLES_KEY, {}))
@@ -105,20 +105,17 @@ class AbstractTask(Freck):
         result[FRECK_META_ROLES_KEY] = add_roles
         result[FRECK_ITEM_NAME_KEY] = item_name
 
-        GENERATED_ROLE_ID_COUNTER = GENERATED_ROLE_ID_COUNTER + 1
-
         return result
 
 class Task(AbstractTask):
     """Generic task freck that can be used directly, or overwritten for more custom stuff.
     """
 
+    DISPATCH_FALLBACK = True
+
     def get_item_name(self, freck_meta):
         return freck_meta[TASK_NAME_KEY]
 
-    def can_be_used_for(self, freck_meta):
-        return True
-
     def process_leaf(self, leaf, supported_runners=[FRECKLES_DEFAULT_RUNNER], debug=False):
 
         # adding last vars, needed for 'pure' ansible tasks, otherwise all inherited vars would be put into the generated role
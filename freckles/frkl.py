@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 import abc
+import collections
 import copy
+import hashlib
 import json
 import logging
 import os
 import pprint
 import re
 import sys
+import threading
 import urllib2
 import uuid
 from collections import OrderedDict
 from exceptions import FrecklesConfigError, FrecklesRunError
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 
 import click
@@ -18,7 +22,8 @@ import jinja2
 import requests
 import six
 import yaml
-from jinja2 import BaseLoader, Environment, PackageLoader
+from jinja2 import (BaseLoader, Environment, FileSystemBytecodeCache,
+                    FunctionLoader, PackageLoader)
 
 import sets
 from constants import *
@@ -42,11 +47,150 @@ DEFAULT_LOAD_KEY = "load"
 LEAF_DICT = "_leaf_dict"
 DEFAULT_FRKL_KEY_MARKER = "frkl_default"
 
-def get_config(config_file_url, verify_ssl=None):
+# (connect, read) timeout in seconds for downloading a remote config
+DEFAULT_FETCH_TIMEOUT = (10, 30)
+# max number of remote configs that are downloaded at the same time
+DEFAULT_FETCH_JOBS = 8
+
+# strings that indicate a config needs to be rendered with jinja
+TEMPLATE_MARKERS = ["{{", "{%", "{#"]
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_RENDERER = None
+
+def get_session():
+    """Returns the http session that is used to download remote configs.
+
+    The session is shared within the process, so connections (and TLS handshakes) to the same host are re-used across config files.
+    """
+
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=DEFAULT_FETCH_JOBS, pool_maxsize=DEFAULT_FETCH_JOBS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+
+    return _SESSION
+
+def content_hash(content):
+    """Returns the sha1 hex digest of a (unicode or byte) string."""
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    return hashlib.sha1(content).hexdigest()
+
+def local_config_digest(config):
+    """Returns a digest of the local file a config string points to, or None if it doesn't point to one.
+
+    The result changes whenever :meth:`get_config` would return something different for this string.
+    """
+
+    try:
+        path = expand_config_url(config)
+    except FrecklesConfigError:
+        return None
+
+    if not os.path.exists(path):
+        return None
+    if not os.path.isfile(path):
+        return "not a file"
+
+    with open(path) as f:
+        return content_hash(f.read())
+
+class ConfigRenderer(object):
+    """Renders config templates, using one shared jinja environment.
+
+    Templates are registered under the sha1 hash of their content, so a document that is loaded several times (e.g. via different 'load' chains) is only compiled once. Optionally, compiled templates are also stored on disk in a bytecode cache, and re-used across invocations.
+
+    Documents that don't contain any template markers are returned as they are, without involving jinja at all.
+
+    Args:
+        bytecode_cache_dir (str): directory for the on-disk bytecode cache, None to not use one
+    """
+
+    def __init__(self, bytecode_cache_dir=None):
+
+        self.sources = {}
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            if not os.path.isdir(bytecode_cache_dir):
+                os.makedirs(bytecode_cache_dir)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+        self.env = Environment(loader=FunctionLoader(self.get_source), bytecode_cache=bytecode_cache, cache_size=-1)
+
+    def get_source(self, name):
+
+        source = self.sources.get(name, None)
+        if source is None:
+            return None
+
+        # templates are content-addressed, so they are always up to date
+        return (source, None, lambda: True)
+
+    @staticmethod
+    def is_template(config_template):
+
+        return any(marker in config_template for marker in TEMPLATE_MARKERS)
+
+    def render(self, config_template, template_vars):
+        """Renders a config template with the provided variables.
+
+        Args:
+            config_template (str): the content of the config
+            template_vars (dict): the variables to use when rendering
+
+        Returns:
+            str: the rendered config
+        """
+
+        if not ConfigRenderer.is_template(config_template):
+            return config_template
+
+        name = content_hash(config_template)
+        self.sources.setdefault(name, config_template)
+
+        return self.env.get_template(name).render(**template_vars)
+
+def get_renderer():
+    """Returns the config renderer that is shared within this process."""
+
+    global _RENDERER
+    if _RENDERER is None:
+        _RENDERER = ConfigRenderer()
+
+    return _RENDERER
+
+def set_renderer(renderer):
+    """Sets the config renderer that is shared within this process (e.g. to use one with an on-disk bytecode cache)."""
+
+    global _RENDERER
+    _RENDERER = renderer
+
+def is_remote_config_url(config_file_url):
+    """Returns whether the provided config item points to a remote (http) config file, after expanding abbreviations."""
+
+    if not isinstance(config_file_url, basestring):
+        return False
+
+    try:
+        return expand_config_url(config_file_url).startswith("http")
+    except FrecklesConfigError:
+        return False
+
+def get_config(config_file_url, verify_ssl=None, timeout=DEFAULT_FETCH_TIMEOUT, cache=None):
     """Retrieves the config (if necessary), and converts it to a dict.
 
     Config can be either a path to a local yaml file, an url to a remote yaml file, or a json string.
 
+    If a :class:`~freckles.config_cache.ConfigCache` is provided, remote configs are served from (and stored in) that cache.
+
     For the case that a url is provided, there are a few abbreviations available:
 
     TODO
@@ -76,7 +220,13 @@ def get_config(config_file_url, verify_ssl=None):
                 # '/etc/ssl/certs/',
                 # 'ca-certificates.crt')
             verify_ssl = True
-        r = requests.get(config_file_url, verify=verify_ssl)
+        if cache is not None:
+            return cache.get(config_file_url, get_session(), verify_ssl, timeout)
+        try:
+            r = get_session().get(config_file_url, verify=verify_ssl, timeout=timeout)
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise FrecklesConfigError("Can't download config '{}': {}".format(config_file_url, e), 'config', config_file_url)
         content = r.text
 
     else:
@@ -89,6 +239,36 @@ def get_config(config_file_url, verify_ssl=None):
     return content
 
 
+def fetch_configs(config_urls, verify_ssl=None, jobs=DEFAULT_FETCH_JOBS, timeout=DEFAULT_FETCH_TIMEOUT, cache=None):
+    """Retrieves several configs concurrently.
+
+    Args:
+        config_urls (list): the config urls to retrieve
+        verify_ssl (bool): whether to verify ssl certificates
+        jobs (int): maximum number of concurrent downloads
+        timeout (tuple): (connect, read) timeout per request
+        cache (ConfigCache): optional on-disk cache for remote configs
+
+    Returns:
+        list: a list of (url, content, error) tuples, in the same order as the input urls
+    """
+
+    def fetch(url):
+        try:
+            return (url, get_config(url, verify_ssl, timeout, cache), None)
+        except Exception, e:
+            return (url, None, e)
+
+    if len(config_urls) <= 1:
+        return [fetch(url) for url in config_urls]
+
+    pool = ThreadPool(min(jobs, len(config_urls)))
+    try:
+        return pool.map(fetch, config_urls)
+    finally:
+        pool.close()
+        pool.join()
+
 def expand_config_url(url):
 
     prefix, sep, rest = url.partition(':')
@@ -141,51 +321,369 @@ def expand_config_url_old(url, default_repo, default_repo_path):
         # TODO bitbucket
         raise Exception("Not implemented")
 
-def get_and_load_configs(config_url, load_external=True, load_key=DEFAULT_LOAD_KEY):
-    """ Retrieves and loads config from url, parses it and downloads 'load' configs if applicable.
+class ConfigResolver(object):
+    """Retrieves and holds the (un-rendered) content of remote config files.
+
+    Before a list of configs is processed, all the remote urls in it are downloaded concurrently (using a shared, pooled http session). Every downloaded document that is valid yaml without rendering is scanned for more remote urls (in 'stem' lists and 'load' keys), and those are downloaded in the next batch, so the whole config graph is usually retrieved before the first config is rendered. The order in which configs are merged doesn't change, that is still up to the caller.
+
+    Args:
+        verify_ssl (bool): whether to verify ssl certificates
+        stem_key (str): the key that contains child configs
+        load_key (str): the key that contains configs to load additionally
+        jobs (int): maximum number of concurrent downloads
+        timeout (tuple): (connect, read) timeout per request
+        cache (ConfigCache): optional on-disk cache for remote configs
+    """
+
+    def __init__(self, verify_ssl=None, stem_key=None, load_key=DEFAULT_LOAD_KEY, jobs=DEFAULT_FETCH_JOBS, timeout=DEFAULT_FETCH_TIMEOUT, cache=None):
+
+        self.verify_ssl = verify_ssl
+        self.stem_key = stem_key
+        self.load_key = load_key
+        self.jobs = jobs
+        self.timeout = timeout
+        self.cache = cache
+
+        self.contents = {}
+        self.errors = {}
+        # digests of every (string) config that was requested, in order
+        self.dependencies = OrderedDict()
+
+        # background downloads, only used when streaming
+        self.pending = {}
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def prefetch(self, configs):
+        """Downloads all remote configs in the provided list (and the ones they reference) that weren't downloaded yet."""
+
+        todo = self.filter_new(configs)
+        while todo:
+            log.debug("Downloading {} config(s)...".format(len(todo)))
+            discovered = []
+            for url, content, error in fetch_configs(todo, self.verify_ssl, self.jobs, self.timeout, self.cache):
+                if error is not None:
+                    self.errors[url] = error
+                    continue
+                self.contents[url] = content
+                discovered.extend(self.discover_urls(content))
+
+            todo = self.filter_new(discovered)
+
+    def prefetch_async(self, configs):
+        """Starts downloading all remote configs in the provided list (and the ones they reference) in the background, without waiting for them.
+
+        :meth:`get` waits for a pending download when its config is requested. Call :meth:`close` once all configs are processed.
+        """
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.jobs)
+            self.schedule(configs)
+
+    def schedule(self, configs):
+
+        for url in self.filter_new(configs):
+            if url in self.pending.keys():
+                continue
+            self.pending[url] = self.pool.apply_async(get_config, (url, self.verify_ssl, self.timeout, self.cache), callback=self.discovered)
+
+    def discovered(self, content):
+
+        urls = self.discover_urls(content)
+        with self.lock:
+            # already closed
+            if self.pool is None:
+                return
+            self.schedule(urls)
+
+    def wait_for(self, config):
+
+        with self.lock:
+            result = self.pending.get(config, None)
+        if result is None:
+            return
+
+        try:
+            content = result.get()
+            error = None
+        except Exception, e:
+            content = None
+            error = e
+
+        with self.lock:
+            if error is None:
+                self.contents[config] = content
+            else:
+                self.errors[config] = error
+            del self.pending[config]
+
+    def close(self):
+        """Stops the background downloads (waiting for the ones that are already running)."""
+
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+            self.pending = {}
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def filter_new(self, configs):
+        """Returns the expanded urls of the remote configs in the provided list that weren't downloaded yet (abbreviated and expanded urls of the same config are downloaded only once)."""
+
+        result = []
+        for c in configs:
+            if not is_remote_config_url(c):
+                continue
+            url = expand_config_url(c)
+            if url in self.contents.keys() or url in self.errors.keys() or url in result:
+                continue
+            result.append(url)
+        return result
+
+    def discover_urls(self, content):
+        """Returns the remote urls that are referenced in an (un-rendered) config document.
+
+        Templated documents that aren't valid yaml before rendering are skipped, their children will be downloaded once they are rendered.
+        """
+
+        try:
+            parsed = yaml.safe_load(content)
+        except Exception:
+            return []
+
+        result = []
+        self._collect_urls(parsed, result)
+        return result
+
+    def _collect_urls(self, item, result):
+
+        if isinstance(item, (list, tuple)):
+            for i in item:
+                self._collect_urls(i, result)
+        elif isinstance(item, dict):
+            for key, value in item.iteritems():
+                if key in [self.stem_key, self.load_key]:
+                    if isinstance(value, basestring):
+                        value = [value]
+                    if isinstance(value, (list, tuple)):
+                        result.extend([v for v in value if is_remote_config_url(v)])
+                self._collect_urls(value, result)
+
+    def get(self, config):
+        """Returns the content of a config, downloading it first if necessary.
+
+        Non-remote configs (local files, json strings, dicts) are forwarded to :meth:`get_config`.
+
+        For every string config, a digest of its content is recorded in ``self.dependencies``.
+        """
+
+        if not is_remote_config_url(config):
+            if isinstance(config, basestring):
+                self.dependencies[config] = local_config_digest(config)
+            return get_config(config, self.verify_ssl, self.timeout, self.cache)
+
+        url = expand_config_url(config)
+        self.wait_for(url)
+        self.prefetch([url])
+
+        if url in self.errors.keys():
+            raise self.errors[url]
+
+        self.dependencies[config] = content_hash(self.contents[url])
+        return self.contents[url]
+
+
+class RecordingEnviron(collections.Mapping):
+    """Read-only view on the process environment that records which variables a template used.
+
+    Attributes:
+        reads (dict): the variables that were looked up, and their values (None if not set)
+        read_all (bool): whether the whole environment was accessed (e.g. iterated over)
+    """
+
+    def __init__(self, environ=os.environ):
+
+        self.environ = environ
+        self.reads = {}
+        self.read_all = False
+
+    def __getitem__(self, key):
+
+        value = self.environ.get(key, None)
+        self.reads[key] = value
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+
+        self.read_all = True
+        return iter(self.environ.keys())
+
+    def __len__(self):
+
+        self.read_all = True
+        return len(self.environ)
+
+
+def get_config_id(config):
+    """Returns an id that is the same for all references to the same config source.
+
+    That is the expanded url for remote configs, the real path for local files, and the config itself for everything else (e.g. json strings).
+    """
+
+    if not isinstance(config, basestring):
+        return "dict:{}".format(content_hash(json.dumps(config, sort_keys=True, default=repr)))
+
+    try:
+        expanded = expand_config_url(config)
+    except FrecklesConfigError:
+        return config
+
+    if os.path.exists(expanded):
+        return os.path.realpath(expanded)
+
+    return expanded
+
+def format_cycle(config_ids):
+
+    return " -> ".join(config_ids)
+
+class ConfigGraph(object):
+    """Dependency graph of configs, and the configs they load.
+
+    Every config source is a node, identified by :func:`get_config_id`, so the same source referenced from several places (or with different urls, e.g. abbreviated and expanded) is retrieved, rendered and parsed exactly once. A config that (directly or indirectly) loads itself raises a :class:`FrecklesConfigError`.
+
+    Args:
+        resolver (ConfigResolver): the resolver to retrieve configs with
+        load_key (str): the key that contains configs to load additionally
+        load_external (bool): whether to follow 'load' references at all
+
+    Attributes:
+        nodes (OrderedDict): the parsed configs, keyed by config id, in the order they were resolved
+        edges (dict): the (unresolved) configs every node loads, keyed by config id
     """
 
-    log.debug("Loading config: {}".format(config_url))
-    config_template = get_config(config_url)
-    rtemplate = Environment(loader=BaseLoader()).from_string(config_template)
-    config_string = rtemplate.render({})
-    config_dict = yaml.load(config_string)
-    result = [config_dict]
-
-    load = config_dict.get(load_key, [])
-    if load and load_external:
-        if isinstance(load, basestring):
-            new_configs = get_and_load_configs(load)
-            result.extend(new_configs)
+    def __init__(self, resolver=None, load_key=DEFAULT_LOAD_KEY, load_external=True):
+
+        if resolver is None:
+            resolver = ConfigResolver(load_key=load_key)
+        self.resolver = resolver
+        self.load_key = load_key
+        self.load_external = load_external
+
+        self.nodes = OrderedDict()
+        self.edges = {}
+
+    def resolve(self, config):
+        """Returns a config and all the configs it loads (recursively), in overlay order.
+
+        The order is the same as if every 'load' reference was followed one after the other, so a config that is loaded more than once is also contained more than once (as a copy).
+        """
+
+        order = []
+        self.visit(config, [], order)
+
+        result = []
+        seen = set()
+        for config_id in order:
+            if config_id in seen:
+                result.append(copy.deepcopy(self.nodes[config_id]))
+            else:
+                result.append(self.nodes[config_id])
+                seen.add(config_id)
+
+        return result
+
+    def visit(self, config, path, order):
+
+        config_id = get_config_id(config)
+        if config_id in path:
+            raise FrecklesConfigError("Cycle in '{}' chain: {}".format(self.load_key, format_cycle(path + [config_id])), self.load_key, config)
+
+        order.append(config_id)
+        if config_id not in self.nodes.keys():
+            self.add_node(config_id, config)
+
+        for child in self.edges[config_id]:
+            self.visit(child, path + [config_id], order)
+
+    def add_node(self, config_id, config):
+
+        log.debug("Loading config: {}".format(config))
+        config_template = self.resolver.get(config)
+        config_string = get_renderer().render(config_template, {})
+        config_dict = yaml.load(config_string)
+
+        load = config_dict.get(self.load_key, [])
+        if not load or not self.load_external:
+            load = []
+        elif isinstance(load, basestring):
+            load = [load]
         elif isinstance(load, (tuple, list)):
-            for config in load:
-                new_configs = get_and_load_configs(config)
-                result.extend(new_configs)
+            # download all of them concurrently (once per source, and only if they weren't loaded yet), before they are resolved one after the other
+            to_fetch = []
+            for c in load:
+                load_id = get_config_id(c)
+                if load_id not in self.nodes.keys() and load_id not in to_fetch:
+                    to_fetch.append(load_id)
+            self.resolver.prefetch(to_fetch)
         else:
             raise FrecklesConfigError("Can't load external config, type not recognized: {}".format(load), GLOBAL_LOAD_KEY, load)
 
-    return result
+        self.nodes[config_id] = config_dict
+        self.edges[config_id] = list(load)
 
-def flatten_root(root, add_leaf_dicts=False):
+def get_and_load_configs(config_url, load_external=True, load_key=DEFAULT_LOAD_KEY, resolver=None):
+    """ Retrieves and loads config from url, parses it and downloads 'load' configs if applicable.
 
-    root_copy = copy.deepcopy(root)
-    result = []
-    for item in root_copy:
+    All configs of the 'load' chain are downloaded concurrently, and every one of them is only parsed once (see :class:`ConfigGraph`), but the result is in the same order as if they were loaded one after the other.
+    """
+
+    graph = ConfigGraph(resolver, load_key, load_external)
+    return graph.resolve(config_url)
+
+def flatten_leaf(leaf, add_leaf_dicts=False):
+    """Merges the layers of overlay dicts of every key of a leaf into a single dict per key.
+
+    Layers are shared between leafs (and with the ancestor configs they come from), so they are never modified, the result only contains copies.
+    """
+
+    result_dict = {}
+    for var, value_dicts in leaf.iteritems():
+        if var == LEAF_DICT:
+            continue
+        result_dict[var] = {}
+        for value_dict in value_dicts:
+            dict_merge(result_dict[var], copy.deepcopy(value_dict))
+
+    if add_leaf_dicts:
+        result_dict[LEAF_DICT] = copy.deepcopy(leaf.get(LEAF_DICT, {}))
+
+    return result_dict
+
+def merge_layer(parent, layer):
+    """Returns the result of merging a layer on top of an already merged dict (like :func:`dict_merge` would), without changing either of them.
 
-        if LEAF_DICT in item.keys():
-            leaf_dict = item.pop(LEAF_DICT)
+    Values of the parent that the layer doesn't change are shared with the result (not copied), only the values of the layer itself are.
+    """
+
+    result = dict(parent)
+    for key, value in layer.iteritems():
+        if isinstance(value, collections.Mapping) and isinstance(result.get(key, None), dict):
+            result[key] = merge_layer(result[key], value)
         else:
-            leaf_dict = {}
+            result[key] = copy.deepcopy(value)
+
+    return result
 
-        result_dict = {}
-        for var, value_dicts in item.iteritems():
-            result_dict[var] = {}
-            for value_dict in value_dicts:
-                dict_merge(result_dict[var], value_dict)
+def flatten_root(root, add_leaf_dicts=False):
 
-        if add_leaf_dicts:
-            result_dict[LEAF_DICT] = leaf_dict
-        result.append(result_dict)
+    result = []
+    for item in root:
+        result.append(flatten_leaf(item, add_leaf_dicts))
 
     return result
 
@@ -198,9 +696,91 @@ def merge_root(root):
 
     return result
 
+class RootContext(object):
+    """The merged values of all leafs of a root, as used as context when rendering config templates.
+
+    This gives the same result as ``merge_root(root)``, but is updated every time a leaf is appended instead of being re-calculated from the whole root, which would make processing a config quadratic in the number of leafs.
+
+    In ``merge_root``, earlier leafs have precedence, so a new leaf can only add values 'underneath' the current ones. Once a key had a non-dict value in any leaf, no later leaf can change it anymore (it is 'sealed'), which is tracked in a tree that mirrors the merged dict.
+
+    Only the dict of every key of a flattened leaf is copied (so changing it after the leaf was appended doesn't change the context), the values in it are added to the merged dict without copying them, and a (shallow) copy of a nested dict is only made once a later leaf has to merge values into it, so the flattened leafs themselves are never modified.
+    """
+
+    def __init__(self):
+
+        self.merged = {}
+        self.sealed = {}
+        # ids of the dicts in 'merged' that were created here (and can be modified), all others belong to leafs
+        self.owned = set([id(self.merged)])
+
+    def append(self, leaf):
+
+        self.append_flattened(flatten_leaf(leaf))
+
+    def append_flattened(self, flattened):
+        """Like :meth:`append`, but for a leaf that was already flattened (see :func:`flatten_leaf`)."""
+
+        # the dict of every key is copied, since the leaf itself might change it once it's used (the values in it are shared by leafs, and never changed)
+        new = {}
+        for key, value in flattened.iteritems():
+            if key == LEAF_DICT:
+                continue
+            if isinstance(value, dict):
+                value = dict(value)
+                if key not in self.merged:
+                    # will be stored as it is
+                    self.owned.add(id(value))
+            new[key] = value
+
+        self.merge_under(self.merged, self.sealed, new)
+
+    @staticmethod
+    def seal_tree(value):
+
+        if not isinstance(value, dict):
+            return True
+
+        return dict((k, RootContext.seal_tree(v)) for k, v in value.iteritems())
+
+    def merge_under(self, merged, sealed, new):
+
+        for key, value in new.iteritems():
+            if key not in merged.keys():
+                merged[key] = value
+                sealed[key] = RootContext.seal_tree(value)
+            elif sealed[key] is True:
+                continue
+            elif isinstance(value, collections.Mapping):
+                if id(merged[key]) not in self.owned:
+                    merged[key] = dict(merged[key])
+                    self.owned.add(id(merged[key]))
+                self.merge_under(merged[key], sealed[key], value)
+            else:
+                # will be replaced by the existing dict, and replace everything that comes after it
+                sealed[key] = True
+
+    def get_template_vars(self, all_keys, environ=os.environ):
+        """Returns the variables to use when rendering a config template."""
+
+        temp_flattened = dict(self.merged)
+        # make sure at least empty dicts exist for all possible keys, otherwise template rendering might fail when
+        # trying something like {{ vars.key1 | default("DefaultValue") }}
+        for key in all_keys:
+            if key not in temp_flattened.keys():
+                temp_flattened[key] = {}
+                temp_flattened["env"] = environ
+
+        return temp_flattened
+
 class Frkl(object):
+    """Calculates the leafs out of a list of (overlayed) configs.
+
+    By default, all leafs are calculated when the object is created, and stored in the 'leafs' attribute (a list). If 'stream' is set, 'leafs' is a generator instead, which processes the configs while it is consumed, so the first leafs can be used while later configs are still being downloaded and rendered. Only the current branch of the config tree is held in memory in that case, and the generator can only be consumed once. :meth:`get_dependencies` is only complete after it was exhausted.
 
-    def __init__(self, configs, stem_key, other_valid_keys, default_leaf_key, default_leaf_default_key, default_leaf_default_value_key, default_repo, default_repo_path, add_leaf_dicts=False, verify=None):
+    Leafs share the values they inherit unchanged from their ancestors with each other, so only the (top-level) dict of every key of a leaf may be changed, not the values in it (use a copy for that).
+    """
+
+    def __init__(self, configs, stem_key, other_valid_keys, default_leaf_key, default_leaf_default_key, default_leaf_default_value_key, default_repo, default_repo_path, add_leaf_dicts=False, verify=None, jobs=DEFAULT_FETCH_JOBS, cache=None, stream=False):
 
         self.stem_key = stem_key
         self.other_keys = other_valid_keys
@@ -221,41 +801,102 @@ class Frkl(object):
         self.all_keys.update(self.other_keys)
 
         self.config_urls = configs
+        self.cache = cache
+        self.stream = stream
+        self.resolver = ConfigResolver(self.verify_ssl, self.stem_key, jobs=jobs, cache=cache)
 
-        self.root = []
+        self.root_context = RootContext()
+        self.environ = RecordingEnviron()
         self.meta_dict = {}
 
-        self.frklize_config(self.root, self.config_urls, self.meta_dict, {}, 0)
+        if self.stream:
+            self.root = None
+            self.leafs = self.iterate_leafs()
+        else:
+            root = list(self.frklize_config(self.config_urls, self.meta_dict, {}, {}, 0))
+            self.root = [leaf for leaf, flattened in root]
+            self.leafs = [flattened for leaf, flattened in root]
 
-        self.leafs = flatten_root(self.root, self.add_leaf_dicts)
+            if cache is not None:
+                cache.log_stats()
 
         # pprint.pprint(self.leafs)
         # print(yaml.dump(self.leafs, default_flow_style=False))
         # sys.exit(0)
 
+    def get_dependencies(self):
+        """Returns everything the leafs were calculated from, apart from the input configs themselves.
+
+        Returns:
+            dict: the digests of all config files and urls that were used (key: 'configs'), and the environment variables templates looked up (key: 'env', all of them if 'env_all' is True)
+        """
+
+        if self.environ.read_all:
+            env = dict(os.environ)
+        else:
+            env = dict(self.environ.reads)
+
+        return {
+            "configs": self.resolver.dependencies.items(),
+            "env": env,
+            "env_all": self.environ.read_all
+        }
+
+
+    def iterate_leafs(self):
+        """Yields the flattened leafs, processing the configs as they are requested."""
+
+        try:
+            for leaf, flattened in self.frklize_config(self.config_urls, self.meta_dict, {}, {}, 0):
+                yield flattened
+        finally:
+            self.resolver.close()
+
+        if self.cache is not None:
+            self.cache.log_stats()
 
-    def frklize_config(self, root, configs, meta_dict_parent, root_base_dict, level, add_level=False):
+    def frklize_config(self, configs, meta_dict_parent, merged_dict_parent, root_base_dict, level, add_level=False, parents=()):
+        """Processes a list of configs, and yields a tuple of every leaf that is found (unflattened) and the flattened version of it, in order.
+
+        The meta dict maps every key to a tuple of overlay layers, one per ancestor that sets this key. Layers are never modified once they are added, so children (and leafs) only copy the (shallow) dict and tuples, and share the layer dicts with their ancestors.
+
+        The merged dict maps every key to the result of merging those layers (see :func:`merge_layer`), which is calculated once per config and shared with its children, so flattened leafs share all values they inherit unchanged with each other, and only contain copies of the values they set themselves.
+
+        'parents' contains the ids of the config sources the current configs are children of, to detect configs that (indirectly) contain themselves.
+        """
+
+        # download all remote configs of this level (and the ones they reference) in one go
+        if self.stream:
+            self.resolver.prefetch_async(configs)
+        else:
+            self.resolver.prefetch(configs)
 
         for c in configs:
 
-            meta_dict = copy.deepcopy(meta_dict_parent)
+            meta_dict = dict(meta_dict_parent)
+            merged_dict = dict(merged_dict_parent)
+
+            config_id = None
+            if isinstance(c, basestring):
+                config_id = get_config_id(c)
+                if config_id in parents:
+                    raise FrecklesConfigError("Cycle in '{}' chain: {}".format(self.stem_key, format_cycle(list(parents) + [config_id])), self.stem_key, c)
 
             try:
-                config_template = get_config(c, self.verify_ssl)
+                config_template = self.resolver.get(c)
+                if not isinstance(config_template, basestring):
+                    raise FrecklesConfigError("Not a config template: {}".format(c), 'config', c)
                 try:
-                    temp_flattened = merge_root(root)
-                    # make sure at least empty dicts exist for all possible keys, otherwise template rendering might fail when
-                    # trying something like {{ vars.key1 | default("DefaultValue") }}
-                    for key in self.all_keys:
-                        if key not in temp_flattened.keys():
-                            temp_flattened[key] = {}
-                            temp_flattened["env"] = os.environ
-                    rtemplate = Environment(loader=BaseLoader()).from_string(config_template)
-                    config_string = rtemplate.render(**temp_flattened)
+                    temp_flattened = self.root_context.get_template_vars(self.all_keys, self.environ)
+                    config_string = get_renderer().render(config_template, temp_flattened)
                     c = yaml.load(config_string)
                 except Exception, e:
                     raise FrecklesRunError("Error parsing/rendering config file: {}".format(e), None)
 
+            except FrecklesConfigError:
+                # a remote config that can't be downloaded is an error, everything else (including dicts) is not a 'url' config
+                if is_remote_config_url(c):
+                    raise
             except:
                 # means this is not a 'url' config
                 pass
@@ -288,11 +929,12 @@ class Frkl(object):
             stem = base_dict.pop(self.stem_key, NO_STEM_INDICATOR)
 
             # we want to take along all the 'base' non-stem variables
+            # (copied, so the layers below don't change when later configs are merged into root_base_dict)
             if level == 0:
-                dict_merge(root_base_dict, base_dict)
+                dict_merge(root_base_dict, copy.deepcopy(base_dict))
 
             temp = {}
-            dict_merge(temp, root_base_dict)
+            dict_merge(temp, copy.deepcopy(root_base_dict))
             dict_merge(temp, base_dict)
             base_dict = temp
 
@@ -303,15 +945,23 @@ class Frkl(object):
                 if add_level:
                     base_dict[key][FRKL_META_LEVEL_KEY] = level
 
-                meta_dict.setdefault(key, []).append(base_dict[key])
+                meta_dict[key] = meta_dict.get(key, ()) + (base_dict[key],)
+                merged_dict[key] = merge_layer(merged_dict.get(key, {}), base_dict[key])
 
             if not stem:
                 continue
             elif stem == NO_STEM_INDICATOR:
-                leaf = copy.deepcopy(meta_dict)
+                leaf = dict(meta_dict)
                 leaf[LEAF_DICT] = base_dict
-                root.append(leaf)
+                # the dicts of the keys the leaf doesn't set itself belong to its parent
+                flattened = dict((key, value if key in base_dict else dict(value)) for key, value in merged_dict.iteritems())
+                if self.add_leaf_dicts:
+                    flattened[LEAF_DICT] = copy.deepcopy(base_dict)
+                self.root_context.append_flattened(flattened)
+                yield (leaf, flattened)
             elif isinstance(stem, (list, tuple)) and not isinstance(stem, basestring):
-                self.frklize_config(root, stem, meta_dict, {}, level+1)
+                child_parents = parents if config_id is None else parents + (config_id,)
+                for result in self.frklize_config(stem, meta_dict, merged_dict, {}, level+1, parents=child_parents):
+                    yield result
             else:
                 raise Exception("Value of {} must be list (is: '{}')".format(self.stem_key, type(stem)))
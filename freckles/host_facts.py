@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# absolute imports, otherwise 'ansible' would be the 'freckles.ansible' package
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import subprocess
+import time
+from distutils.spawn import find_executable
+
+from .constants import *
+
+from . import __version__ as VERSION
+
+log = logging.getLogger("freckles")
+
+HOST_FACTS_VERSION_KEY = "version"
+HOST_FACTS_BOOT_ID_KEY = "boot_id"
+HOST_FACTS_PATH_KEY = "path"
+HOST_FACTS_TIMESTAMP_KEY = "timestamp"
+HOST_FACTS_FACTS_KEY = "facts"
+
+OS_FAMILY_KEY = "os_family"
+DISTRIBUTION_KEY = "distribution"
+DISTRIBUTION_VERSION_KEY = "distribution_version"
+DISTRIBUTION_RELEASE_KEY = "distribution_release"
+PKG_MGRS_AVAILABLE_KEY = "pkg_mgrs_available"
+
+LINUX_BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+# the executables that indicate a package manager is available, by package manager name
+PKG_MGR_EXECUTABLES = {
+    "apt": "apt-get",
+    "yum": "yum",
+    "homebrew": "brew",
+    "nix": "nix-env",
+    "conda": "conda",
+    "pip": "pip",
+    "git": "git"
+}
+
+HOST_FACTS = None
+
+
+def get_boot_id():
+    """Returns an id that changes every time the machine is rebooted, or None if it can't be determined."""
+
+    if os.path.exists(LINUX_BOOT_ID_FILE):
+        with open(LINUX_BOOT_ID_FILE) as f:
+            return f.read().strip()
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(["sysctl", "-n", "kern.boottime"], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def probe_host_facts():
+    """Determines the facts about this machine, using ansible's distribution facts.
+
+    Returns:
+        dict: the facts
+    """
+
+    from ansible.module_utils import basic
+    from ansible.module_utils.facts import Distribution
+
+    log.debug("Probing host facts...")
+    basic._ANSIBLE_ARGS = '{"ANSIBLE_MODULE_ARGS": {}}'
+    module = basic.AnsibleModule({})
+    d = Distribution(module)
+    d.populate()
+
+    facts = {}
+    for key in [OS_FAMILY_KEY, DISTRIBUTION_KEY, DISTRIBUTION_VERSION_KEY, DISTRIBUTION_RELEASE_KEY]:
+        facts[key] = d.facts.get(key, None)
+    facts[PKG_MGRS_AVAILABLE_KEY] = sorted(pkg_mgr for pkg_mgr, executable in PKG_MGR_EXECUTABLES.iteritems() if find_executable(executable))
+
+    return facts
+
+
+class HostFacts(object):
+    """Facts about the machine freckles runs on, persisted so they don't have to be probed again in every run.
+
+    Facts are probed at most once per object (use :func:`get_host_facts` to get the one for this process). The probed facts are written to 'cache_file', and are used from there as long as they are not older than 'max_age' seconds, the machine was not rebooted (if that can be determined) and the PATH did not change. Which package managers are available is determined when the facts are probed, so the facts are invalidated after a run that installed one (see :meth:`~freckles.freckles.Freck.changes_host_facts`).
+
+    Args:
+        cache_file (str): the file to persist the facts in (None to not persist them)
+        max_age (int): the number of seconds persisted facts are used
+    """
+
+    def __init__(self, cache_file=FRECKLES_DEFAULT_HOST_FACTS_FILE, max_age=FRECKLES_DEFAULT_HOST_FACTS_MAX_AGE):
+
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.facts = None
+
+    def get_cache_key(self):
+
+        return {HOST_FACTS_VERSION_KEY: VERSION, HOST_FACTS_BOOT_ID_KEY: get_boot_id(), HOST_FACTS_PATH_KEY: os.environ.get("PATH", "")}
+
+    def load(self, cache_key):
+
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return None
+
+        try:
+            with open(self.cache_file) as f:
+                entry = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Ignoring invalid host facts cache '{}': {}".format(self.cache_file, e))
+            return None
+
+        if any(entry.get(key, None) != value for key, value in cache_key.iteritems()):
+            log.debug("Host facts cache: outdated")
+            return None
+        if time.time() - entry.get(HOST_FACTS_TIMESTAMP_KEY, 0) > self.max_age:
+            log.debug("Host facts cache: expired")
+            return None
+
+        return entry.get(HOST_FACTS_FACTS_KEY, None)
+
+    def store(self, cache_key, facts):
+
+        if not self.cache_file:
+            return
+
+        entry = dict(cache_key)
+        entry[HOST_FACTS_TIMESTAMP_KEY] = time.time()
+        entry[HOST_FACTS_FACTS_KEY] = facts
+
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            temp_file = "{}.{}".format(self.cache_file, os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump(entry, f)
+            os.rename(temp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            log.debug("Could not write host facts cache: {}".format(e))
+
+    def get_facts(self):
+        """Returns all facts, probing them if necessary."""
+
+        if self.facts is None:
+            cache_key = self.get_cache_key()
+            self.facts = self.load(cache_key)
+            if self.facts is None:
+                self.facts = probe_host_facts()
+                self.store(cache_key, self.facts)
+
+        return self.facts
+
+    def get(self, key, default=None):
+
+        return self.get_facts().get(key, default)
+
+    def invalidate(self):
+        """Forgets the facts (also the persisted ones), so they are probed again the next time they are needed."""
+
+        self.facts = None
+        if self.cache_file and os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+
+def get_host_facts():
+    """Returns the :class:`HostFacts` for this process."""
+
+    global HOST_FACTS
+
+    if HOST_FACTS is None:
+        HOST_FACTS = HostFacts()
+
+    return HOST_FACTS
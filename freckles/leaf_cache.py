@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import os
+
+from constants import *
+from frkl import (content_hash, fetch_configs, is_remote_config_url,
+                  local_config_digest)
+
+from . import __version__ as VERSION
+
+log = logging.getLogger("freckles")
+
+LEAF_CACHE_VERSION_KEY = "version"
+LEAF_CACHE_DEPENDENCIES_KEY = "dependencies"
+LEAF_CACHE_LEAFS_KEY = "leafs"
+
+
+class LeafCache(object):
+    """On-disk cache for the flattened leafs that are calculated from a list of configs.
+
+    Entries are keyed by the freckles version, the current working directory (because configs can be relative paths) and the input configs. Every entry also contains the digests of all config files and urls that were used to calculate the leafs, as well as all environment variables that were looked up in templates. An entry is only used if all of those are still the same, otherwise the leafs are re-calculated.
+
+    Args:
+        cache_dir (str): the directory to store cached leafs in
+        config_cache (ConfigCache): the cache to use when checking whether remote configs changed
+    """
+
+    def __init__(self, cache_dir=FRECKLES_DEFAULT_LEAF_CACHE_DIR, config_cache=None):
+
+        self.cache_dir = cache_dir
+        self.config_cache = config_cache
+
+    def get_cache_file(self, configs):
+
+        key = json.dumps([VERSION, os.getcwd(), configs], sort_keys=True, default=repr)
+        return os.path.join(self.cache_dir, "{}.pickle".format(hashlib.sha1(key).hexdigest()))
+
+    def is_valid(self, entry):
+
+        if not isinstance(entry, dict) or entry.get(LEAF_CACHE_VERSION_KEY, None) != VERSION:
+            return False
+
+        # truncated or incomplete entries are misses
+        dependencies = entry.get(LEAF_CACHE_DEPENDENCIES_KEY, None)
+        if LEAF_CACHE_LEAFS_KEY not in entry.keys() or not isinstance(dependencies, dict):
+            return False
+        env = dependencies.get("env", None)
+        configs = dependencies.get("configs", None)
+        if not isinstance(env, dict) or not isinstance(configs, (list, tuple)):
+            return False
+
+        if dependencies.get("env_all", False):
+            if dict(os.environ) != env:
+                log.debug("Leaf cache: environment changed")
+                return False
+        else:
+            for key, value in env.iteritems():
+                if os.environ.get(key, None) != value:
+                    log.debug("Leaf cache: environment variable '{}' changed".format(key))
+                    return False
+
+        remote = []
+        for config, digest in configs:
+            if is_remote_config_url(config):
+                remote.append((config, digest))
+            elif local_config_digest(config) != digest:
+                log.debug("Leaf cache: config changed: {}".format(config))
+                return False
+
+        results = fetch_configs([config for config, digest in remote], cache=self.config_cache)
+        for (config, digest), (url, content, error) in zip(remote, results):
+            if error is not None or content_hash(content) != digest:
+                log.debug("Leaf cache: remote config changed: {}".format(config))
+                return False
+
+        return True
+
+    def load(self, configs):
+        """Returns the cached leafs for the provided configs, or None if there are none, or they are not valid anymore."""
+
+        cache_file = self.get_cache_file(configs)
+        if not os.path.exists(cache_file):
+            log.debug("Leaf cache: miss")
+            return None
+
+        try:
+            with open(cache_file, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            log.debug("Ignoring invalid leaf cache entry '{}': {}".format(cache_file, e))
+            return None
+
+        if not self.is_valid(entry):
+            return None
+
+        log.debug("Leaf cache: hit")
+        return entry[LEAF_CACHE_LEAFS_KEY]
+
+    def store(self, configs, dependencies, leafs):
+
+        entry = {
+            LEAF_CACHE_VERSION_KEY: VERSION,
+            LEAF_CACHE_DEPENDENCIES_KEY: dependencies,
+            LEAF_CACHE_LEAFS_KEY: leafs
+        }
+
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            cache_file = self.get_cache_file(configs)
+            temp_file = "{}.{}".format(cache_file, os.getpid())
+            with open(temp_file, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            log.debug("Could not write leaf cache entry: {}".format(e))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from collections import OrderedDict
+
+from constants import *
+
+log = logging.getLogger("freckles")
+
+# resource classes run items can declare (in the 'resources' key), items that use the same resource are never executed concurrently
+RESOURCE_APT_LOCK = "apt_lock"
+RESOURCE_YUM_LOCK = "yum_lock"
+RESOURCE_NIX_STORE = "nix_store"
+RESOURCE_CONDA = "conda"
+RESOURCE_HOMEBREW = "homebrew"
+RESOURCE_DIR_PREFIX = "dir:"
+
+
+def get_dir_resource(path):
+    """Returns the resource class for changes to the content of a directory.
+
+    The resource conflicts with the ones of the same directory, and of its parent and child directories (see :func:`resources_conflict`).
+    """
+
+    return "{}{}".format(RESOURCE_DIR_PREFIX, os.path.abspath(os.path.expanduser(path)))
+
+
+def get_home_dir_resource():
+    """Returns the resource class for changes to the home directory of the user (for example shell init files)."""
+
+    return get_dir_resource("~")
+
+
+def resources_conflict(resource_1, resource_2):
+    """Returns whether two resource classes can't be used concurrently.
+
+    That is the case if they are the same, or if both are directories and one of them contains the other.
+    """
+
+    if resource_1 == resource_2:
+        return True
+    if not resource_1.startswith(RESOURCE_DIR_PREFIX) or not resource_2.startswith(RESOURCE_DIR_PREFIX):
+        return False
+
+    path_1 = resource_1[len(RESOURCE_DIR_PREFIX):].rstrip(os.sep) + os.sep
+    path_2 = resource_2[len(RESOURCE_DIR_PREFIX):].rstrip(os.sep) + os.sep
+    return path_1.startswith(path_2) or path_2.startswith(path_1)
+
+
+def get_item_dependencies(items):
+    """Calculates which items of a run have to be executed before which other ones.
+
+    An item depends on:
+     - the items that provide one of the unique task ids listed in its 'depends_on' key (only if they come earlier in the run)
+     - the last item before it that uses one of the resources listed in its 'resources' key, or a resource that conflicts with it (see :func:`resources_conflict`)
+     - every item before it, if it doesn't have a 'resources' key (which means it could use any resource), in which case every item after it depends on it too
+
+    Args:
+        items (list): the run items, in the order they'd be executed serially
+
+    Returns:
+        list: a set of indexes of items for every item
+    """
+
+    dependencies = []
+    providers = {}
+    last_users = {}
+    exclusive_item = None
+    since_exclusive = []
+
+    for i, item in enumerate(items):
+
+        item_dependencies = set()
+        if exclusive_item is not None:
+            item_dependencies.add(exclusive_item)
+
+        resources = item.get(FRECK_RESOURCES_KEY, None)
+        if resources is None:
+            item_dependencies.update(since_exclusive)
+            exclusive_item = i
+            since_exclusive = []
+            last_users = {}
+        else:
+            for resource in resources:
+                for used, last_user in last_users.iteritems():
+                    if resources_conflict(resource, used):
+                        item_dependencies.add(last_user)
+            for resource in resources:
+                last_users[resource] = i
+            since_exclusive.append(i)
+
+        for task_id in item.get(FRECK_DEPENDS_ON_KEY, []):
+            if task_id not in providers.keys():
+                log.debug("No task with id '{}' earlier in this run, ignoring dependency.".format(task_id))
+                continue
+            item_dependencies.update(providers[task_id])
+
+        if item.get(UNIQUE_TASK_ID_KEY, False):
+            providers.setdefault(item[UNIQUE_TASK_ID_KEY], []).append(i)
+
+        dependencies.append(item_dependencies)
+
+    return dependencies
+
+
+def create_run_plan(items):
+    """Splits the items of a run into stages that are executed one after the other, and every stage into branches that can be executed concurrently.
+
+    Stages are separated by items that don't declare the resources they use, those are executed on their own. Within a stage, every group of items that are connected by a dependency (see :func:`get_item_dependencies`) becomes a branch. The items of a branch, and the branches of a stage, keep the order of the run.
+
+    Args:
+        items (list): the run items, in the order they'd be executed serially
+
+    Returns:
+        list: a list of stages, each a list of branches, each a list of items
+    """
+
+    dependencies = get_item_dependencies(items)
+
+    # union-find, with the first item of a group as its root
+    groups = range(len(items))
+
+    def find(i):
+        while groups[i] != i:
+            groups[i] = groups[groups[i]]
+            i = groups[i]
+        return i
+
+    stage_start = 0
+    for i, item_dependencies in enumerate(dependencies):
+        if items[i].get(FRECK_RESOURCES_KEY, None) is None:
+            stage_start = i + 1
+            continue
+        for dependency in item_dependencies:
+            if dependency < stage_start:
+                # executed in an earlier stage
+                continue
+            root_1 = find(i)
+            root_2 = find(dependency)
+            groups[max(root_1, root_2)] = min(root_1, root_2)
+
+    stages = []
+    for i, item in enumerate(items):
+        exclusive = item.get(FRECK_RESOURCES_KEY, None) is None
+        # consecutive items that could use any resource are executed together, as a stage with a single branch
+        if not stages or stages[-1][0] != exclusive:
+            stages.append((exclusive, OrderedDict()))
+        branch = None if exclusive else find(i)
+        stages[-1][1].setdefault(branch, []).append(item)
+
+    return [branches.values() for exclusive, branches in stages]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import collections
+import glob
+import hashlib
+import importlib
+import json
+import logging
+import os
+import sys
+from exceptions import FrecklesConfigError
+
+from constants import *
+
+log = logging.getLogger("freckles")
+
+FRECKS_NAMESPACE = "freckles.frecks"
+
+INDEX_FINGERPRINT_KEY = "fingerprint"
+INDEX_ENTRY_POINTS_KEY = "entry_points"
+
+
+def get_path_fingerprint(paths=None):
+    """Returns a fingerprint of the python path that changes whenever a distribution is installed, removed or updated.
+
+    This uses the names of all distribution metadata folders (and eggs) on the path, and the modification times of their 'entry_points.txt' files.
+    """
+
+    if paths is None:
+        paths = sys.path
+
+    result = []
+    for path in paths:
+        path = os.path.abspath(path or os.curdir)
+        result.append(path)
+        if not os.path.isdir(path):
+            continue
+
+        metadata_dirs = [os.path.join(path, "EGG-INFO")]
+        for pattern in ["*.egg-info", "*.dist-info", "*.egg"]:
+            metadata_dirs.extend(sorted(glob.glob(os.path.join(path, pattern))))
+
+        for metadata_dir in metadata_dirs:
+            for entry_points_file in [os.path.join(metadata_dir, "entry_points.txt"), os.path.join(metadata_dir, "EGG-INFO", "entry_points.txt")]:
+                if os.path.exists(entry_points_file):
+                    result.append([entry_points_file, os.stat(entry_points_file).st_mtime])
+            result.append(os.path.basename(metadata_dir))
+
+    return hashlib.sha1(json.dumps(result)).hexdigest()
+
+
+def scan_entry_points(namespace=FRECKS_NAMESPACE):
+    """Scans all installed distributions for the entry points in a namespace.
+
+    Returns:
+        list: a list of (name, module_name, attrs) tuples
+    """
+
+    import pkg_resources
+
+    return [(ep.name, ep.module_name, list(ep.attrs)) for ep in pkg_resources.iter_entry_points(namespace)]
+
+
+class FreckRegistry(collections.Mapping):
+    """Registry of all available frecks, with the freck names as keys.
+
+    A freck is only imported and instantiated the first time it is accessed. The index of available frecks is read from a file that is only re-created (by scanning all installed distributions) when the python path changes (see :func:`get_path_fingerprint`).
+
+    Args:
+        entry_points (list): a list of (name, module_name, attrs) tuples, one for each freck
+    """
+
+    def __init__(self, entry_points):
+
+        # a plain dict on purpose: freck dispatch picks the first freck that can handle a task, and the
+        # iteration order of this dict is the one the previous (stevedore based) plugin dict had
+        self.entry_points = {name: (module_name, attrs) for name, module_name, attrs in entry_points}
+        self.plugins = {}
+
+    @staticmethod
+    def load(index_file=FRECKLES_DEFAULT_PLUGIN_INDEX_FILE, namespace=FRECKS_NAMESPACE):
+        """Creates the registry, using the cached index in 'index_file' if it is still valid."""
+
+        fingerprint = get_path_fingerprint()
+
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+            if index.get(INDEX_FINGERPRINT_KEY, None) == fingerprint:
+                log.debug("Using cached plugin index: {}".format(index_file))
+                return FreckRegistry(index[INDEX_ENTRY_POINTS_KEY])
+        except (IOError, ValueError, KeyError):
+            pass
+
+        log.debug("Scanning for plugins...")
+        entry_points = scan_entry_points(namespace)
+
+        try:
+            if not os.path.isdir(os.path.dirname(index_file)):
+                os.makedirs(os.path.dirname(index_file))
+            temp_file = "{}.{}".format(index_file, os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump({INDEX_FINGERPRINT_KEY: fingerprint, INDEX_ENTRY_POINTS_KEY: entry_points}, f)
+            os.rename(temp_file, index_file)
+        except (IOError, OSError) as e:
+            log.debug("Could not write plugin index: {}".format(e))
+
+        return FreckRegistry(entry_points)
+
+    def __getitem__(self, name):
+
+        if name not in self.plugins:
+            if name not in self.entry_points:
+                raise KeyError(name)
+            self.plugins[name] = self.load_plugin(name)
+
+        return self.plugins[name]
+
+    def __iter__(self):
+
+        return iter(self.entry_points)
+
+    def __len__(self):
+
+        return len(self.entry_points)
+
+    def __contains__(self, name):
+
+        return name in self.entry_points
+
+    def load_plugin(self, name):
+
+        module_name, attrs = self.entry_points[name]
+        log.debug("Loading freck '{}' ({}:{})".format(name, module_name, ".".join(attrs)))
+        try:
+            plugin = importlib.import_module(module_name)
+            for attr in attrs:
+                plugin = getattr(plugin, attr)
+            return plugin()
+        except Exception as e:
+            log.error("PLUGIN ERROR -> Could not load '{}': {}".format(name, e))
+            raise FrecklesConfigError("Can't load freck '{}': {}".format(name, e), TASK_NAME_KEY, name)
+
+    def is_loaded(self, name):
+
+        return name in self.plugins
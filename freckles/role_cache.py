@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from exceptions import FrecklesConfigError
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+from constants import *
+from utils import get_dir_hash
+
+log = logging.getLogger("freckles")
+
+ROLE_CACHE_REFS_DIR = "refs"
+ROLE_CACHE_OBJECTS_DIR = "objects"
+ROLE_CACHE_TEMP_DIR = "tmp"
+
+REF_SRC_KEY = "src"
+REF_VERSION_KEY = "version"
+REF_COMMIT_KEY = "commit"
+REF_OBJECT_KEY = "object"
+REF_CHECKED_KEY = "checked"
+
+# written by ansible-galaxy, contains the install date
+GALAXY_INSTALL_INFO_FILE = os.path.join("meta", ".galaxy_install_info")
+
+COMMIT_PATTERN = re.compile("^[0-9a-f]{7,40}$")
+
+
+def parse_role_url(role_url):
+    """Splits the url of an external role into its source and version (the format is '<src>[,<version>]', like in ansible-galaxy requirement files).
+
+    Returns:
+        tuple: the source and the version (or None)
+    """
+
+    if "," not in role_url:
+        return (role_url.strip(), None)
+
+    src, version = role_url.split(",", 1)
+    return (src.strip(), version.strip() or None)
+
+
+def is_git_src(src):
+    """Returns whether a role source is a git repository (which can be revalidated without downloading it)."""
+
+    return src.startswith("git+") or src.startswith("git@") or src.endswith(".git")
+
+
+def is_immutable(src, version):
+    """Returns whether a version of a role source always has the same content, so it never needs to be revalidated.
+
+    This is the case for a pinned version of a source that is not a git repository (like a release on ansible galaxy), and for a full commit id of a git repository (branches and tags can move).
+    """
+
+    if not version:
+        return False
+
+    if not is_git_src(src):
+        return True
+
+    return len(version) == 40 and COMMIT_PATTERN.match(version) is not None
+
+
+def get_remote_commit(src, version=None):
+    """Returns the commit a version (branch, tag or commit) of a git role source points to, without cloning the repository.
+
+    Returns:
+        str: the commit, or None if it can't be determined
+    """
+
+    url = src[4:] if src.startswith("git+") else src
+    ref = version if version else "HEAD"
+
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output(["git", "ls-remote", url, ref, "{}^{{}}".format(ref)], stderr=devnull)
+
+    commits = {}
+    for line in output.splitlines():
+        commit, name = line.split()
+        commits[name] = commit
+
+    # annotated tags point to a tag object, the commit is the 'peeled' one
+    for name in ["refs/tags/{}^{{}}".format(ref), "refs/heads/{}".format(ref), "refs/tags/{}".format(ref), ref]:
+        if name in commits:
+            return commits[name]
+
+    if version and COMMIT_PATTERN.match(version):
+        return version
+
+    return None
+
+
+def fetch_role(src, version, dest_dir):
+    """Downloads a role (using ansible-galaxy) into a directory.
+
+    Args:
+        src (str): the source of the role
+        version (str): the version of the role (None for the default one)
+        dest_dir (str): the directory to download the role into (in a sub-directory called 'role')
+
+    Returns:
+        str: the path of the downloaded role
+    """
+
+    requirement = {"name": "role", "src": src}
+    if version:
+        requirement["version"] = version
+
+    requirements_file = os.path.join(dest_dir, "requirements.yml")
+    with open(requirements_file, 'w') as f:
+        f.write(yaml.safe_dump([requirement], default_flow_style=False))
+    res = subprocess.check_output(["ansible-galaxy", "install", "-r", requirements_file, "--force", "--no-deps", "-p", dest_dir], stderr=subprocess.STDOUT)
+    for line in res.splitlines():
+        log.debug("Installing role: {}".format(line))
+
+    role_path = os.path.join(dest_dir, "role")
+    if not os.path.isdir(role_path):
+        raise FrecklesConfigError("Could not download role '{}': {}".format(src, res.strip()), "roles", src)
+
+    return role_path
+
+
+class RoleCache(object):
+    """Content-addressed on-disk cache for external ansible roles.
+
+    Downloaded roles are stored in a directory named after the hash of their content, and linked into the execution environments of runs from there (so runs, and users that use the same cache directory, share them). A reference for every source and version points to the content, together with the commit it was downloaded from, if the source is a git repository. References are used without revalidating them for 'max_age' seconds. After that, git sources are revalidated with 'git ls-remote', and only downloaded again if the commit changed. Other sources are downloaded again, but stored only once if the content didn't change. Pinned versions that can't change (see :func:`is_immutable`) are never revalidated, and if revalidating fails, the cached role is used.
+
+    Args:
+        cache_dir (str): the directory to store cached roles in
+        max_age (int): number of seconds a cached role is used without revalidating it (0 means always revalidate)
+        offline (bool): never access the network, only use cached roles
+        jobs (int): the number of roles to download at the same time
+
+    Attributes:
+        hits (int): number of roles that were served from the cache (including successful revalidations)
+        misses (int): number of roles that had to be downloaded
+    """
+
+    def __init__(self, cache_dir=FRECKLES_DEFAULT_ROLE_CACHE_DIR, max_age=0, offline=False, jobs=FRECKLES_DEFAULT_ROLE_DOWNLOAD_JOBS):
+
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.offline = offline
+        self.jobs = jobs
+
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_ref_file(self, src, version):
+
+        key = json.dumps([src, version])
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.cache_dir, ROLE_CACHE_REFS_DIR, "{}.json".format(hashlib.sha1(key).hexdigest()))
+
+    def get_object_path(self, object_key):
+
+        return os.path.join(self.cache_dir, ROLE_CACHE_OBJECTS_DIR, object_key)
+
+    def load_ref(self, src, version):
+        """Returns the reference for a role source and version, or None if there is none (or the content it points to is missing)."""
+
+        ref_file = self.get_ref_file(src, version)
+        if not os.path.exists(ref_file):
+            return None
+
+        try:
+            with open(ref_file) as f:
+                ref = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Ignoring invalid role cache reference '{}': {}".format(ref_file, e))
+            return None
+
+        if ref.get(REF_SRC_KEY, None) != src or ref.get(REF_VERSION_KEY, None) != version:
+            return None
+        if not os.path.isdir(self.get_object_path(ref.get(REF_OBJECT_KEY, ""))):
+            return None
+
+        return ref
+
+    def store_ref(self, src, version, commit, object_key):
+
+        ref = {
+            REF_SRC_KEY: src,
+            REF_VERSION_KEY: version,
+            REF_COMMIT_KEY: commit,
+            REF_OBJECT_KEY: object_key,
+            REF_CHECKED_KEY: time.time()
+        }
+
+        try:
+            ref_file = self.get_ref_file(src, version)
+            if not os.path.isdir(os.path.dirname(ref_file)):
+                os.makedirs(os.path.dirname(ref_file))
+            temp_file = "{}.{}.{}".format(ref_file, os.getpid(), threading.current_thread().ident)
+            with open(temp_file, 'w') as f:
+                json.dump(ref, f)
+            os.rename(temp_file, ref_file)
+        except (IOError, OSError) as e:
+            log.debug("Could not write role cache reference for '{}': {}".format(src, e))
+
+        return ref
+
+    def count(self, hit):
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def download(self, src, version):
+        """Downloads a role, and adds its content to the cache.
+
+        Returns:
+            str: the key of the content
+        """
+
+        temp_base_dir = os.path.join(self.cache_dir, ROLE_CACHE_TEMP_DIR)
+        if not os.path.isdir(temp_base_dir):
+            os.makedirs(temp_base_dir)
+        temp_dir = tempfile.mkdtemp(dir=temp_base_dir)
+        try:
+            role_path = fetch_role(src, version, temp_dir)
+            install_info = os.path.join(role_path, GALAXY_INSTALL_INFO_FILE)
+            if os.path.exists(install_info):
+                os.remove(install_info)
+
+            object_key = get_dir_hash(role_path)
+            object_path = self.get_object_path(object_key)
+            if not os.path.isdir(object_path):
+                if not os.path.isdir(os.path.dirname(object_path)):
+                    os.makedirs(os.path.dirname(object_path))
+                try:
+                    os.rename(role_path, object_path)
+                except OSError:
+                    # added by another process in the meantime
+                    if not os.path.isdir(object_path):
+                        raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return object_key
+
+    def get(self, role_url):
+        """Returns the path to the content of a role, downloading it if necessary.
+
+        Args:
+            role_url (str): the url of the role ('<src>[,<version>]')
+
+        Returns:
+            str: the path to the (read-only) role
+        """
+
+        return self.lookup(role_url)[0]
+
+    def lookup(self, role_url):
+        """Like :meth:`get`, but also returns whether the role had to be downloaded.
+
+        Returns:
+            tuple: the path to the role, and whether it was downloaded
+        """
+
+        src, version = parse_role_url(role_url)
+        git = is_git_src(src)
+        ref = self.load_ref(src, version)
+
+        if ref is not None:
+            age = time.time() - ref.get(REF_CHECKED_KEY, 0)
+            if self.offline or age < self.max_age or is_immutable(src, version):
+                log.debug("Using cached role (age: {}s): {}".format(int(age), role_url))
+                self.count(True)
+                return (self.get_object_path(ref[REF_OBJECT_KEY]), False)
+        elif self.offline:
+            raise FrecklesConfigError("Can't get role '{}': not cached, and running in offline mode.".format(role_url), "roles", role_url)
+
+        commit = None
+        if git:
+            try:
+                commit = get_remote_commit(src, version)
+            except (OSError, subprocess.CalledProcessError) as e:
+                if ref is not None:
+                    log.warning("Can't revalidate role '{}', using cached version: {}".format(role_url, e))
+                    self.count(True)
+                    return (self.get_object_path(ref[REF_OBJECT_KEY]), False)
+                log.debug("Can't determine commit of role '{}': {}".format(role_url, e))
+
+            if ref is not None and commit is not None and commit == ref.get(REF_COMMIT_KEY, None):
+                log.debug("Cached role still valid: {}".format(role_url))
+                self.store_ref(src, version, commit, ref[REF_OBJECT_KEY])
+                self.count(True)
+                return (self.get_object_path(ref[REF_OBJECT_KEY]), False)
+
+        try:
+            object_key = self.download(src, commit if commit else version)
+        except (subprocess.CalledProcessError, OSError, FrecklesConfigError) as e:
+            output = getattr(e, "output", None) or e
+            if ref is not None:
+                log.warning("Can't download role '{}', using cached version: {}".format(role_url, output))
+                self.count(True)
+                return (self.get_object_path(ref[REF_OBJECT_KEY]), False)
+            if isinstance(e, FrecklesConfigError):
+                raise
+            raise FrecklesConfigError("Can't download role '{}': {}".format(role_url, output), "roles", role_url)
+
+        self.count(False)
+        self.store_ref(src, version, commit, object_key)
+        return (self.get_object_path(object_key), True)
+
+    def get_roles(self, roles, report=None):
+        """Returns the paths to the contents of multiple roles, downloading the ones that are needed at the same time (at most 'jobs' of them).
+
+        Once a role can't be downloaded, no more downloads are started, and the error is raised as soon as the ones already in progress are finished.
+
+        Args:
+            roles (dict): the urls of the roles, with the role names as keys
+            report (function): optional function that is called with the name(s) and url of every role once it's available or failed, whether it was downloaded, the number of seconds it took, and the error (or None)
+
+        Returns:
+            dict: the paths to the roles, with the role names as keys
+        """
+
+        names = {}
+        for role_name, role_url in roles.iteritems():
+            names.setdefault(role_url, []).append(role_name)
+
+        failed = threading.Event()
+
+        def fetch(role_url):
+            if failed.is_set():
+                return (role_url, None, False, None, 0)
+            started = time.time()
+            try:
+                role_path, downloaded = self.lookup(role_url)
+                return (role_url, role_path, downloaded, None, time.time() - started)
+            except FrecklesConfigError as e:
+                failed.set()
+                return (role_url, None, False, e, time.time() - started)
+
+        role_urls = sorted(names.keys())
+        pool = None
+        if len(role_urls) <= 1 or self.jobs <= 1:
+            results = imap(fetch, role_urls)
+        else:
+            pool = ThreadPool(min(self.jobs, len(role_urls)))
+            results = pool.imap_unordered(fetch, role_urls)
+
+        role_paths = {}
+        try:
+            for role_url, role_path, downloaded, error, duration in results:
+                if role_path is None and error is None:
+                    # skipped because of an earlier error
+                    continue
+                if report is not None:
+                    report(sorted(names[role_url]), role_url, downloaded, duration, error)
+                if error is not None:
+                    raise error
+                role_paths[role_url] = role_path
+        finally:
+            if pool is not None:
+                failed.set()
+                pool.close()
+                pool.join()
+
+        return dict((role_name, role_paths[role_url]) for role_name, role_url in roles.iteritems())
+
+    def link_roles(self, roles, role_base_path, report=None):
+        """Makes external roles available in a directory, as links to the cached roles.
+
+        Args:
+            roles (dict): the urls of the roles, with the role names as keys
+            role_base_path (str): the directory to create the links in
+            report (function): optional function to report the status of every role with (see :meth:`get_roles`)
+        """
+
+        role_paths = self.get_roles(roles, report=report)
+
+        if not os.path.isdir(role_base_path):
+            os.makedirs(role_base_path)
+
+        for role_name, role_path in role_paths.iteritems():
+            log.debug("Linking external role: {} -> {}".format(role_path, role_name))
+            os.symlink(role_path, os.path.join(role_base_path, role_name))
+
+    def log_stats(self):
+
+        log.debug("Role cache: {} hit(s), {} miss(es)".format(self.hits, self.misses))
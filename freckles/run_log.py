@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+from constants import *
+
+log = logging.getLogger("freckles")
+
+RUN_LOG_TIMESTAMP_KEY = "timestamp"
+RUN_LOG_RUN_NR_KEY = "run_nr"
+RUN_LOG_FRECK_ID_KEY = "freck_id"
+RUN_LOG_EVENT_KEY = "event"
+
+
+class RunLogWriter(object):
+    """Writes the events of a run to a log file, one json object per line.
+
+    The file is opened once, when the first event is written, and events are buffered in memory until 'buffer_size' bytes are pending, 'flush_interval' seconds passed since the last write to the file, or the writer is closed (there is no background thread, so the interval is only checked when an event is written). Once closed, the log can be compressed with gzip, which replaces it with a file with the same name and a '.gz' extension.
+
+    Args:
+        log_file (str): the path of the log file (its parent directory is created if necessary)
+        run_nr (int): the number of the run, added to every event
+        buffer_size (int): the number of bytes to buffer before writing them to the file
+        flush_interval (int): the maximum number of seconds to buffer events
+        compress (bool): whether to compress the log once it's closed
+    """
+
+    def __init__(self, log_file, run_nr=None, buffer_size=FRECKLES_DEFAULT_RUN_LOG_BUFFER_SIZE, flush_interval=FRECKLES_DEFAULT_RUN_LOG_FLUSH_INTERVAL, compress=False):
+
+        self.log_file = log_file
+        self.run_nr = run_nr
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        # the path of the log once it's closed
+        self.final_log_file = "{}.gz".format(log_file) if compress else log_file
+
+        self.file = None
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = time.time()
+        self.closed = False
+
+    def write(self, freck_id, event):
+        """Adds an event (a dict of details reported by the runner, or a string like RUN_FINISHED) to the log."""
+
+        if self.closed:
+            log.debug("Run log '{}' already closed, ignoring event for freck '{}'".format(self.log_file, freck_id))
+            return
+
+        entry = {RUN_LOG_TIMESTAMP_KEY: time.time(), RUN_LOG_RUN_NR_KEY: self.run_nr, RUN_LOG_FRECK_ID_KEY: freck_id, RUN_LOG_EVENT_KEY: event}
+        line = json.dumps(entry, default=repr) + "\n"
+        self.buffer.append(line)
+        self.buffered_bytes = self.buffered_bytes + len(line)
+
+        if self.buffered_bytes >= self.buffer_size or entry[RUN_LOG_TIMESTAMP_KEY] - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered events to the log file."""
+
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+
+        if self.file is None:
+            log_dir = os.path.dirname(self.log_file)
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            self.file = open(self.log_file, "a")
+
+        self.file.write("".join(self.buffer))
+        self.file.flush()
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def close(self):
+        """Flushes and closes the log file, and compresses it if configured to do so. Events written after this are ignored."""
+
+        if self.closed:
+            return
+
+        self.flush()
+        self.closed = True
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+
+        if self.compress:
+            with open(self.log_file, "rb") as f_in:
+                with gzip.open(self.final_log_file, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.remove(self.log_file)
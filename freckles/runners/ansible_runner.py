@@ -11,17 +11,17 @@ import shutil
 import subprocess
 import sys
 from collections import OrderedDict, namedtuple
-from tempfile import NamedTemporaryFile
 
 import click
 import yaml
 
-from cookiecutter.main import cookiecutter
+from freckles import __version__ as VERSION
 from freckles.constants import *
 from freckles.exceptions import FrecklesConfigError, FrecklesRunError
 from freckles.freckles_runner import FrecklesRunner
+from freckles.role_cache import RoleCache
 from freckles.utils import (can_passwordless_sudo, check_schema, dict_merge,
-                            playbook_needs_sudo)
+                            get_dir_hash, merge_dicts, playbook_needs_sudo)
 from sets import Set
 from voluptuous import Any, Schema
 
@@ -57,6 +57,10 @@ FRECK_META_ROLE_KEY = "role"
 FRECK_META_TASKS_KEY = "tasks"
 FRECK_META_ROLE_DICT_KEY = "role_dict"
 
+FRECKLES_INTERNAL_ROLES_PATH = os.path.join(os.path.dirname(__file__), "..", "ansible", "external_roles")
+FRECKLES_PLAY_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "..", "cookiecutter", "external_templates", "cookiecutter-freckles-play")
+FRECKLES_PLAY_TEMPLATE_DIR_NAME = "{{cookiecutter.execution_dir}}"
+
 def create_inventory_dir(hosts, inventory_dir, group_name=FRECKLES_DEFAULT_GROUP_NAME):
 
         group_base_dir = os.path.join(inventory_dir, "group_vars")
@@ -87,13 +91,10 @@ def create_playbook_dict(playbook_items, host_group=FRECKLES_DEFAULT_GROUP_NAME)
 
     roles = []
     for p in playbook_items:
-            role_dict = copy.deepcopy(p[FRECK_META_ROLE_DICT_KEY])
             id = p[FRECK_ID_KEY]
-            role_dict[FRECK_ID_KEY] = id
             become = p.get(FRECK_SUDO_KEY, FRECK_DEFAULT_SUDO)
-            role_dict[FRECK_SUDO_KEY] = become
             vars = p[FRECK_VARS_KEY]
-            dict_merge(role_dict, vars)
+            role_dict = merge_dicts(p[FRECK_META_ROLE_DICT_KEY], {FRECK_ID_KEY: id, FRECK_SUDO_KEY: become}, vars)
             roles.append(role_dict)
 
     temp_root["roles"] = roles
@@ -136,12 +137,60 @@ def extract_ansible_roles(playbook_items):
 
     return roles
 
-def copy_internal_roles(playbook_items, role_base_path):
-    """Copies included roles to playbook environment.
+def get_internal_role_cache_dir(role_path, cache_base_dir=FRECKLES_DEFAULT_INTERNAL_ROLE_CACHE_DIR, versioned=False):
+    """Returns the directory that contains a snapshot of an internal role, creating it if necessary.
+
+    Snapshots are named after the role and either the version of freckles (for roles that are packaged with it, which only change together with the version), or the hash of its content, so they never change once created, and runs (including archived ones) can link to them, even after freckles was upgraded or the bundle a role came from was removed.
+
+    Args:
+        role_path (str): the path to the internal role
+        cache_base_dir (str): the directory containing the snapshots
+        versioned (bool): whether the role is packaged with freckles, so its content doesn't need to be hashed
 
-    If the url of the role starts with 'frkl:', it is assumed it is an internally supported role, and will be copied to the 'internal' role path in the playbook environment.
+    Returns:
+        str: the path to the snapshot
     """
 
+    role_name = os.path.basename(os.path.normpath(role_path))
+    if versioned:
+        cache_dir = os.path.join(cache_base_dir, "{}_v{}".format(role_name, VERSION))
+    else:
+        cache_dir = os.path.join(cache_base_dir, "{}_{}".format(role_name, get_dir_hash(role_path)))
+    if os.path.isdir(cache_dir):
+        return cache_dir
+
+    log.debug("Creating internal role snapshot: {}".format(cache_dir))
+    temp_dir = "{}.{}".format(cache_dir, os.getpid())
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    shutil.copytree(role_path, temp_dir, symlinks=True)
+
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        # created by another process in the meantime
+        if not os.path.isdir(cache_dir):
+            raise
+        shutil.rmtree(temp_dir)
+
+    return cache_dir
+
+def link_internal_roles(playbook_items, role_base_path, internal_roles_path=FRECKLES_INTERNAL_ROLES_PATH, cache_base_dir=FRECKLES_DEFAULT_INTERNAL_ROLE_CACHE_DIR):
+    """Links included roles into the playbook environment.
+
+    If the url of the role starts with 'frkl:', it is assumed it is an internally supported role, and will be linked into the 'internal' role path in the playbook environment, from a snapshot of it (see :func:`get_internal_role_cache_dir`). Internal roles are never changed by a run, roles that are generated for a run (see :func:`create_custom_roles`) are written into its environment directly.
+
+    The roles that are packaged with freckles are only hashed in develop mode (if 'FRECKLES_DEVELOP' is set), roles from other directories (like the ones of a bundle) always are.
+
+    Args:
+        playbook_items (list): all the items that are to be executed
+        role_base_path (str): the directory to link the roles into
+        internal_roles_path (str): the directory that contains the internal roles
+        cache_base_dir (str): the directory containing the snapshots of internal roles
+    """
+
+    versioned = not FRECKLES_DEVELOP_ROLE_PATH and os.path.realpath(internal_roles_path) == os.path.realpath(FRECKLES_INTERNAL_ROLES_PATH)
+
     role_urls = Set()
     for item in playbook_items:
         item_roles = item.get(FRECK_META_ROLES_KEY, {})
@@ -150,12 +199,45 @@ def copy_internal_roles(playbook_items, role_base_path):
                 if role_url_or_dict.startswith("frkl:"):
                     role_urls.add((role_name, role_url_or_dict))
 
+    if role_urls and not os.path.isdir(role_base_path):
+        os.makedirs(role_base_path)
+
     for role_internal_name in role_urls:
         frkl_role_name = role_internal_name[1][5:]
-        role_path = os.path.join(os.path.dirname(__file__), "..", "ansible", "external_roles", frkl_role_name)
+        role_path = get_internal_role_cache_dir(os.path.join(internal_roles_path, frkl_role_name), cache_base_dir, versioned=versioned)
         dest = os.path.join(role_base_path, role_internal_name[0])
-        log.debug("Copying internal roles: {} -> {}".format(role_path, dest))
-        shutil.copytree(role_path, dest)
+        log.debug("Linking internal role: {} -> {}".format(role_path, dest))
+        os.symlink(role_path, dest)
+
+def report_role_status(role_names, role_url, downloaded, duration, error):
+    """Prints the status of an external role once it's available, if it had to be downloaded or couldn't be."""
+
+    if error is not None:
+        output = getattr(error, "output", None) or error
+        click.echo("Failed to get external role '{}' after {:.1f}s: {}".format(", ".join(role_names), duration, str(output).strip()))
+    elif downloaded:
+        click.echo("Downloaded external role '{}' ({:.1f}s)".format(", ".join(role_names), duration))
+    else:
+        log.debug("Using cached external role '{}' ({:.1f}s)".format(", ".join(role_names), duration))
+
+def copy_external_roles(roles, source_path, role_base_path):
+    """Copies previously downloaded external roles (e.g. from a bundle) into a run environment.
+
+    Args:
+        roles (dict): the urls of the roles that are needed, with the role names as keys
+        source_path (str): the directory that contains the downloaded roles
+        role_base_path (str): the directory to copy the roles to
+    """
+
+    for role_name in roles.keys():
+        role_path = os.path.join(source_path, role_name)
+        if not os.path.isdir(role_path):
+            raise FrecklesConfigError("Role '{}' is not available offline (url: {})".format(role_name, roles[role_name]), FRECK_META_ROLES_KEY, roles[role_name])
+        dest = os.path.join(role_base_path, role_name)
+        log.debug("Copying external role: {} -> {}".format(role_path, dest))
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(role_path, dest, symlinks=True)
 
 def internal_role_exists():
 
@@ -167,23 +249,29 @@ def create_custom_roles(playbook_items, role_base_path):
 
     If one of the roles in one of the playbook items is a list instead of a string, it is assumed that it is a list of task descriptions (see: XXX) and a custom role is generated dynamically.
 
-    If that is the case, the role_name will not be included in the result, since that role doesn't need to be downloaded, and the internal role path that contains the role is already included in the ansible path.
+    If that is the case, the role_name will not be included in the result, since that role doesn't need to be downloaded, and the internal role path that contains the role is already included in the ansible path. Items can share a generated role (the values of its variables are role parameters of the item), in which case it is only created once.
 
     Args:
         playbook_items (list): all the items that are to be executed
         role_base_path (str): base directory where the role should be created
     """
 
+    created = Set()
     for item in playbook_items:
         item_roles = item.get(FRECK_META_ROLES_KEY, {})
         for role_name, role_url_or_dict in item_roles.iteritems():
             if not isinstance(role_url_or_dict, basestring) and isinstance(role_url_or_dict, (list, tuple)):
+                if role_name in created:
+                    continue
                 create_custom_role(role_base_path, role_name, role_url_or_dict)
+                created.add(role_name)
 
 
 def create_custom_role(role_base_path, role_name, tasks, defaults={}):
     """Creates a ansible role in the specified location.
 
+    The role is written directly, with the same content the 'ansible-role-template' cookiecutter template would create: every task uses the variables that are listed for it, which are expected to be provided as role parameters.
+
     Args:
         role_path (str): the base path where the role will be created
         role_name (str): the name of the role
@@ -191,43 +279,119 @@ def create_custom_role(role_base_path, role_name, tasks, defaults={}):
         defaults (dict): a dictionary of the default variables for this role
     """
 
-    # need to convert tasks dictionary so that it works with the template
-    tasks_dict = OrderedDict()
-    # tasks_dict = {}
+    role_tasks = {}
     for task in tasks:
         task_id_element = task["task"]
         if len(task_id_element["vars"]) != 1:
             raise FrecklesConfigError("Task element in task description has more than one entries, not valid: {}".format(task_id_element), "task", task)
 
         task_id = task_id_element["vars"].keys()[0]
-        task_vars = task_id_element["vars"][task_id]
-        become = task_id_element["become"]
+        task_vars = list(task_id_element["vars"][task_id])
+        become = task_id_element[TASK_BECOME_KEY]
+        ansible_module = task["type"]
+
+        role_task = {"name": task_id, "become": become, "ignore_errors": "{{ ignore_errors | default('yes') }}"}
+        if TASK_FREE_FORM_KEY in task_vars:
+            task_vars.remove(TASK_FREE_FORM_KEY)
+            role_task[ansible_module] = "{{ free_form }}"
+        else:
+            role_task[ansible_module] = None
+        role_task["args"] = dict((arg, "{{{{ {} | default(omit) }}}}".format(arg)) for arg in task_vars)
+        role_tasks[task_id] = role_task
 
-        name = task["name"]
-        task_type = task["type"]
+    role_path = os.path.join(role_base_path, role_name)
+    os.makedirs(os.path.join(role_path, "tasks"))
+    os.makedirs(os.path.join(role_path, "defaults"))
+    with open(os.path.join(role_path, "tasks", "main.yml"), 'w') as f:
+        f.write(yaml.safe_dump([role_tasks[task_id] for task_id in sorted(role_tasks.keys())], default_flow_style=False))
+    with open(os.path.join(role_path, "defaults", "main.yml"), 'w') as f:
+        f.write(yaml.safe_dump(defaults, default_flow_style=False))
 
-        tasks_dict[task_id] = {task_type: {"vars": task_vars, "become": become}}
 
-    current_dir = os.getcwd()
-    os.chdir(role_base_path)
+def is_templated_file(path):
+    """Returns whether a file of the play template uses template variables (and has to be rendered for every run)."""
 
-    rearranged_tasks = {}
-    for task, task_detail in tasks_dict.iteritems():
-            ansible_module = task_detail.keys()[0]
-            become = task_detail[ansible_module][TASK_BECOME_KEY]
-            if TASK_FREE_FORM_KEY in task_detail[ansible_module]["vars"]:
-                task_detail[ansible_module]["vars"].remove(TASK_FREE_FORM_KEY)
-                new_dict = {"module_name": ansible_module, "args": task_detail[ansible_module]["vars"], "become": become, "free_form": True}
-                rearranged_tasks[task] = new_dict
-            else:
-                ansible_module = task_detail.keys()[0]
-                rearranged_tasks[task] = {"module_name": ansible_module, "args": task_detail[ansible_module]["vars"], "become": become, "free_form": False}
+    with open(path) as f:
+        return "cookiecutter." in f.read()
+
+
+def get_environment_cache_dir(template_path=FRECKLES_PLAY_TEMPLATE_PATH, cache_base_dir=FRECKLES_DEFAULT_ENVIRONMENT_CACHE_DIR):
+    """Returns the directory that contains the static files of the play template, creating it if necessary.
+
+    The static files (the ones that don't use template variables, like the setup scripts and bin wrappers) are the same for every run, so they are copied into the cache only once per freckles version and template content, and linked into the execution environments from there.
+
+    Args:
+        template_path (str): the path to the (cookiecutter) play template
+        cache_base_dir (str): the directory containing the cached environments
+
+    Returns:
+        str: the path to the cached static files
+    """
+
+    template_dir = os.path.join(template_path, FRECKLES_PLAY_TEMPLATE_DIR_NAME)
+    cache_dir = os.path.join(cache_base_dir, "{}_{}".format(VERSION, get_dir_hash(template_path)))
+    if os.path.isdir(cache_dir):
+        return cache_dir
+
+    log.debug("Creating execution environment cache: {}".format(cache_dir))
+    temp_dir = "{}.{}".format(cache_dir, os.getpid())
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    for root, dirs, files in os.walk(template_dir):
+        rel_root = os.path.relpath(root, template_dir)
+        os.makedirs(os.path.normpath(os.path.join(temp_dir, rel_root)))
+        for name in files:
+            if not is_templated_file(os.path.join(root, name)):
+                shutil.copy2(os.path.join(root, name), os.path.join(temp_dir, rel_root, name))
+
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        # created by another process in the meantime
+        if not os.path.isdir(cache_dir):
+            raise
+        shutil.rmtree(temp_dir)
+
+    return cache_dir
 
-    role_dict = {"role_name": role_name, "tasks": rearranged_tasks, "defaults": defaults}
-    role_local_path = os.path.join(os.path.dirname(__file__), "..", "cookiecutter", "external_templates", "ansible-role-template")
 
-    cookiecutter(role_local_path, extra_context=role_dict, no_input=True)
-    os.chdir(current_dir)
+def create_execution_environment(execution_dir, template_details, template_path=FRECKLES_PLAY_TEMPLATE_PATH, cache_base_dir=FRECKLES_DEFAULT_ENVIRONMENT_CACHE_DIR):
+    """Creates the directory structure of the play template in an execution directory.
+
+    Static files are symlinked from the cache (see :func:`get_environment_cache_dir`), files that use template variables are rendered in-process, the same way cookiecutter would render them.
+
+    Args:
+        execution_dir (str): the directory to create (must not exist)
+        template_details (dict): the values of the template variables (missing ones are taken from the template's defaults)
+        template_path (str): the path to the (cookiecutter) play template
+        cache_base_dir (str): the directory containing the cached environments
+    """
+
+    from jinja2 import Environment, StrictUndefined
+
+    cache_dir = get_environment_cache_dir(template_path, cache_base_dir)
+    template_dir = os.path.join(template_path, FRECKLES_PLAY_TEMPLATE_DIR_NAME)
+
+    with open(os.path.join(template_path, "cookiecutter.json")) as f:
+        context = json.load(f, object_pairs_hook=OrderedDict)
+    context.update(template_details)
+    env = Environment(keep_trailing_newline=True, undefined=StrictUndefined)
+
+    for root, dirs, files in os.walk(template_dir):
+        rel_root = os.path.relpath(root, template_dir)
+        os.makedirs(os.path.normpath(os.path.join(execution_dir, rel_root)))
+        for name in files:
+            source = os.path.join(root, name)
+            dest = os.path.join(execution_dir, rel_root, name)
+            if not is_templated_file(source):
+                os.symlink(os.path.join(cache_dir, rel_root, name), dest)
+                continue
+            with open(source) as f:
+                content = env.from_string(f.read().decode('utf-8')).render(cookiecutter=context)
+            with open(dest, 'w') as f:
+                f.write(content.encode('utf-8'))
+            shutil.copymode(source, dest)
+
 
 ANSIBLE_FRECK_SCHEMA = Schema({
         FRECK_NAME_KEY: basestring,
@@ -236,6 +400,7 @@ ANSIBLE_FRECK_SCHEMA = Schema({
         FRECK_SUDO_KEY: bool,
         FRECK_VARS_KEY: dict,
         FRECK_ITEM_NAME_KEY: basestring,
+        FRECK_BATCH_ITEMS_KEY: list,
         FRECK_META_ROLE_DICT_KEY: dict,
         FRECK_META_TASKS_KEY: dict,
         FRECK_INDEX_KEY: int,
@@ -247,7 +412,11 @@ ANSIBLE_FRECK_SCHEMA = Schema({
         FRECK_META_ROLES_KEY: dict,
         FRECK_META_ROLE_KEY: basestring,
         ANSIBLE_ROLE_PROCESSED: bool,
-        UNIQUE_TASK_ID_KEY: basestring
+        UNIQUE_TASK_ID_KEY: basestring,
+        FRECK_RESOURCES_KEY: list,
+        FRECK_DEPENDS_ON_KEY: list,
+        FRECK_REMOTE_STATE_KEY: bool,
+        FRECK_CHANGES_HOST_FACTS_KEY: bool
 })
 
 class AnsibleRunner(FrecklesRunner):
@@ -256,7 +425,7 @@ class AnsibleRunner(FrecklesRunner):
     This is the default runner, and there might never be a different type. Just abstracted it because it was easy to do at this stage, and it might prove useful later on.
     """
 
-    def __init__(self, items, callback):
+    def __init__(self, items, callback, roles_dir=None, execution_dir_name=None, execution_base_dir=None, role_cache=None):
         # TODO: validate items
         for item in items:
                 check_schema(item, ANSIBLE_FRECK_SCHEMA)
@@ -264,7 +433,11 @@ class AnsibleRunner(FrecklesRunner):
         self.items = items
 
         self.callback = callback
-        self.create_playbook_environment()
+        # if set, roles are only taken from here (in the 'internal' and 'external' sub-folders), nothing is downloaded
+        self.roles_dir = roles_dir
+        # otherwise, external roles are linked from this cache (downloading them into it if necessary)
+        self.role_cache = role_cache if role_cache is not None else RoleCache()
+        self.create_playbook_environment(execution_base_dir=execution_base_dir, execution_dir_name=execution_dir_name)
 
 
     def create_playbook_environment(self, execution_base_dir=None, execution_dir_name=None, hosts=None):
@@ -347,14 +520,14 @@ class AnsibleRunner(FrecklesRunner):
             }
         log.debug("Creating build environment from template...")
         log.debug("Using cookiecutter details: {}".format(cookiecutter_details))
-
-        play_template_path = os.path.join(os.path.dirname(__file__), "..", "cookiecutter", "external_templates", "cookiecutter-freckles-play")
-
-        cookiecutter(play_template_path, extra_context=cookiecutter_details, no_input=True)
+        create_execution_environment(self.execution_dir, cookiecutter_details)
 
         # create custom & internal roles
         create_custom_roles(self.items, os.path.join(self.execution_dir, "roles", "internal"))
-        copy_internal_roles(self.items, os.path.join(self.execution_dir, "roles", "internal"))
+        if self.roles_dir:
+            link_internal_roles(self.items, os.path.join(self.execution_dir, "roles", "internal"), os.path.join(self.roles_dir, "internal"))
+        else:
+            link_internal_roles(self.items, os.path.join(self.execution_dir, "roles", "internal"))
 
         log.debug("Creating and writing inventory...")
         create_inventory_dir(self.hosts, self.inventory_dir)
@@ -366,11 +539,13 @@ class AnsibleRunner(FrecklesRunner):
             f.write(yaml.safe_dump([playbook_dict], default_flow_style=False))
 
         # ext_role_path = os.path.join(self.execution_dir, "roles", "external")
-        if self.roles:
-            click.echo("Downloading and installing external roles...")
-            res = subprocess.check_output([os.path.join(self.execution_dir, "extensions", "setup", "role_update.sh")])
-            for line in res.splitlines():
-                log.debug("Installing role: {}".format(line.encode('utf8')))
+        if self.roles and self.roles_dir:
+            log.debug("Copying external roles from: {}".format(self.roles_dir))
+            copy_external_roles(self.roles, os.path.join(self.roles_dir, "external"), os.path.join(self.execution_dir, "roles", "external"))
+        elif self.roles:
+            log.debug("Linking external roles from cache: {}".format(self.role_cache.cache_dir))
+            self.role_cache.link_roles(self.roles, os.path.join(self.execution_dir, "roles", "external"), report=report_role_status)
+            self.role_cache.log_stats()
 
 
     def run(self):
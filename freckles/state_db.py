@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+from constants import *
+from runners.ansible_runner import (FRECK_META_ROLE_DICT_KEY,
+                                    FRECK_META_ROLES_KEY,
+                                    FRECK_META_TASKS_KEY,
+                                    FRECKLES_INTERNAL_ROLES_PATH)
+from utils import get_dir_hash
+
+from . import __version__ as VERSION
+
+log = logging.getLogger("freckles")
+
+STATE_DB_VERSION_KEY = "version"
+STATE_DB_HOSTS_KEY = "hosts"
+STATE_ENTRY_STATE_KEY = "state"
+STATE_ENTRY_TIMESTAMP_KEY = "timestamp"
+
+# keys of a run item that don't change what it does: its position in the run, how it's displayed, and how it's planned
+ITEM_STATE_IGNORED_KEYS = [FRECK_ID_KEY, FRECK_DESC_KEY, FRECK_ITEM_NAME_KEY, FRECK_BATCH_ITEMS_KEY, FRECK_RESOURCES_KEY, FRECK_DEPENDS_ON_KEY, FRECK_REMOTE_STATE_KEY, FRECK_CHANGES_HOST_FACTS_KEY]
+# keys of a run item that are generated from its other keys, if it has generated tasks
+ITEM_STATE_GENERATED_KEYS = [FRECK_META_TASKS_KEY, FRECK_META_ROLE_DICT_KEY]
+
+
+class StateDB(object):
+    """Persisted hashes of the desired state of run items, together with the outcome of their last execution, per host.
+
+    This is used to skip items that were executed successfully before, and didn't change since (see the '--incremental' option of 'freckles apply'). The hash of an item covers its task name, vars and roles (including the content of internal roles), but not the state of the target or of remote sources (items that depend on those are never skipped), so a successful outcome is only used for 'max_age' seconds. After that the item is applied again, which also corrects changes that were made outside of freckles.
+
+    Args:
+        db_file (str): the file to persist the state in (None to not persist it)
+        max_age (int): the number of seconds a successful outcome is used
+        host (str): the host the items are applied to (default: this machine)
+    """
+
+    def __init__(self, db_file=FRECKLES_DEFAULT_STATE_DB_FILE, max_age=FRECKLES_DEFAULT_STATE_DB_MAX_AGE, host=None):
+
+        self.db_file = db_file
+        self.max_age = max_age
+        self.host = host if host else socket.gethostname()
+        self.entries = None
+        self.role_hashes = {}
+
+    def load_db(self):
+
+        if not self.db_file or not os.path.exists(self.db_file):
+            return {}
+
+        try:
+            with open(self.db_file) as f:
+                db = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Ignoring invalid state db '{}': {}".format(self.db_file, e))
+            return {}
+
+        if db.get(STATE_DB_VERSION_KEY, None) != VERSION:
+            log.debug("State db: created by a different version of freckles, ignoring it")
+            return {}
+
+        return db.get(STATE_DB_HOSTS_KEY, {})
+
+    def get_entries(self):
+        """Returns the entries for this host, loading them if necessary."""
+
+        if self.entries is None:
+            self.entries = self.load_db().get(self.host, {})
+
+        return self.entries
+
+    def store(self):
+        """Persists the entries for this host, and removes the expired entries of all hosts."""
+
+        if not self.db_file or self.entries is None:
+            return
+
+        hosts = self.load_db()
+        hosts[self.host] = self.entries
+        now = time.time()
+        for host, entries in hosts.items():
+            hosts[host] = dict((item_hash, entry) for item_hash, entry in entries.iteritems() if now - entry.get(STATE_ENTRY_TIMESTAMP_KEY, 0) <= self.max_age)
+
+        try:
+            db_dir = os.path.dirname(self.db_file)
+            if not os.path.isdir(db_dir):
+                os.makedirs(db_dir)
+            temp_file = "{}.{}".format(self.db_file, os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump({STATE_DB_VERSION_KEY: VERSION, STATE_DB_HOSTS_KEY: hosts}, f)
+            os.rename(temp_file, self.db_file)
+        except (IOError, OSError) as e:
+            log.debug("Could not write state db: {}".format(e))
+
+    def get_role_hash(self, role_url, internal_roles_path=FRECKLES_INTERNAL_ROLES_PATH):
+        """Returns a hash of the content of an internal role, or the url of an external one (which isn't downloaded yet)."""
+
+        if not isinstance(role_url, basestring) or not role_url.startswith("frkl:"):
+            return role_url
+
+        role_path = os.path.join(internal_roles_path, role_url[5:])
+        if role_path not in self.role_hashes.keys():
+            self.role_hashes[role_path] = get_dir_hash(role_path)
+
+        return self.role_hashes[role_path]
+
+    def get_item_hash(self, item, internal_roles_path=FRECKLES_INTERNAL_ROLES_PATH):
+        """Returns the hash of the desired state of a run item.
+
+        This has to be called before the item is given to a runner, which might change it.
+        """
+
+        ignored_keys = list(ITEM_STATE_IGNORED_KEYS)
+        if FRECK_META_TASKS_KEY in item.keys():
+            ignored_keys.extend(ITEM_STATE_GENERATED_KEYS)
+        state = dict((key, value) for key, value in item.iteritems() if key not in ignored_keys)
+
+        roles = dict((name, self.get_role_hash(url, internal_roles_path)) for name, url in item.get(FRECK_META_ROLES_KEY, {}).iteritems())
+
+        # task template keys are a set
+        key = json.dumps([VERSION, state, roles], sort_keys=True, default=lambda o: sorted(o) if hasattr(o, "__iter__") else repr(o))
+        return hashlib.sha1(key).hexdigest()
+
+    def is_unchanged(self, item_hash):
+        """Returns whether the item with this hash was executed successfully less than 'max_age' seconds ago."""
+
+        entry = self.get_entries().get(item_hash, None)
+        if entry is None:
+            return False
+
+        return time.time() - entry.get(STATE_ENTRY_TIMESTAMP_KEY, 0) <= self.max_age
+
+    def record(self, item_hash, state):
+        """Records the outcome of executing the item with this hash (only successful outcomes are kept)."""
+
+        if state == FRECKLES_STATE_FAILED:
+            self.get_entries().pop(item_hash, None)
+        else:
+            self.get_entries()[item_hash] = {STATE_ENTRY_STATE_KEY: state, STATE_ENTRY_TIMESTAMP_KEY: time.time()}
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import collections
 import copy
+import hashlib
 import json
 import logging
 import os
@@ -15,7 +16,7 @@ import yaml
 
 from constants import *
 from constants import FRECKLES_METADATA_FILENAME
-from stevedore import extension
+from plugin_registry import FreckRegistry
 from voluptuous import Schema
 
 log = logging.getLogger("freckles")
@@ -41,6 +42,13 @@ class CursorOff(object):
 
 
 
+class UnaliasedDumper(yaml.Dumper):
+    """Yaml dumper that writes objects that are referenced more than once (like the values leafs share) in full every time, instead of using anchors and aliases."""
+
+    def ignore_aliases(self, data):
+        return True
+
+
 def dict_merge(dct, merge_dct):
     """ Recursive dict merge. Inspired by :meth:``dict.update()``, instead of
     updating only top-level keys, dict_merge recurses down into dicts nested
@@ -62,6 +70,183 @@ def dict_merge(dct, merge_dct):
             dct[k] = merge_dct[k]
 
 
+class LayeredDict(collections.MutableMapping):
+    """Merged view on a list of dicts, with the same semantics as calling :func:`dict_merge` on them in order (later layers take precedence).
+
+    The layers are neither copied nor modified. Nested dicts are returned as LayeredDict views themselves, so lookups only touch the keys that are actually requested. Writes (and deletes) only affect the view: they are stored in an overlay on top of the layers (like a ChainMap). Values that aren't dicts are returned as they are, so they should not be changed in place.
+
+    Use :func:`materialize` to get a plain, independent dict out of a view.
+
+    Args:
+        *layers: the dicts to merge, in order
+    """
+
+    def __init__(self, *layers):
+
+        self.layers = [l for l in layers if l]
+        self.overrides = {}
+        self.children = {}
+        self.hidden = set()
+
+    def resolve(self, key):
+        """Returns a tuple (value, dicts): either the (non-dict) value for a key, or the list of dicts that need to be merged for it."""
+
+        dicts = []
+        for layer in reversed(self.layers):
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not isinstance(value, collections.Mapping):
+                if not dicts:
+                    return (value, None)
+                # replaces everything below
+                break
+            dicts.append(value)
+
+        if not dicts:
+            raise KeyError(key)
+
+        dicts.reverse()
+        return (None, dicts)
+
+    def __getitem__(self, key):
+
+        if key in self.overrides:
+            return self.overrides[key]
+        if key in self.hidden:
+            raise KeyError(key)
+        if key in self.children:
+            return self.children[key]
+
+        value, dicts = self.resolve(key)
+        if dicts is None:
+            return value
+
+        child = LayeredDict(*dicts)
+        self.children[key] = child
+        return child
+
+    def __setitem__(self, key, value):
+
+        self.overrides[key] = value
+        self.children.pop(key, None)
+        self.hidden.discard(key)
+
+    def __delitem__(self, key):
+
+        if key not in self:
+            raise KeyError(key)
+        self.overrides.pop(key, None)
+        self.children.pop(key, None)
+        self.hidden.add(key)
+
+    def __contains__(self, key):
+
+        if key in self.overrides:
+            return True
+        if key in self.hidden:
+            return False
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+
+        seen = set()
+        for mapping in self.layers + [self.overrides]:
+            for key in mapping:
+                if key in seen or key not in self:
+                    continue
+                seen.add(key)
+                yield key
+
+    def __len__(self):
+
+        return sum(1 for key in self)
+
+    def __repr__(self):
+
+        return "LayeredDict({})".format(self.materialize())
+
+    def materialize(self):
+        """Returns the merged content of this view as plain dict, sharing nothing with the layers."""
+
+        result = merge_layers(self.layers)
+        for key in self.hidden:
+            result.pop(key, None)
+        for key, child in self.children.iteritems():
+            result[key] = child.materialize()
+        for key, value in self.overrides.iteritems():
+            result[key] = materialize(value)
+
+        return result
+
+
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+def merge_layers(layers):
+    """Merges a list of dicts (in order) into a new dict, copying only the values that end up in the result."""
+
+    result = {}
+    # dicts to merge for a key, highest precedence first
+    pending = {}
+    done = set()
+    for layer in reversed(layers):
+        for key, value in layer.iteritems():
+            if key in done:
+                continue
+            # (checking for 'dict' first is a lot faster than the abc check)
+            if isinstance(value, dict) or isinstance(value, collections.Mapping):
+                pending.setdefault(key, []).append(value)
+                continue
+            # replaces everything below
+            done.add(key)
+            if key not in pending:
+                result[key] = value if isinstance(value, IMMUTABLE_TYPES) else materialize(value)
+
+    for key, dicts in pending.iteritems():
+        if len(dicts) == 1 and type(dicts[0]) is dict:
+            result[key] = copy.deepcopy(dicts[0])
+        else:
+            dicts.reverse()
+            result[key] = merge_layers(dicts)
+
+    return result
+
+
+def materialize(value):
+    """Returns an independent copy of a value, with all :class:`LayeredDict` views (also nested ones) converted to plain dicts."""
+
+    if isinstance(value, LayeredDict):
+        return value.materialize()
+    elif isinstance(value, collections.Mapping):
+        return merge_layers([value])
+    else:
+        return copy.deepcopy(value)
+
+
+def merge_dicts(*dicts):
+    """Returns a new dict that contains the merged content of all provided dicts (in order), without changing any of them."""
+
+    return LayeredDict(*dicts).materialize()
+
+
+def get_dir_hash(path):
+    """Returns a hash of the names and contents of all files in a directory (recursively)."""
+
+    result = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            result.update(os.path.relpath(file_path, path))
+            result.update("\0")
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as f:
+                    result.update(hashlib.sha1(f.read()).hexdigest())
+            result.update("\0")
+
+    return result.hexdigest()
+
+
 def check_schema(value, schema):
 
     schema(value)
@@ -273,24 +458,16 @@ def get_pkg_mgr_from_path(p):
         return False
 
 def load_extensions():
-    """Loads all the extensions that can be found."""
+    """Returns all the extensions that can be found.
 
-    log2 = logging.getLogger("stevedore")
-    out_hdlr = logging.StreamHandler(sys.stdout)
-    out_hdlr.setFormatter(logging.Formatter('PLUGIN ERROR -> %(message)s'))
-    out_hdlr.setLevel(logging.DEBUG)
-    log2.addHandler(out_hdlr)
-    log2.setLevel(logging.INFO)
+    The result is a :class:`~freckles.plugin_registry.FreckRegistry`, which only imports an extension once it is used.
+    """
 
     log.debug("Loading extensions...")
-    mgr = extension.ExtensionManager(
-        namespace='freckles.frecks',
-        invoke_on_load=True,
-        propagate_map_exceptions=True
-    )
-    log.debug("Registered plugins: {}".format(", ".join(ext.name for ext in mgr.extensions)))
+    registry = FreckRegistry.load()
+    log.debug("Registered plugins: {}".format(", ".join(registry.keys())))
 
-    return {ext.name: ext.plugin() for ext in mgr.extensions}
+    return registry
 
 def playbook_needs_sudo(playbook_items):
     """Checks whether a playbook needs to use 'become' or not."""
@@ -312,7 +489,6 @@ def create_apps_dict(apps, default_details):
 
     result = {}
     for app in apps:
-        details = copy.deepcopy(default_details)
         if isinstance(app, dict):
             if len(app) != 1:
                 raise FrecklesConfigError("More than one key provided in app configuration, needs to be either dict of lengths one, or string: {}".format(app), "apps", app)
@@ -320,10 +496,11 @@ def create_apps_dict(apps, default_details):
             app_details = app.values()[0]
             if not app_details:
                 app_details = {}
-            dict_merge(details, app_details)
+            details = merge_dicts(default_details, app_details)
             details["name"] = app_name
 
         elif isinstance(app, str):
+            details = materialize(default_details)
             details["name"] = app
 
         else:
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_freckles
+----------------------------------
+
+Benchmarks for the `freckles` module. Not collected by pytest, run directly:
+
+    python tests/benchmark_freckles.py [nr_repos] [nr_apps]
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+from freckles.constants import *
+from freckles.freckles import Freckles
+
+
+def create_dotfile_repos(base_dir, nr_repos, nr_apps):
+    """Creates 'nr_repos' dotfile directories with 'nr_apps' application folders each, and a config that installs and stows all of them."""
+
+    tasks = []
+    for r in range(nr_repos):
+        repo = os.path.join(base_dir, "dotfiles_{}".format(r))
+        for a in range(nr_apps):
+            app_dir = os.path.join(repo, "app_{}_{}".format(r, a))
+            os.makedirs(os.path.join(app_dir, ".config", "app_{}".format(a)))
+            with open(os.path.join(app_dir, ".config", "app_{}".format(a), "config"), 'w') as f:
+                f.write("key: value\n")
+            with open(os.path.join(app_dir, FRECKLES_METADATA_FILENAME), 'w') as f:
+                yaml.safe_dump({"pkgs": {"default": ["package_{}_{}".format(r, a)]}}, f)
+
+        dotfiles = {DOTFILES_KEY: [{DOTFILES_BASE_KEY: repo}]}
+        tasks.append({"install": {FRECK_VARS_KEY: dict(dotfiles, use_dotfiles=True, pkg_mgr="apt")}})
+        tasks.append({"stow": {FRECK_VARS_KEY: dotfiles}})
+
+    config = os.path.join(base_dir, "config.yml")
+    with open(config, 'w') as f:
+        yaml.safe_dump({FRECK_TASKS_KEY: tasks}, f)
+
+    return config
+
+
+def benchmark_process_leafs(nr_repos=40, nr_apps=50):
+
+    base_dir = tempfile.mkdtemp(prefix="freckles_benchmark_")
+    try:
+        config = create_dotfile_repos(base_dir, nr_repos, nr_apps)
+
+        for jobs in sorted(set([1, 2, 4, multiprocessing.cpu_count()])):
+            def process():
+                freckles = Freckles(config, jobs=jobs)
+                freckles.preprocess_configs()
+                return [len(run) for run in freckles.process_leafs()]
+
+            runs = process()
+            duration = min(timeit.repeat(process, number=1, repeat=3))
+            print("{} repos x {} apps, jobs={}: {:.3f}s ({} frecks)".format(nr_repos, nr_apps, jobs, duration, sum(runs)))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    benchmark_process_leafs(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_frkl
+----------------------------------
+
+Benchmarks for the `frkl` module. Not collected by pytest, run directly:
+
+    python tests/benchmark_frkl.py
+    python tests/benchmark_frkl.py memory
+"""
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+from freckles.constants import *
+from freckles.frkl import Frkl
+
+CONFIG_TEMPLATE = """
+tasks:
+  - task_{0}:
+      var_{0}: "{{{{ vars.var_0 | default('none') }}}}-{0}"
+  - task_{0}_b:
+      key: value_{0}
+"""
+
+
+def create_configs(base_dir, nr_configs):
+
+    configs = []
+    for i in range(nr_configs):
+        path = os.path.join(base_dir, "config_{}.yml".format(i))
+        with open(path, 'w') as f:
+            f.write(CONFIG_TEMPLATE.format(i))
+        configs.append(path)
+
+    return configs
+
+
+def create_frkl(configs):
+
+    return Frkl(configs, FRECK_TASKS_KEY, [FRECK_VARS_KEY, FRECK_META_KEY], FRECK_META_KEY, TASK_NAME_KEY, FRECK_VARS_KEY, DEFAULT_DOTFILE_REPO_NAME, FRECKLES_DEFAULT_FRECKLES_BOOTSTRAP_CONFIG_PATH, add_leaf_dicts=True)
+
+
+def create_nested_config(path, nr_groups, nr_leafs, nr_vars=50):
+    """Writes a config with 'nr_groups' child configs of 'nr_leafs' leafs each, with inherited vars on every level."""
+
+    def create_vars(prefix):
+        return dict(("{}_{}".format(prefix, i), {"value": "{}_{}".format(prefix, i), "list": range(5)}) for i in range(nr_vars))
+
+    groups = []
+    for g in range(nr_groups):
+        leafs = [{"task_{}_{}".format(g, l): {FRECK_VARS_KEY: {"leaf_var": l}}} for l in range(nr_leafs)]
+        groups.append({FRECK_VARS_KEY: create_vars("group_{}".format(g)), FRECK_TASKS_KEY: leafs})
+
+    config = {FRECK_VARS_KEY: create_vars("top"), FRECK_META_KEY: create_vars("meta"), FRECK_TASKS_KEY: groups}
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def deep_size(obj):
+    """Returns the size of an object and everything it references, counting shared objects only once."""
+
+    seen = set()
+    size = 0
+    todo = [obj]
+    while todo:
+        current = todo.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            todo.extend(current.keys())
+            todo.extend(current.values())
+        elif isinstance(current, (list, tuple)):
+            todo.extend(current)
+
+    return size
+
+
+def benchmark_root_memory(nr_groups=100, nr_leafs=100):
+    """Measures the size of the (unflattened) root and of the (flattened) leafs of a config with nr_groups * nr_leafs leafs.
+
+    Leafs share the values they inherit, so the size of all leafs (counting shared values once) per leaf should be much smaller than the size of a single leaf (counting everything it references).
+
+    Peak RSS is only meaningful when this is the only benchmark run in this process.
+    """
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(base_dir, "nested.yml")
+        create_nested_config(path, nr_groups, nr_leafs)
+        duration = min(timeit.repeat(lambda: create_frkl([path]), number=1, repeat=1))
+        frkl = create_frkl([path])
+    finally:
+        shutil.rmtree(base_dir)
+
+    print("Nested config ({} leafs):".format(len(frkl.root)))
+    print("  time:       {:8.3f}s".format(duration))
+    print("  root size:  {:8.1f}MB".format(deep_size(frkl.root) / 1024.0 / 1024.0))
+    leafs_size = deep_size(frkl.leafs)
+    print("  leafs size: {:8.1f}MB".format(leafs_size / 1024.0 / 1024.0))
+    print("  per leaf:   {:8.1f}KB (single leaf: {:.1f}KB)".format(leafs_size / 1024.0 / len(frkl.leafs), deep_size(frkl.leafs[0]) / 1024.0))
+    print("  peak RSS:   {:8.1f}MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+# the time per config may grow at most by this factor from the smallest to the largest size, it would grow with the
+# number of configs (x8 for the default sizes) if processing were quadratic
+MAX_TIME_PER_CONFIG_GROWTH = 2.0
+
+
+def benchmark_template_context(sizes=(250, 500, 1000, 2000)):
+    """Times processing of n templated config files, each of which is rendered against the merged context of all previous leafs.
+
+    Leafs have a constant size, so the time per config should stay (roughly) the same. Fails if it grows by more than MAX_TIME_PER_CONFIG_GROWTH from the smallest to the largest size.
+    """
+
+    print("Rendering templated configs (2 leafs per config):")
+    per_config = []
+    for size in sizes:
+        base_dir = tempfile.mkdtemp()
+        try:
+            configs = create_configs(base_dir, size)
+            duration = min(timeit.repeat(lambda: create_frkl(configs), number=1, repeat=3))
+        finally:
+            shutil.rmtree(base_dir)
+
+        ratio = "" if not per_config else "  (x{:.2f})".format(duration / size / per_config[-1])
+        print("  {:5d} configs: {:8.3f}s, {:6.3f}ms per config{}".format(size, duration, duration * 1000 / size, ratio))
+        per_config.append(duration / size)
+
+    growth = per_config[-1] / per_config[0]
+    if growth > MAX_TIME_PER_CONFIG_GROWTH:
+        sys.exit("Time per config grew by x{:.2f} from {} to {} configs (at most x{} is linear)".format(growth, sizes[0], sizes[-1], MAX_TIME_PER_CONFIG_GROWTH))
+
+
+if __name__ == "__main__":
+    if "memory" in sys.argv[1:]:
+        benchmark_root_memory()
+    else:
+        benchmark_template_context()
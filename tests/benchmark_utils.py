@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_utils
+----------------------------------
+
+Micro-benchmarks for the dict merging helpers in the `utils` module. Not collected by pytest, run directly:
+
+    python tests/benchmark_utils.py
+"""
+
+import copy
+import timeit
+
+from freckles.utils import LayeredDict, dict_merge, merge_dicts
+
+
+def create_wide(nr_keys, prefix):
+
+    return dict(("key_{}".format(i), {"value": "{}_{}".format(prefix, i), "list": range(3)}) for i in range(nr_keys))
+
+
+def create_deep(depth, prefix):
+
+    result = {"value": prefix}
+    for i in range(depth):
+        result = {"level_{}".format(i): result, "value_{}".format(i): prefix}
+    return result
+
+
+def create_meta(nr_vars, prefix):
+
+    return {"task_name": prefix, "sudo": False, "vars": dict(("var_{}".format(i), "{}_{}".format(prefix, i)) for i in range(nr_vars)), "roles": {"role_{}".format(prefix): "url"}}
+
+
+SHAPES = [
+    ("wide (3 x 2000 keys)", [create_wide(2000, p) for p in ("a", "b", "c")]),
+    ("wide, small overlay", [create_wide(2000, "a"), {"key_1": {"value": "b"}}]),
+    ("deep (3 x 200 levels)", [create_deep(200, p) for p in ("a", "b", "c")]),
+    ("freck meta (50 vars)", [create_meta(50, "a"), create_meta(5, "b")])
+]
+
+
+def copy_and_merge(layers):
+    """What the call sites did before: copy the first layer, and merge copies of the others into it."""
+
+    result = copy.deepcopy(layers[0])
+    for layer in layers[1:]:
+        dict_merge(result, copy.deepcopy(layer))
+    return result
+
+
+def lookup(layers):
+
+    view = LayeredDict(*layers)
+    return view["key_1"] if "key_1" in view else view.keys()
+
+
+def benchmark_merge(number=20):
+
+    print("{:24s} {:>14s} {:>14s} {:>14s}".format("", "copy + merge", "merge_dicts", "view lookup"))
+    for name, layers in SHAPES:
+        results = []
+        for func in (copy_and_merge, merge_dicts, lookup):
+            duration = min(timeit.repeat(lambda: func(*layers) if func is merge_dicts else func(layers), number=number, repeat=3))
+            results.append(duration * 1000 / number)
+        print("{:24s} {:12.3f}ms {:12.3f}ms {:12.3f}ms".format(name, *results))
+
+
+if __name__ == "__main__":
+    benchmark_merge()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_ansible_runner
+----------------------------------
+
+Tests for `ansible_runner` module.
+"""
+
+import os
+
+import pytest
+import yaml
+
+from freckles.runners import ansible_runner
+from freckles.runners.ansible_runner import (create_custom_roles,
+                                             create_execution_environment,
+                                             link_internal_roles)
+
+
+def test_create_execution_environment(tmpdir):
+
+    cache_dir = tmpdir.join("cache")
+    details = {"freckles_playbook_dir": "/run/plays", "freckles_playbook": "/run/plays/play.yml", "freckles_ask_sudo": "", "freckles_ansible_roles": {"ext_role": "https://github.com/x/y.git"}}
+
+    for name in ["run_1", "run_2"]:
+        create_execution_environment(str(tmpdir.join(name)), details, cache_base_dir=str(cache_dir))
+
+    # static files are linked from a single cached copy
+    assert len(cache_dir.listdir()) == 1
+    setup_script = tmpdir.join("run_2", "extensions", "setup", "role_update.sh")
+    assert setup_script.islink()
+    assert os.path.realpath(str(setup_script)).startswith(os.path.realpath(str(cache_dir)))
+
+    # templated files are rendered for every run
+    run_script = tmpdir.join("run_1", "freckles_run.sh")
+    assert not run_script.islink()
+    assert "ansible-playbook  /run/plays/play.yml" in run_script.read()
+    assert os.access(str(run_script), os.X_OK)
+    assert "src: https://github.com/x/y.git" in tmpdir.join("run_1", "roles", "roles_requirements.yml").read()
+
+
+def test_create_custom_roles(tmpdir):
+
+    def item(task_type, keys):
+        role_name = "dyn_{}".format(task_type)
+        return {"roles": {role_name: [{"name": "desc", "type": task_type, "task": {"vars": {"{}_task".format(role_name): keys}, "become": False}}]}}
+
+    # items that only differ in the values of their variables share a role
+    items = [item("debug", ["msg"]), item("debug", ["msg"]), item("command", ["chdir", "free_form"])]
+    create_custom_roles(items, str(tmpdir))
+
+    assert sorted(os.listdir(str(tmpdir))) == ["dyn_command", "dyn_debug"]
+    tasks = yaml.safe_load(tmpdir.join("dyn_command", "tasks", "main.yml").read())
+    assert tasks == [{"name": "dyn_command_task", "command": "{{ free_form }}", "args": {"chdir": "{{ chdir | default(omit) }}"}, "become": False, "ignore_errors": "{{ ignore_errors | default('yes') }}"}]
+    # the item is not changed
+    assert items[2]["roles"]["dyn_command"][0]["task"]["vars"]["dyn_command_task"] == ["chdir", "free_form"]
+
+
+def test_link_internal_roles(tmpdir):
+
+    internal_roles = tmpdir.join("internal")
+    internal_roles.join("ansible-stow", "tasks", "main.yml").write("- debug: msg=stow\n", ensure=True)
+    cache_dir = tmpdir.join("cache")
+    items = [{"roles": {"stow": "frkl:ansible-stow", "ext": "https://github.com/x/y.git"}}]
+
+    for name in ["run_1", "run_2"]:
+        link_internal_roles(items, str(tmpdir.join(name, "roles", "internal")), str(internal_roles), cache_base_dir=str(cache_dir))
+
+    # both runs link to the same snapshot
+    assert len(cache_dir.listdir()) == 1
+    assert tmpdir.join("run_1", "roles", "internal").listdir() == [tmpdir.join("run_1", "roles", "internal", "stow")]
+    role_link = tmpdir.join("run_2", "roles", "internal", "stow")
+    assert role_link.islink()
+    assert role_link.join("tasks", "main.yml").read() == "- debug: msg=stow\n"
+
+    # a changed role gets a new snapshot, earlier runs keep theirs
+    internal_roles.join("ansible-stow", "tasks", "main.yml").write("- debug: msg=changed\n")
+    link_internal_roles(items, str(tmpdir.join("run_3", "roles", "internal")), str(internal_roles), cache_base_dir=str(cache_dir))
+    assert len(cache_dir.listdir()) == 2
+    assert role_link.join("tasks", "main.yml").read() == "- debug: msg=stow\n"
+
+
+def test_link_internal_roles_packaged(tmpdir, monkeypatch):
+
+    internal_roles = tmpdir.join("internal")
+    internal_roles.join("ansible-stow", "tasks", "main.yml").write("- debug: msg=stow\n", ensure=True)
+    cache_dir = tmpdir.join("cache")
+    items = [{"roles": {"stow": "frkl:ansible-stow"}}]
+    monkeypatch.setattr(ansible_runner, "FRECKLES_INTERNAL_ROLES_PATH", str(internal_roles))
+    monkeypatch.setattr(ansible_runner, "FRECKLES_DEVELOP_ROLE_PATH", "")
+
+    # packaged roles are not hashed, they only change with the version of freckles
+    monkeypatch.setattr(ansible_runner, "get_dir_hash", lambda path: pytest.fail("hashed packaged role"))
+    link_internal_roles(items, str(tmpdir.join("run_1", "roles", "internal")), str(internal_roles), cache_base_dir=str(cache_dir))
+    assert [path.basename for path in cache_dir.listdir()] == ["ansible-stow_v{}".format(ansible_runner.VERSION)]
+
+    # ... unless in develop mode
+    monkeypatch.setattr(ansible_runner, "FRECKLES_DEVELOP_ROLE_PATH", str(tmpdir))
+    monkeypatch.setattr(ansible_runner, "get_dir_hash", lambda path: "abc")
+    link_internal_roles(items, str(tmpdir.join("run_2", "roles", "internal")), str(internal_roles), cache_base_dir=str(cache_dir))
+    assert sorted(path.basename for path in cache_dir.listdir()) == ["ansible-stow_abc", "ansible-stow_v{}".format(ansible_runner.VERSION)]
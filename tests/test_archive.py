@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_archive
+----------------------------------
+
+Tests for `archive` module.
+"""
+
+import os
+import tarfile
+import time
+from datetime import datetime
+
+from freckles.archive import RunArchive
+
+
+def create_entry(archive_dir, age_days, role_content="- debug: msg=1"):
+
+    name = datetime.fromtimestamp(time.time() - age_days * 24 * 60 * 60).strftime('%y%m%d_%H_%M_%S')
+    run_dir = archive_dir.join(name, "run_1")
+    run_dir.join("roles", "internal", "main.yml").write(role_content, ensure=True)
+    run_dir.join("play.yml").write(name, ensure=True)
+    return name
+
+
+def test_archive_dedup(tmpdir):
+
+    archive_dir = tmpdir.join("archive")
+    archive = RunArchive(archive_dir=str(archive_dir), blob_dir=str(tmpdir.join("blobs")), last_link=str(tmpdir.join("last")))
+    first = create_entry(archive_dir, 2)
+    second = create_entry(archive_dir, 1)
+
+    assert archive.dedup(str(archive_dir.join(first))) == 0
+    assert archive.dedup(str(archive_dir.join(second))) == 1
+
+    role_1 = os.stat(str(archive_dir.join(first, "run_1", "roles", "internal", "main.yml")))
+    role_2 = os.stat(str(archive_dir.join(second, "run_1", "roles", "internal", "main.yml")))
+    assert role_1.st_ino == role_2.st_ino
+    assert archive_dir.join(second, "run_1", "play.yml").read() == second
+
+
+def test_archive_gc(tmpdir):
+
+    archive_dir = tmpdir.join("archive")
+    archive = RunArchive(archive_dir=str(archive_dir), blob_dir=str(tmpdir.join("blobs")), last_link=str(tmpdir.join("last")))
+    entries = [create_entry(archive_dir, age, role_content="x" * 10000) for age in [40, 20, 10, 3, 2, 1]]
+    # the last run is never removed
+    tmpdir.join("last").mksymlinkto(archive_dir.join(entries[0], "run_1"))
+
+    result = archive.gc(keep=4, max_age=30 * 24 * 60 * 60, compress_after=5 * 24 * 60 * 60)
+
+    assert result["removed"] == [entries[1]]
+    assert result["compressed"] == [entries[2]]
+    assert result["deduplicated"] == 3
+    assert result["reclaimed"] > 3 * 10000
+    assert sorted(archive.get_entries()) == sorted([entries[0], entries[2] + ".tar.gz"] + entries[3:])
+    with tarfile.open(str(archive_dir.join(entries[2] + ".tar.gz"))) as f:
+        assert "{}/run_1/play.yml".format(entries[2]) in f.getnames()
+
+    # blobs are removed once no run uses them anymore
+    for name in archive.get_entries():
+        archive.remove(name)
+    archive.gc()
+    assert [blob for blob in tmpdir.join("blobs").visit() if blob.isfile()] == []
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_bundle
+----------------------------------
+
+Tests for `bundle` module.
+"""
+
+import io
+import os
+import tarfile
+
+import pytest
+import yaml
+
+from freckles import bundle as bundle_module
+from freckles.bundle import (BUNDLE_METADATA_FILE, Bundle, create_bundle,
+                             is_bundle)
+from freckles.exceptions import FrecklesConfigError
+from freckles.freckles import Freckles
+
+
+def test_bundle_roundtrip(tmpdir):
+
+    config = tmpdir.join("config.yml")
+    config.write("vars:\n  packages:\n    - \"{{ env.FRECKLES_TEST_PKG | default('htop') }}\"\ntasks:\n  - install\n")
+    bundle_file = str(tmpdir.join("bundle.tar.gz"))
+
+    freckles = Freckles(str(config))
+    leafs = yaml.safe_dump(freckles.leafs)
+    assert create_bundle(freckles, bundle_file) == {}
+
+    assert is_bundle(bundle_file)
+    assert not is_bundle(str(config))
+
+    bundle = Bundle.extract(bundle_file, str(tmpdir.join("extracted")))
+    assert yaml.safe_dump(bundle.leafs) == leafs
+    assert os.path.isdir(os.path.join(bundle.roles_dir, "internal", "ansible-stow"))
+
+    freckles = Freckles(bundle=bundle)
+    assert freckles.leafs == bundle.leafs and freckles.leafs is not bundle.leafs
+
+    bundle.cleanup()
+    assert not os.path.exists(bundle.bundle_dir)
+
+
+class FakeRoleCache(object):
+
+    def __init__(self, role_paths):
+        self.role_paths = role_paths
+
+    def get_roles(self, roles, report=None):
+        return dict((role_name, self.role_paths[role_url]) for role_name, role_url in roles.iteritems())
+
+    def log_stats(self):
+        pass
+
+
+def test_bundle_external_roles(tmpdir, monkeypatch):
+
+    config = tmpdir.join("config.yml")
+    config.write("tasks:\n  - install:\n      packages:\n        - htop\n")
+    cached_role = tmpdir.join("cache", "objects", "abc")
+    cached_role.join("tasks", "main.yml").write("- debug: msg=cached\n", ensure=True)
+    monkeypatch.setattr(bundle_module, "extract_ansible_roles", lambda items: {"my_role": "git+https://example.com/role.git"})
+
+    freckles = Freckles(str(config), role_cache=FakeRoleCache({"git+https://example.com/role.git": str(cached_role)}))
+    bundle_file = str(tmpdir.join("bundle.tar.gz"))
+    assert create_bundle(freckles, bundle_file) == {"my_role": "git+https://example.com/role.git"}
+
+    # roles are copied from the cache
+    bundle = Bundle.extract(bundle_file, str(tmpdir.join("extracted")))
+    assert open(os.path.join(bundle.roles_dir, "external", "my_role", "tasks", "main.yml")).read() == "- debug: msg=cached\n"
+    assert bundle.external_roles == {"my_role": "git+https://example.com/role.git"}
+
+
+def create_archive(path, members):
+    """Creates a tar archive out of (name, type, content or link target) tuples, type None is a regular file."""
+
+    with tarfile.open(path, "w") as archive:
+        for name, link_type, value in members:
+            info = tarfile.TarInfo(name)
+            content = b""
+            if link_type is None:
+                content = value or b"content"
+                info.size = len(content)
+            else:
+                info.type = link_type
+                info.linkname = value
+            archive.addfile(info, io.BytesIO(content))
+    return path
+
+
+@pytest.mark.parametrize("members", [
+    [("../evil", None, None)],
+    [("/tmp/evil", None, None)],
+    [("roles/x", tarfile.SYMTYPE, "/etc"), ("roles/x/passwd", None, None)],
+    [("roles/x", tarfile.SYMTYPE, "../.."), ("roles/x/evil", None, None)],
+    [("roles/passwd", tarfile.LNKTYPE, "/etc/passwd")],
+    [("roles/passwd", tarfile.LNKTYPE, "../outside")]
+])
+def test_bundle_extract_rejects_paths_outside(tmpdir, members):
+
+    bundle_file = create_archive(str(tmpdir.join("bundle.tar")), members)
+    with pytest.raises(FrecklesConfigError):
+        Bundle.extract(bundle_file, str(tmpdir.join("extracted")))
+    assert not tmpdir.join("evil").check()
+
+
+def test_bundle_extract_allows_links_inside(tmpdir):
+
+    members = [
+        (BUNDLE_METADATA_FILE, None, yaml.safe_dump({"leafs": []})),
+        ("..foo", None, None),
+        ("roles/internal/a/tasks/main.yml", None, None),
+        ("roles/internal/b", tarfile.SYMTYPE, "a"),
+        ("roles/internal/c.yml", tarfile.LNKTYPE, "roles/internal/a/tasks/main.yml")
+    ]
+    bundle_file = create_archive(str(tmpdir.join("bundle.tar")), members)
+    bundle = Bundle.extract(bundle_file, str(tmpdir.join("extracted")))
+
+    assert os.path.isfile(os.path.join(bundle.bundle_dir, "..foo"))
+    assert open(os.path.join(bundle.roles_dir, "internal", "b", "tasks", "main.yml")).read() == "content"
+    assert open(os.path.join(bundle.roles_dir, "internal", "c.yml")).read() == "content"
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_config_cache
+----------------------------------
+
+Tests for `config_cache` module.
+"""
+
+import pytest
+import requests
+
+from freckles.config_cache import ConfigCache
+from freckles.exceptions import FrecklesConfigError
+
+URL = "https://example.com/config.yml"
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers if headers is not None else {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("{} error".format(self.status_code))
+
+
+class FakeSession(object):
+    """Returns the provided responses (or raises the provided exceptions) in order, and records the headers of every request."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None, verify=True, timeout=None):
+        self.requests.append(headers)
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_config_cache_revalidates(tmpdir):
+
+    session = FakeSession([FakeResponse(200, "tasks: [install]", {"ETag": '"abc"'}), FakeResponse(304)])
+
+    cache = ConfigCache(cache_dir=str(tmpdir))
+    assert cache.get(URL, session) == "tasks: [install]"
+
+    cache = ConfigCache(cache_dir=str(tmpdir))
+    assert cache.get(URL, session) == "tasks: [install]"
+    assert session.requests[1] == {"If-None-Match": '"abc"'}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    offline_cache = ConfigCache(cache_dir=str(tmpdir), offline=True)
+    assert offline_cache.get(URL, session) == "tasks: [install]"
+    assert len(session.requests) == 2
+
+
+def test_config_cache_fallback(tmpdir):
+
+    cache = ConfigCache(cache_dir=str(tmpdir))
+    session = FakeSession([
+        FakeResponse(200, "tasks: []", {"ETag": '"abc"'}),
+        FakeResponse(304),
+        requests.exceptions.ConnectionError("unreachable"),
+        requests.exceptions.Timeout("timeout"),
+        FakeResponse(404)
+    ])
+    assert cache.get(URL, session) == "tasks: []"
+    assert cache.get(URL, session) == "tasks: []"
+
+    # the cached version is used if the server can't be reached
+    assert cache.get(URL, session) == "tasks: []"
+    assert cache.get(URL, session) == "tasks: []"
+
+    # but not if the config was removed
+    with pytest.raises(FrecklesConfigError):
+        cache.get(URL, session)
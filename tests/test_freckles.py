@@ -8,13 +8,18 @@ test_freckles
 Tests for `freckles` module.
 """
 
+import os
+import threading
+
 import pytest
+import yaml
 
 from contextlib import contextmanager
 from click.testing import CliRunner
 
 from freckles import freckles
 from freckles import cli
+from freckles.state_db import StateDB
 
 
 @pytest.fixture
@@ -40,3 +45,243 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.cli, ['--help'])
     assert help_result.exit_code == 0
     assert 'Show this message and exit.' in help_result.output
+
+
+class CountingFreck(freckles.Freck):
+
+    def __init__(self):
+        self.calls = 0
+
+    def create_run_item(self, freck_meta, develop=False):
+        return {}
+
+
+class DynamicFreck(CountingFreck):
+
+    def can_be_used_for(self, freck_meta):
+        self.calls += 1
+        return freck_meta.get("dynamic", False)
+
+
+class AliasFreck(CountingFreck):
+
+    DISPATCH_TASK_NAMES = frozenset(["alias"])
+
+
+class RolesFreck(CountingFreck):
+
+    DISPATCH_ROLES_KEY = True
+
+
+class FallbackFreck(CountingFreck):
+
+    DISPATCH_FALLBACK = True
+
+
+def test_freck_dispatch():
+
+    frecks = {"fallback": FallbackFreck(), "dynamic": DynamicFreck(), "roles": RolesFreck(), "alias": AliasFreck(), "other": AliasFreck()}
+    frecks["other"].DISPATCH_TASK_NAMES = frozenset(["other_alias"])
+    dispatcher = freckles.FreckDispatcher(frecks)
+
+    assert dispatcher.get_freck_name({"task_name": "roles"}) == "roles"
+    assert dispatcher.index is None
+
+    assert dispatcher.get_freck_name({"task_name": "other_alias"}) == "other"
+    assert dispatcher.get_freck_name({"task_name": "my_role", "roles": {"my_role": "url"}}) == "roles"
+    assert dispatcher.get_freck_name({"task_name": "my_role", "roles": {"my_role": "url"}}) == "roles"
+    assert frecks["dynamic"].calls == 0
+
+    assert dispatcher.get_freck_name({"task_name": "unknown", "dynamic": True}) == "dynamic"
+    assert dispatcher.get_freck_name({"task_name": "unknown"}) == "fallback"
+    assert frecks["dynamic"].calls == 2
+
+    del frecks["fallback"]
+    dispatcher = freckles.FreckDispatcher(frecks)
+    assert dispatcher.get_freck_name({"task_name": "unknown"}) is False
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_process_leafs_jobs(tmpdir, jobs):
+
+    dotfiles = tmpdir.mkdir("dotfiles")
+    dotfiles.mkdir("app_1")
+    config = tmpdir.join("config.yml")
+    stow = {"stow": {"vars": {"dotfiles": [{"base_dir": str(dotfiles)}]}}}
+    config.write(yaml.safe_dump({"tasks": [stow, {"debug": {"meta": {"new_run_after": True}}}, stow, {"debug": {"vars": {"msg": "last"}}}]}))
+
+    f = freckles.Freckles(str(config), jobs=jobs)
+    f.preprocess_configs()
+
+    runs = []
+    for frecks in f.process_leafs():
+        runs.append([(freck["freck_name"], freck["freck_item_name"]) for freck in frecks])
+        # leafs after the end of a run can depend on what the run did
+        dotfiles.mkdir("app_{}".format(len(runs) + 1))
+
+    assert runs == [
+        [("stow", "app_1"), ("ansible-task", "ansible-task")],
+        [("stow", "app_1"), ("stow", "app_2"), ("ansible-task", "ansible-task")]
+    ]
+
+
+def test_batch_install(tmpdir):
+
+    config = tmpdir.join("config.yml")
+    config.write(yaml.safe_dump({"tasks": [
+        {"install": {"packages": ["a", "b"], "pkg_mgr": "apt"}},
+        {"debug": {"meta": {"resources": ["dir:/tmp/other"]}, "vars": {"msg": "independent"}}},
+        {"install": {"packages": ["b", "c", "d.deb"], "pkg_mgr": "apt"}},
+        {"debug": {"vars": {"msg": "x"}}},
+        {"install": {"packages": ["c", "g"], "pkg_mgr": "apt"}},
+        {"install": {"packages": ["e", "f"], "pkg_mgr": "apt", "batch_install": False}}
+    ]}))
+
+    f = freckles.Freckles(str(config))
+    f.preprocess_configs()
+    runs = [f.create_run_items(frecks) for frecks in f.process_leafs()]
+
+    # batches are only closed by items that could conflict with them (the '.deb' file uses the same package manager, the debug task could use any resource), packages are only installed once per run
+    assert [(item.get("task_name", None), item["vars"].get("name", item["vars"].get("deb", None)), item.get("freck_batch_items", None)) for item in runs[0]] == [
+        ("apt", ["a", "b", "c"], ["a", "b", "c"]),
+        ("debug", None, None),
+        ("apt", "d.deb", None),
+        ("debug", None, None),
+        ("apt", "g", None),
+        ("apt", "e", None),
+        ("apt", "f", None)
+    ]
+    assert [item["freck_id"] for item in runs[0]] == range(1, 8)
+
+
+def test_batch_item_output(capsys):
+
+    item = {"freck_id": 1, "freck_item_name": "a, b", "freck_desc": "install", "freck_batch_items": ["a", "b"]}
+    callback = freckles.FrecklesRunCallback(1, {}, [item], log_dir="/tmp/current/logs")
+    summary = freckles.TaskResultSummary()
+    summary.add({"task_name": "install", "ignore_errors": False, "state": "ok", "result": {"changed": True}})
+    callback.task_result[1] = summary
+    callback.log_freck_complete(1)
+
+    # there is only a result for the whole batch
+    assert capsys.readouterr()[0].splitlines() == ["\t=> changed (result of the single task for all items)", "    - 'a'", "    - 'b'"]
+
+
+def test_pkg_mgr_install_changes_host_facts(tmpdir):
+
+    config = tmpdir.join("config.yml")
+    config.write(yaml.safe_dump({"tasks": [{"install": {"packages": ["zile"], "pkg_mgr": "nix"}}]}))
+
+    f = freckles.Freckles(str(config))
+    f.preprocess_configs()
+    items = [item for frecks in f.process_leafs() for item in f.create_run_items(frecks)]
+
+    # the host facts are probed again after nix got installed
+    assert [(item["freck_item_name"], item.get("changes_host_facts", False)) for item in items] == [("nix", True), ("zile", False)]
+
+
+class BranchRunner(object):
+
+    def __init__(self, items, callback, roles_dir=None, execution_dir_name=None, execution_base_dir=None, role_cache=None):
+        self.items = items
+        self.execution_dir = os.path.join(execution_base_dir, execution_dir_name)
+        os.makedirs(self.execution_dir)
+
+    def run(self):
+        self.items[0]["started"].append(self.items[0]["freck_id"])
+        # branches with events wait for each other, so they only succeed if they are executed concurrently
+        if "events" in self.items[0]:
+            own_event, other_event = self.items[0]["events"]
+            own_event.set()
+            return other_event.wait(5)
+        return not self.items[0].get("fail", False)
+
+
+def test_run_stages(tmpdir):
+
+    config = tmpdir.join("config.yml")
+    config.write(yaml.safe_dump({"tasks": [{"debug": {"vars": {"msg": "x"}}}]}))
+    f = freckles.Freckles(str(config), run_jobs=2, workdir=str(tmpdir.join("work")))
+
+    started = []
+    event_1 = threading.Event()
+    event_2 = threading.Event()
+    stages = [
+        [[{"freck_id": 1, "started": started, "events": (event_1, event_2)}], [{"freck_id": 2, "started": started, "events": (event_2, event_1)}]],
+        [[{"freck_id": 3, "started": started}]]
+    ]
+    dest_dir = tmpdir.join("run_1")
+    assert f.run_stages(1, BranchRunner, [], stages, str(dest_dir)) is True
+    assert sorted(started) == [1, 2, 3]
+    assert sorted(os.listdir(str(dest_dir))) == ["branch_1", "branch_2", "branch_3"]
+
+    # stages after a failed one are not executed
+    started = []
+    stages = [[[{"freck_id": 1, "started": started, "fail": True}], [{"freck_id": 2, "started": started}]], [[{"freck_id": 3, "started": started}]]]
+    assert f.run_stages(2, BranchRunner, [], stages, str(tmpdir.join("run_2"))) is False
+    assert sorted(started) == [1, 2]
+
+
+def test_task_result_summary():
+
+    callback = freckles.FrecklesRunCallback(1, {}, [{"freck_id": 1}], log_dir="/tmp/current/logs", compress_log=True, archive_log_dir="/archive/run_1/logs")
+    summary = freckles.TaskResultSummary(max_output_size=100)
+    for i in range(1000):
+        summary.add({"task_name": "install", "ignore_errors": False, "state": "ok", "result": {"changed": i == 10, "stderr": "x" * 30}})
+    summary.add({"task_name": "install", "ignore_errors": True, "state": "failed", "result": {"msg": "ignored"}})
+
+    # only the first 100 characters are kept in memory
+    assert summary.stderr == ["x" * 30] * 3 + ["x" * 10]
+    assert summary.msg == []
+    assert summary.truncated
+
+    output = callback.handle_freck_task_output({"freck_id": 1}, summary)
+    assert output["state"] == "changed"
+    assert "output truncated" in output["stdout"][-1]
+    assert output["stdout"][-1].endswith("/archive/run_1/logs/run_log.jsonl.gz]")
+
+
+class FailingFreck(object):
+
+    def process_leaf(self, leaf, supported_runners, debug):
+        raise ValueError("broken leaf")
+
+
+def test_process_leaf_worker_returns_traceback(monkeypatch):
+
+    monkeypatch.setattr(freckles, "LEAF_WORKER_FRECKS", {"failing": FailingFreck()})
+    error, worker_traceback, result = freckles.process_leaf_worker({freckles.FRECK_META_KEY: {freckles.FRECK_NAME_KEY: "failing"}}, [])
+
+    assert isinstance(error, ValueError) and result is None
+    assert "in process_leaf" in worker_traceback and "broken leaf" in worker_traceback
+
+
+def test_filter_unchanged_items(tmpdir):
+
+    config = tmpdir.join("config.yml")
+    config.write(yaml.safe_dump({"tasks": [{"debug": {"vars": {"msg": "x"}}}]}))
+    state_db = StateDB(db_file=None, host="test")
+    f = freckles.Freckles(str(config), workdir=str(tmpdir.join("work")), state_db=state_db, incremental=True)
+
+    def items():
+        return [
+            {"freck_id": 1, "task_name": "git", "vars": {"repo": "r", "dest": "/d"}, "resources": ["dir:/d"], "remote_state": True},
+            {"freck_id": 2, "task_name": "stow", "vars": {"src": "/d"}, "resources": ["dir:/d"]},
+            {"freck_id": 3, "task_name": "install", "vars": {"packages": ["zile"]}, "resources": ["apt_lock"], "unique_task_id": "install_zile"},
+            {"freck_id": 4, "task_name": "install", "vars": {"packages": ["vim"]}, "resources": ["conda"], "depends_on": ["install_zile"]},
+            {"freck_id": 5, "task_name": "install", "vars": {"packages": ["emacs"]}, "resources": ["nix_store"]}
+        ]
+
+    for item in items():
+        state_db.record(state_db.get_item_hash(item), "no change")
+
+    # the checkout is always executed, and so is the item using the same directory after it
+    filtered, item_hashes = f.filter_unchanged_items(1, items())
+    assert [item["task_name"] for item in filtered] == ["git", "stow"]
+    assert [item["freck_id"] for item in filtered] == [1, 2]
+
+    # changed items are executed together with the items depending on them
+    changed = items()
+    changed[2]["vars"]["packages"] = ["mg"]
+    filtered, item_hashes = f.filter_unchanged_items(1, changed)
+    assert [item["vars"] for item in filtered] == [{"repo": "r", "dest": "/d"}, {"src": "/d"}, {"packages": ["mg"]}, {"packages": ["vim"]}]
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_frkl
+----------------------------------
+
+Tests for `frkl` module.
+"""
+
+import random
+
+import pytest
+import yaml
+
+from freckles import frkl
+from freckles.constants import *
+from freckles.exceptions import FrecklesConfigError
+from freckles.frkl import (LEAF_DICT, ConfigRenderer, ConfigResolver, Frkl,
+                           RootContext, flatten_leaf, flatten_root,
+                           get_and_load_configs, merge_root)
+
+REMOTE_CONFIGS = {
+    "https://example.com/root.yml": "tasks:\n  - install\nload:\n  - https://example.com/a.yml\n  - https://example.com/b.yml\n",
+    "https://example.com/a.yml": "tasks:\n  - stow\nload:\n  - https://example.com/c.yml\n",
+    "https://example.com/b.yml": "tasks:\n  - checkout-dotfiles\n",
+    "https://example.com/c.yml": "tasks:\n  - delete\n"
+}
+
+
+@pytest.fixture
+def remote_configs(monkeypatch):
+
+    fetched = []
+
+    def fake_get_config(url, verify_ssl=None, timeout=None, cache=None):
+        fetched.append(url)
+        return REMOTE_CONFIGS[url]
+
+    monkeypatch.setattr(frkl, "get_config", fake_get_config)
+    return fetched
+
+
+def test_resolver_discovers_load_graph(remote_configs):
+
+    resolver = ConfigResolver(stem_key="tasks")
+    resolver.prefetch(["https://example.com/root.yml"])
+
+    assert sorted(remote_configs) == sorted(REMOTE_CONFIGS.keys())
+
+
+def test_resolver_expands_urls(remote_configs, monkeypatch):
+
+    monkeypatch.setitem(REMOTE_CONFIGS, "https://raw.githubusercontent.com/me/dots/master/a.yml", "tasks:\n  - stow\n")
+    resolver = ConfigResolver(stem_key="tasks")
+    resolver.prefetch(["gh:me/dots/a.yml", "https://raw.githubusercontent.com/me/dots/master/a.yml"])
+
+    assert resolver.get("gh:me/dots/a.yml") == "tasks:\n  - stow\n"
+    assert remote_configs == ["https://raw.githubusercontent.com/me/dots/master/a.yml"]
+
+
+def test_load_graph_expands_urls(remote_configs, monkeypatch):
+
+    monkeypatch.setitem(REMOTE_CONFIGS, "https://example.com/aliases.yml", "tasks:\n  - install\nload:\n  - gh:me/dots/a.yml\n  - https://raw.githubusercontent.com/me/dots/master/a.yml\n")
+    monkeypatch.setitem(REMOTE_CONFIGS, "https://raw.githubusercontent.com/me/dots/master/a.yml", "tasks:\n  - stow\n")
+    result = get_and_load_configs("https://example.com/aliases.yml")
+
+    assert [r["tasks"][0] for r in result] == ["install", "stow", "stow"]
+    assert remote_configs == ["https://example.com/aliases.yml", "https://raw.githubusercontent.com/me/dots/master/a.yml"]
+
+
+def test_get_and_load_configs_keeps_order(remote_configs):
+
+    result = get_and_load_configs("https://example.com/root.yml")
+
+    assert [r["tasks"][0] for r in result] == ["install", "stow", "delete", "checkout-dotfiles"]
+    assert len(remote_configs) == len(REMOTE_CONFIGS)
+
+
+def test_load_graph_dedupes_and_detects_cycles(remote_configs, monkeypatch):
+
+    monkeypatch.setitem(REMOTE_CONFIGS, "https://example.com/diamond.yml", "tasks:\n  - install\nload:\n  - https://example.com/a.yml\n  - https://example.com/c.yml\n")
+    result = get_and_load_configs("https://example.com/diamond.yml")
+
+    assert [r["tasks"][0] for r in result] == ["install", "stow", "delete", "delete"]
+    assert sorted(remote_configs) == sorted(["https://example.com/diamond.yml", "https://example.com/a.yml", "https://example.com/c.yml"])
+    assert result[2] == result[3] and result[2] is not result[3]
+
+    monkeypatch.setitem(REMOTE_CONFIGS, "https://example.com/c.yml", "tasks:\n  - delete\nload: https://example.com/diamond.yml\n")
+    with pytest.raises(FrecklesConfigError) as e:
+        get_and_load_configs("https://example.com/diamond.yml")
+    assert "diamond.yml -> https://example.com/a.yml -> https://example.com/c.yml -> https://example.com/diamond.yml" in str(e.value)
+
+
+def random_value(rnd, depth):
+
+    if depth > 2 or rnd.random() < 0.4:
+        return rnd.choice(["a", "b", 1, None, [1, 2]])
+    return dict((rnd.choice("xyz"), random_value(rnd, depth + 1)) for _ in range(rnd.randint(0, 3)))
+
+
+def test_root_context_matches_merge_root():
+
+    rnd = random.Random(1)
+    for _ in range(200):
+        root = []
+        context = RootContext()
+        flattened = []
+        flattened_context = RootContext()
+        for _ in range(rnd.randint(1, 6)):
+            leaf = {
+                "vars": [random_value(rnd, 1) for _ in range(rnd.randint(1, 3))],
+                "meta": [{"task_name": rnd.choice("xyz")}],
+                LEAF_DICT: {"vars": {}}
+            }
+            leaf["vars"] = [v if isinstance(v, dict) else {"v": v} for v in leaf["vars"]]
+            root.append(leaf)
+            context.append(leaf)
+            assert context.merged == merge_root(root)
+
+            # flattened leafs are shared with the context, but never modified by it
+            flattened.append(flatten_leaf(leaf))
+            flattened_context.append_flattened(flattened[-1])
+            assert flattened_context.merged == context.merged
+            assert flattened == flatten_root(root)
+
+
+def test_config_renderer_compiles_once(tmpdir):
+
+    renderer = ConfigRenderer(bytecode_cache_dir=str(tmpdir))
+    plain = "tasks:\n  - install\n"
+    assert renderer.render(plain, {}) is plain
+    assert renderer.sources == {}
+
+    template = "tasks:\n  - {{ vars.name }}\n"
+    assert renderer.render(template, {"vars": {"name": "stow"}}) == "tasks:\n  - stow"
+    assert renderer.render(template, {"vars": {"name": "install"}}) == "tasks:\n  - install"
+    assert len(renderer.sources) == 1
+    assert len(tmpdir.listdir()) == 1
+
+
+def create_frkl(configs, stream=False):
+
+    return Frkl(configs, FRECK_TASKS_KEY, [FRECK_VARS_KEY, FRECK_META_KEY], FRECK_META_KEY, TASK_NAME_KEY, FRECK_VARS_KEY, DEFAULT_DOTFILE_REPO_NAME, FRECKLES_DEFAULT_FRECKLES_BOOTSTRAP_CONFIG_PATH, add_leaf_dicts=True, stream=stream)
+
+
+def test_stream_leafs(tmpdir, remote_configs, monkeypatch):
+
+    config = tmpdir.join("config.yml")
+    config.write("vars:\n  a: 1\ntasks:\n  - vars:\n      b: 2\n    tasks:\n      - install\n      - https://example.com/b.yml\n  - stow\n")
+    configs = [str(config), "https://example.com/c.yml", "checkout"]
+
+    frkl = create_frkl(configs, stream=True)
+    assert not isinstance(frkl.leafs, list)
+    streamed = list(frkl.leafs)
+
+    assert yaml.dump(streamed) == yaml.dump(create_frkl(configs).leafs)
+    assert frkl.resolver.pool is None
+
+    # leafs that are changed while they are consumed (like Freckles.preprocess_leaf does) don't change how later configs are rendered
+    monkeypatch.setitem(REMOTE_CONFIGS, "https://example.com/template.yml", "tasks:\n  - debug:\n      vars:\n        msg: \"freck={{ meta.freck_name | default('NONE') }}\"\n")
+    configs = ["install", "https://example.com/template.yml"]
+    streamed = []
+    for leaf in create_frkl(configs, stream=True).leafs:
+        leaf[FRECK_META_KEY][FRECK_NAME_KEY] = leaf[FRECK_META_KEY][TASK_NAME_KEY]
+        streamed.append(leaf)
+
+    assert streamed[1][FRECK_VARS_KEY]["msg"] == "freck=NONE"
+    assert [leaf.get(FRECK_VARS_KEY) for leaf in streamed] == [leaf.get(FRECK_VARS_KEY) for leaf in create_frkl(configs).leafs]
+
+
+def test_leafs_share_inherited_values(tmpdir):
+
+    config = tmpdir.join("config.yml")
+    config.write("vars:\n  a:\n    x: [1, 2]\n  b: 1\ntasks:\n  - vars:\n      a:\n        y: 2\n    tasks:\n      - install\n      - stow:\n          vars:\n            b: 2\n  - checkout\n")
+    frkl = create_frkl([str(config)])
+
+    assert frkl.leafs == flatten_root(frkl.root, add_leaf_dicts=True)
+    install, stow, checkout = frkl.leafs
+    assert stow["vars"] == {"a": {"x": [1, 2], "y": 2}, "b": 2}
+
+    # inherited values are shared, the dicts of every key are not
+    assert install["vars"]["a"] is stow["vars"]["a"]
+    assert install["vars"]["a"]["x"] is checkout["vars"]["a"]["x"]
+    assert install["vars"] is not stow["vars"] and install["meta"] is not stow["meta"]
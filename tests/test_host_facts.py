@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_host_facts
+----------------------------------
+
+Tests for `host_facts` module.
+"""
+
+import time
+
+from freckles import host_facts
+from freckles.frecks import install
+from freckles.host_facts import (OS_FAMILY_KEY, PKG_MGRS_AVAILABLE_KEY,
+                                 HostFacts)
+
+
+def test_host_facts_cache(tmpdir, monkeypatch):
+
+    probes = []
+
+    def probe():
+        probes.append(1)
+        return {OS_FAMILY_KEY: "Debian"}
+
+    monkeypatch.setattr(host_facts, "probe_host_facts", probe)
+    monkeypatch.setattr(host_facts, "get_boot_id", lambda: "boot_1")
+    cache_file = str(tmpdir.join("host_facts.json"))
+
+    facts = HostFacts(cache_file=cache_file, max_age=60)
+    assert [facts.get(OS_FAMILY_KEY) for i in range(500)] == ["Debian"] * 500
+    assert len(probes) == 1
+
+    # persisted facts are used by the next process
+    assert HostFacts(cache_file=cache_file, max_age=60).get(OS_FAMILY_KEY) == "Debian"
+    assert len(probes) == 1
+
+    # ... but not after a reboot
+    monkeypatch.setattr(host_facts, "get_boot_id", lambda: "boot_2")
+    assert HostFacts(cache_file=cache_file, max_age=60).get(OS_FAMILY_KEY) == "Debian"
+    assert len(probes) == 2
+
+    # ... or once they are too old
+    monkeypatch.setattr(time, "time", lambda: 10000000000)
+    assert HostFacts(cache_file=cache_file, max_age=60).get(OS_FAMILY_KEY) == "Debian"
+    assert len(probes) == 3
+
+
+def test_host_facts_invalidate(tmpdir, monkeypatch):
+
+    available = [[]]
+    monkeypatch.setattr(host_facts, "probe_host_facts", lambda: {PKG_MGRS_AVAILABLE_KEY: list(available[0])})
+    monkeypatch.setattr(host_facts, "get_boot_id", lambda: "boot_1")
+    cache_file = tmpdir.join("host_facts.json")
+
+    facts = HostFacts(cache_file=str(cache_file), max_age=60)
+    assert facts.get(PKG_MGRS_AVAILABLE_KEY) == []
+
+    # a package manager got installed
+    available[0] = ["nix"]
+    assert facts.get(PKG_MGRS_AVAILABLE_KEY) == []
+    facts.invalidate()
+    assert not cache_file.exists()
+    assert facts.get(PKG_MGRS_AVAILABLE_KEY) == ["nix"]
+    assert HostFacts(cache_file=str(cache_file), max_age=60).get(PKG_MGRS_AVAILABLE_KEY) == ["nix"]
+
+
+def test_default_pkg_mgr(tmpdir, monkeypatch):
+
+    probed = {OS_FAMILY_KEY: "Debian", PKG_MGRS_AVAILABLE_KEY: ["apt", "conda"]}
+    monkeypatch.setattr(host_facts, "probe_host_facts", lambda: dict(probed))
+    monkeypatch.setattr(host_facts, "get_boot_id", lambda: "boot_1")
+    facts = HostFacts(cache_file=str(tmpdir.join("host_facts.json")), max_age=60)
+    monkeypatch.setattr(install, "get_host_facts", lambda: facts)
+
+    assert install.get_default_pkg_mgr() == "apt"
+
+    # no default for the OS family, so use an available package manager that works everywhere
+    probed[OS_FAMILY_KEY] = "Alpine"
+    facts.invalidate()
+    assert install.get_default_pkg_mgr() == "conda"
+
+    probed[PKG_MGRS_AVAILABLE_KEY] = ["conda", "nix"]
+    facts.invalidate()
+    assert install.get_default_pkg_mgr() == "nix"
+
+    probed[PKG_MGRS_AVAILABLE_KEY] = []
+    facts.invalidate()
+    assert install.get_default_pkg_mgr() is False
+
+
+def test_probe_host_facts():
+
+    facts = host_facts.probe_host_facts()
+    assert facts[OS_FAMILY_KEY]
+    assert isinstance(facts[host_facts.PKG_MGRS_AVAILABLE_KEY], list)
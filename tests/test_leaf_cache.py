@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_leaf_cache
+----------------------------------
+
+Tests for `leaf_cache` module.
+"""
+
+import yaml
+
+from freckles.constants import *
+from freckles.frkl import Frkl
+from freckles.leaf_cache import LeafCache
+
+
+def create_frkl(configs):
+
+    return Frkl(configs, FRECK_TASKS_KEY, [FRECK_VARS_KEY, FRECK_META_KEY], FRECK_META_KEY, TASK_NAME_KEY, FRECK_VARS_KEY, DEFAULT_DOTFILE_REPO_NAME, FRECKLES_DEFAULT_FRECKLES_BOOTSTRAP_CONFIG_PATH, add_leaf_dicts=True)
+
+
+def test_leaf_cache_invalidation(tmpdir, monkeypatch):
+
+    config = tmpdir.join("config.yml")
+    config.write("tasks:\n  - install:\n      packages:\n        - \"{{ env.FRECKLES_TEST_PKG }}\"\n")
+    configs = (str(config), "stow")
+    monkeypatch.setenv("FRECKLES_TEST_PKG", "htop")
+
+    frkl = create_frkl(configs)
+    cache = LeafCache(cache_dir=str(tmpdir.join("cache")))
+    assert cache.load(configs) is None
+    cache.store(configs, frkl.get_dependencies(), frkl.leafs)
+
+    assert yaml.dump(cache.load(configs)) == yaml.dump(frkl.leafs)
+
+    monkeypatch.setenv("FRECKLES_TEST_PKG", "zile")
+    assert cache.load(configs) is None
+    monkeypatch.setenv("FRECKLES_TEST_PKG", "htop")
+    assert cache.load(configs) is not None
+
+    config.write("tasks:\n  - install\n")
+    assert cache.load(configs) is None
+
+
+def test_leaf_cache_invalid_entries(tmpdir):
+
+    cache = LeafCache(cache_dir=str(tmpdir.join("cache")))
+    configs = ("stow",)
+    for dependencies in [None, {}, {"env_all": False, "env": {}}]:
+        cache.store(configs, dependencies, [])
+        assert cache.load(configs) is None
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_planner
+----------------------------------
+
+Tests for `planner` module.
+"""
+
+import yaml
+
+from freckles import freckles
+from freckles.planner import (create_run_plan, get_dir_resource,
+                              get_item_dependencies, resources_conflict)
+
+
+def item(freck_id, resources=None, depends_on=None, unique_task_id=None):
+
+    result = {"freck_id": freck_id}
+    if resources is not None:
+        result["resources"] = resources
+    if depends_on is not None:
+        result["depends_on"] = depends_on
+    if unique_task_id is not None:
+        result["unique_task_id"] = unique_task_id
+    return result
+
+
+def ids(stages):
+
+    return [[[i["freck_id"] for i in branch] for branch in branches] for branches in stages]
+
+
+def test_item_dependencies():
+
+    items = [
+        item(1, ["nix_store"], unique_task_id="install_nix"),
+        item(2, ["conda"]),
+        item(3, ["home"], depends_on=["install_nix", "not_in_run"]),
+        item(4, ["nix_store"]),
+        item(5),
+        item(6, [])
+    ]
+
+    assert get_item_dependencies(items) == [set(), set(), set([0]), set([0]), set([0, 1, 2, 3]), set([4])]
+
+
+def test_create_run_plan():
+
+    items = [
+        item(1, [get_dir_resource("~/projects/freckles")]),
+        item(2, ["apt_lock"], unique_task_id="UPDATE_PKGS_apt"),
+        item(3, ["conda"]),
+        item(4, ["apt_lock"], depends_on=["UPDATE_PKGS_apt"]),
+        item(5, [get_dir_resource("~")], depends_on=["UPDATE_PKGS_apt"]),
+        item(6),
+        item(7),
+        item(8, ["conda"]),
+        item(9, ["apt_lock"])
+    ]
+
+    assert ids(create_run_plan(items)) == [
+        [[1, 2, 4, 5], [3]],
+        [[6, 7]],
+        [[8], [9]]
+    ]
+
+    # items that don't declare resources are executed on their own
+    assert ids(create_run_plan([item(1), item(2)])) == [[[1, 2]]]
+    assert create_run_plan([]) == []
+
+
+def test_dir_resources_conflict():
+
+    assert resources_conflict(get_dir_resource("~"), get_dir_resource("~/.emacs.d"))
+    assert resources_conflict(get_dir_resource("~/.emacs.d/lisp"), get_dir_resource("~/.emacs.d"))
+    assert resources_conflict(get_dir_resource("/"), get_dir_resource("/opt"))
+    assert not resources_conflict(get_dir_resource("~/.emacs"), get_dir_resource("~/.emacs.d"))
+    assert not resources_conflict(get_dir_resource("~/a"), get_dir_resource("~/b"))
+    assert not resources_conflict("dir_lock", get_dir_resource("dir_lock"))
+
+    # a checkout into a directory and a stow into one of its parents
+    items = [
+        item(1, [get_dir_resource("~/.emacs.d")]),
+        item(2, [get_dir_resource("~/projects")]),
+        item(3, [get_dir_resource("~/dotfiles"), get_dir_resource("~")]),
+        item(4, [get_dir_resource("~/.emacs.d/lisp")])
+    ]
+    assert get_item_dependencies(items) == [set(), set(), set([0, 1]), set([0, 2])]
+    assert ids(create_run_plan(items)) == [[[1, 2, 3, 4]]]
+
+
+def test_stow_resources(tmpdir):
+
+    dotfiles = tmpdir.mkdir("dotfiles")
+    dotfiles.mkdir("emacs")
+    target = tmpdir.mkdir("home")
+    config = tmpdir.join("config.yml")
+    config.write(yaml.safe_dump({"tasks": [
+        {"debug": {"meta": {"resources": [get_dir_resource(str(dotfiles))]}, "vars": {"msg": "x"}}},
+        {"debug": {"meta": {"resources": [get_dir_resource(str(target))]}, "vars": {"msg": "y"}}},
+        {"stow": {"vars": {"dotfiles": [{"base_dir": str(dotfiles)}], "stow_target_dir": str(target)}}}
+    ]}))
+
+    f = freckles.Freckles(str(config))
+    f.preprocess_configs()
+    items = [run_item for frecks in f.process_leafs() for run_item in f.create_run_items(frecks)]
+
+    # the stow reads from the dotfiles directory, and writes to the target directory
+    assert items[2]["resources"] == [get_dir_resource(str(dotfiles)), get_dir_resource(str(target))]
+    assert get_item_dependencies(items) == [set(), set(), set([0, 1])]
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_plugin_registry
+----------------------------------
+
+Tests for `plugin_registry` module.
+"""
+
+import json
+
+from freckles.plugin_registry import (INDEX_ENTRY_POINTS_KEY,
+                                      INDEX_FINGERPRINT_KEY, FreckRegistry,
+                                      get_path_fingerprint)
+
+
+def test_registry_index_and_lazy_loading(tmpdir):
+
+    index_file = str(tmpdir.join("plugins.json"))
+
+    registry = FreckRegistry.load(index_file=index_file)
+    assert "install" in registry
+    assert not registry.is_loaded("install")
+
+    with open(index_file) as f:
+        index = json.load(f)
+    assert index[INDEX_FINGERPRINT_KEY] == get_path_fingerprint()
+
+    # a valid index is used as is, without scanning
+    index[INDEX_ENTRY_POINTS_KEY] = [["install", "freckles.frecks.install", ["Install"]]]
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    registry = FreckRegistry.load(index_file=index_file)
+    assert registry.keys() == ["install"]
+
+    assert type(registry["install"]).__name__ == "Install"
+    assert registry.is_loaded("install")
+
+    # a stale index gets re-created
+    index[INDEX_FINGERPRINT_KEY] = "outdated"
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    assert len(FreckRegistry.load(index_file=index_file)) > 1
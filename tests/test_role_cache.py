@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_role_cache
+----------------------------------
+
+Tests for `role_cache` module.
+"""
+
+import os
+import subprocess
+
+import pytest
+
+from freckles.exceptions import FrecklesConfigError
+from freckles.role_cache import RoleCache, parse_role_url
+
+
+def can_execute(*command):
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(list(command), stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+# executables can be shims (like the ones of pyenv) that fail if the command isn't installed for the current interpreter, so they are executed instead of looked up
+requires_galaxy = pytest.mark.skipif(not can_execute("ansible-galaxy", "--version") or not can_execute("git", "--version"), reason="needs ansible-galaxy and git")
+
+
+def git(repo, *args):
+
+    subprocess.check_output(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args), cwd=str(repo))
+
+
+def create_role_repo(tmpdir, msg, name="role_repo"):
+
+    repo = tmpdir.join("{}.git".format(name))
+    repo.join("tasks", "main.yml").write("- debug: msg={}\n".format(msg), ensure=True)
+    repo.join("meta", "main.yml").write("galaxy_info:\n  author: test\n", ensure=True)
+    if not repo.join(".git").check():
+        git(repo, "init", "-q")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", msg)
+    return "git+file://{}".format(repo)
+
+
+def test_parse_role_url():
+
+    assert parse_role_url("git+https://example.com/role.git") == ("git+https://example.com/role.git", None)
+    assert parse_role_url("git+https://example.com/role.git, v1.0") == ("git+https://example.com/role.git", "v1.0")
+
+
+@requires_galaxy
+def test_role_cache(tmpdir):
+
+    role_url = create_role_repo(tmpdir, "first")
+    cache = RoleCache(cache_dir=str(tmpdir.join("cache")), max_age=3600)
+
+    role_path = cache.get(role_url)
+    assert open(os.path.join(role_path, "tasks", "main.yml")).read() == "- debug: msg=first\n"
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # used without revalidating it
+    create_role_repo(tmpdir, "second")
+    assert cache.get(role_url) == role_path
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # revalidated, and downloaded again because the commit changed
+    cache.max_age = 0
+    new_role_path = cache.get(role_url)
+    assert new_role_path != role_path
+    assert open(os.path.join(new_role_path, "tasks", "main.yml")).read() == "- debug: msg=second\n"
+    assert cache.get(role_url) == new_role_path
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    links = tmpdir.join("run", "roles", "external")
+    cache.link_roles({"my_role": role_url}, str(links))
+    assert os.path.realpath(str(links.join("my_role"))) == os.path.realpath(new_role_path)
+
+
+@requires_galaxy
+def test_role_cache_offline(tmpdir):
+
+    role_url = create_role_repo(tmpdir, "first")
+    role_path = RoleCache(cache_dir=str(tmpdir.join("cache"))).get(role_url)
+
+    tmpdir.join("role_repo.git").remove()
+    cache = RoleCache(cache_dir=str(tmpdir.join("cache")), offline=True)
+    assert cache.get(role_url) == role_path
+
+    with pytest.raises(FrecklesConfigError):
+        cache.get("git+file:///does/not/exist.git")
+
+
+@requires_galaxy
+def test_role_cache_get_roles(tmpdir):
+
+    first_url = create_role_repo(tmpdir, "first", name="first")
+    second_url = create_role_repo(tmpdir, "second", name="second")
+    cache = RoleCache(cache_dir=str(tmpdir.join("cache")), jobs=2)
+
+    reported = []
+    report = lambda names, url, downloaded, duration, error: reported.append((names, downloaded, error))
+    role_paths = cache.get_roles({"a": first_url, "b": first_url, "c": second_url}, report=report)
+
+    assert role_paths["a"] == role_paths["b"] != role_paths["c"]
+    assert sorted(reported) == [(["a", "b"], True, None), (["c"], True, None)]
+
+    reported = []
+    with pytest.raises(FrecklesConfigError):
+        cache.get_roles({"a": first_url, "missing": "git+file:///does/not/exist.git"}, report=report)
+    assert (["missing"], False) in [(names, downloaded) for names, downloaded, error in reported if error is not None]
+
+
+def test_role_cache_non_git(tmpdir, monkeypatch):
+
+    cache = RoleCache(cache_dir=str(tmpdir.join("cache")))
+    downloads = []
+
+    def download(src, version):
+        downloads.append((src, version))
+        if len(downloads) > 2:
+            raise subprocess.CalledProcessError(1, "ansible-galaxy", output="galaxy unreachable")
+        object_key = "object_{}".format(len(downloads))
+        os.makedirs(cache.get_object_path(object_key))
+        return object_key
+
+    monkeypatch.setattr(cache, "download", download)
+
+    # pinned versions are only downloaded once
+    role_path = cache.get("geerlingguy.java,1.7.4")
+    assert cache.get("geerlingguy.java,1.7.4") == role_path
+    assert downloads == [("geerlingguy.java", "1.7.4")]
+
+    # other versions are downloaded again, unless that fails
+    role_path = cache.get("geerlingguy.java")
+    assert cache.get("geerlingguy.java") == role_path
+    assert len(downloads) == 3
+
+    with pytest.raises(FrecklesConfigError):
+        cache.get("geerlingguy.git")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_run_log
+----------------------------------
+
+Tests for `run_log` module.
+"""
+
+import gzip
+import json
+
+from freckles.run_log import RunLogWriter
+
+
+def test_run_log(tmpdir):
+
+    log_file = tmpdir.join("logs", "run_log.jsonl")
+    writer = RunLogWriter(str(log_file), run_nr=2, buffer_size=1000, flush_interval=60)
+
+    # events are buffered
+    writer.write(1, {"action": "debug", "state": "ok"})
+    assert not log_file.check()
+
+    for i in range(20):
+        writer.write(2, {"action": "debug", "state": "ok", "msg": "x" * 100})
+    assert log_file.check()
+
+    writer.write(2, "Run finished")
+    writer.close()
+    writer.write(3, "ignored")
+
+    lines = [json.loads(line) for line in log_file.readlines()]
+    assert len(lines) == 22
+    assert lines[0]["freck_id"] == 1 and lines[0]["run_nr"] == 2 and lines[0]["event"]["action"] == "debug"
+    assert lines[-1]["event"] == "Run finished"
+    assert all(isinstance(line["timestamp"], float) for line in lines)
+
+
+def test_run_log_compress(tmpdir):
+
+    log_file = tmpdir.join("run_log.jsonl")
+    writer = RunLogWriter(str(log_file), flush_interval=0, compress=True)
+    writer.write(1, {"state": "ok"})
+    assert log_file.check()
+    writer.close()
+
+    assert not log_file.check()
+    with gzip.open(str(log_file) + ".gz") as f:
+        assert json.loads(f.readline())["event"] == {"state": "ok"}
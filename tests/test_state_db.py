@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_state_db
+----------------------------------
+
+Tests for `state_db` module.
+"""
+
+import time
+from sets import Set
+
+from freckles.state_db import StateDB
+
+
+def item(freck_id, vars, tasks_counter=1):
+
+    return {
+        "freck_id": freck_id,
+        "freck_item_name": "item_{}".format(freck_id),
+        "task_name": "install",
+        "vars": vars,
+        "task_template_keys": Set(["packages"]),
+        "roles": {"install-pkgs": "frkl:install-pkgs"},
+        "tasks": [{"name": "role_{}".format(tasks_counter)}],
+        "role_dict": {"name": "role_{}".format(tasks_counter)}
+    }
+
+
+def test_item_hash(tmpdir):
+
+    internal_roles = tmpdir.mkdir("roles")
+    internal_roles.mkdir("install-pkgs").join("main.yml").write("- debug: msg=1")
+
+    db = StateDB(db_file=None, host="test")
+    item_hash = db.get_item_hash(item(1, {"packages": ["zile"]}), str(internal_roles))
+
+    # ids and generated role names are not part of the desired state
+    assert db.get_item_hash(item(3, {"packages": ["zile"]}, tasks_counter=2), str(internal_roles)) == item_hash
+    assert db.get_item_hash(item(1, {"packages": ["vim"]}), str(internal_roles)) != item_hash
+    # ... the content of internal roles is
+    internal_roles.join("install-pkgs", "main.yml").write("- debug: msg=2")
+    assert StateDB(db_file=None, host="test").get_item_hash(item(1, {"packages": ["zile"]}), str(internal_roles)) != item_hash
+
+
+def test_state_db(tmpdir, monkeypatch):
+
+    db_file = str(tmpdir.join("state.json"))
+
+    db = StateDB(db_file=db_file, max_age=60, host="host_1")
+    assert not db.is_unchanged("hash_1")
+    db.record("hash_1", "changed")
+    db.record("hash_2", "failed")
+    db.store()
+
+    # persisted outcomes are used by the next process, only successful ones, and only for the same host
+    assert StateDB(db_file=db_file, max_age=60, host="host_1").is_unchanged("hash_1")
+    assert not StateDB(db_file=db_file, max_age=60, host="host_1").is_unchanged("hash_2")
+    assert not StateDB(db_file=db_file, max_age=60, host="host_2").is_unchanged("hash_1")
+
+    # a failure removes a previous success
+    db = StateDB(db_file=db_file, max_age=60, host="host_1")
+    db.record("hash_1", "failed")
+    db.store()
+    assert not StateDB(db_file=db_file, max_age=60, host="host_1").is_unchanged("hash_1")
+
+    # outcomes expire
+    db.record("hash_3", "no change")
+    db.store()
+    monkeypatch.setattr(time, "time", lambda: 10000000000)
+    assert not StateDB(db_file=db_file, max_age=60, host="host_1").is_unchanged("hash_3")
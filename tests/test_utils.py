@@ -8,6 +8,7 @@ test_freckles
 Tests for `freckles` module.
 """
 
+import copy
 import os
 from contextlib import contextmanager
 
@@ -64,3 +65,32 @@ def test_parse_dotfiles_item(item, expected):
     ensure_dotfiles_dir()
     result = utils.parse_dotfiles_item(item)
     assert result == expected
+
+
+LAYERS = [
+    {"a": 1, "b": {"c": [1, 2], "d": {"e": 1}}, "f": {"g": 1}},
+    {"b": {"d": {"x": 2}}, "f": "replaced", "h": {"i": 1}},
+    {"b": {"c": [3]}, "f": {"j": 1}, "h": None}
+]
+
+def test_layered_dict_matches_dict_merge():
+
+    expected = {}
+    for layer in copy.deepcopy(LAYERS):
+        utils.dict_merge(expected, layer)
+    original = copy.deepcopy(LAYERS)
+
+    view = utils.LayeredDict(*LAYERS)
+    assert view["b"]["d"]["e"] == 1
+    assert sorted(view.keys()) == sorted(expected.keys())
+
+    view["b"]["d"]["e"] = 5
+    del view["a"]
+    merged = utils.materialize(view)
+    merged["b"]["c"].append(4)
+
+    expected["b"]["d"]["e"] = 5
+    del expected["a"]
+    expected["b"]["c"].append(4)
+    assert merged == expected
+    assert LAYERS == original